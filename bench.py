@@ -0,0 +1,515 @@
+"""Offline benchmarks for the bot, run with: python bench.py <benchmark> [options]
+
+memory  per-user footprint of the storage layer with many users loaded
+load    simulated users driving the real handlers against a fake Yahoo backend
+shard   throughput of sharded worker processes fed synthetic updates
+"""
+import argparse
+import asyncio
+import functools
+import gc
+import json
+import os
+import random
+import resource
+import threading
+import time
+import tracemalloc
+import uuid
+
+from telegram import Update
+
+import stock
+
+def make_universe(count, rng):
+    """Synthetic (ticker, name, exchange) rows standing in for resolved symbols"""
+    universe = []
+    for i in range(count):
+        ticker = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)) + str(i)
+        universe.append((ticker, f"{ticker.title()} Holdings Inc.", rng.choice(['NASDAQ', 'NYSE'])))
+    return universe
+
+def make_users(users, universe, stocks_per_user, groups_per_user, rng):
+    """[(user_id, [rows], [(group_name, [tickers])])] drawn from the universe"""
+    data = []
+    for user_id in range(users):
+        rows = rng.sample(universe, stocks_per_user)
+        groups = [
+            (f"Group {g}", [r[0] for r in rng.sample(rows, min(len(rows), rng.randint(2, 5)))])
+            for g in range(groups_per_user)
+        ]
+        data.append((user_id, rows, groups))
+    return data
+
+def load_slotted(data):
+    storage = stock.MemoryStorage()
+    for user_id, rows, groups in data:
+        for ticker, name, exchange in rows:
+            # Copy the strings as a database read would, interning has to undo that
+            storage.add_stock(user_id, stock.intern_symbol(''.join(ticker), ''.join(name), ''.join(exchange)))
+        for name, tickers in groups:
+            storage.add_group(user_id, stock.Group(name, [''.join(t) for t in tickers]))
+    return storage
+
+def load_dicts(data):
+    """The dict-per-stock layout with copied stock details that groups used to carry"""
+    stocks = {}
+    groups = {}
+    index = stock.SubscriberIndex()  # kept by both layouts
+    for user_id, rows, user_groups in data:
+        user_stocks = stocks[user_id] = [
+            {'name': ''.join(name), 'ticker': ''.join(ticker), 'exchange': ''.join(exchange)}
+            for ticker, name, exchange in rows
+        ]
+        details = {s['ticker']: s for s in user_stocks}
+        groups[user_id] = [
+            {
+                'id': uuid.uuid4().hex,
+                'name': name,
+                'stocks': [''.join(t) for t in tickers],
+                'stock_details': [dict(details[t]) for t in tickers],
+                'active': True,
+            }
+            for name, tickers in user_groups
+        ]
+        for s in user_stocks:
+            index.add_stock(user_id, s['ticker'])
+        for group in groups[user_id]:
+            index.add_group(user_id, group['id'], group['stocks'])
+    return stocks, groups, index
+
+def measure(load, data):
+    """(bytes allocated by load(data) and still alive, result)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = load(data)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+def bench_memory(args):
+    rng = random.Random(args.seed)
+    universe = make_universe(args.symbols, rng)
+    data = make_users(args.users, universe, args.stocks, args.groups, rng)
+
+    slotted, _ = measure(load_slotted, data)
+    dicts, _ = measure(load_dicts, data)
+
+    print(f"{args.users:,} users, {args.stocks} stocks and {args.groups} groups each, {args.symbols:,} distinct symbols")
+    print(f"Slotted records:  {slotted / 2**20:8.1f} MiB  {slotted / args.users:7.0f} bytes/user")
+    print(f"Dict records:     {dicts / 2**20:8.1f} MiB  {dicts / args.users:7.0f} bytes/user")
+    print(f"Saved:            {(dicts - slotted) / dicts:8.1%}")
+
+class FakeYahoo:
+    """Stands in for the yahooquery module's search() and Ticker, with injected latency and errors
+
+    Calls block like the real client does, so they still go through the
+    upstream executor, semaphore and circuit breaker.
+    """
+
+    def __init__(self, universe, latency, jitter, error_rate, seed):
+        self.universe = universe
+        self.by_ticker = {row[0]: row for row in universe}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {'search': 0, 'price': 0}
+        self.errors = {'search': 0, 'price': 0}
+        self.tickers_priced = 0
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors[kind] += 1
+        time.sleep(delay)
+        if fail:
+            raise ConnectionError(f"Injected {kind} failure")
+
+    def search(self, query):
+        self._call('search')
+        q = query.lower()
+        quotes = [
+            {'symbol': ticker, 'shortname': name, 'exchDisp': exchange}
+            for ticker, name, exchange in self.universe
+            if ticker.lower() == q or name.lower().startswith(q)
+        ]
+        return {'quotes': quotes[:10]}
+
+    def Ticker(self, symbols):
+        fake = self
+
+        class FakeTicker:
+            def __init__(self, tickers):
+                self.tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+
+            @property
+            def price(self):
+                fake._call('price')
+                fake.tickers_priced += len(self.tickers)
+                result = {}
+                for ticker in self.tickers:
+                    if ticker in fake.by_ticker:
+                        base = 10 + sum(map(ord, ticker)) % 490
+                        change = fake._rng.uniform(-0.03, 0.03)
+                        result[ticker] = {
+                            'regularMarketPrice': round(base * (1 + change), 2),
+                            'currency': 'USD',
+                            'regularMarketChange': round(base * change, 2),
+                            'regularMarketChangePercent': change,
+                        }
+                    else:
+                        result[ticker] = f"Quote not found for ticker symbol: {ticker}"
+                return result
+
+        return FakeTicker(symbols)
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'errors': dict(self.errors), 'tickers_priced': self.tickers_priced}
+
+class SimulatedUser:
+    """Sends a scripted session through the application, answering keyboards like a person would"""
+
+    def __init__(self, user_id, app, universe, rng, record):
+        self.user_id = user_id
+        self.app = app
+        self.universe = universe
+        self.rng = rng
+        self.record = record
+
+    async def send(self, text):
+        self.record.update_id += 1
+        message = {
+            'message_id': self.record.update_id,
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': f"User{self.user_id}"},
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+            label = command
+        else:
+            conv = stock.conversations.get(self.user_id)
+            label = f"message:{(conv.state if conv else stock.ConvState.IDLE).name.lower()}"
+
+        # Through the update queue, so updates go through the bot's own update processor
+        update = Update.de_json({'update_id': self.record.update_id, 'message': message}, self.app.bot)
+        done = self.record.pending[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.app.update_queue.put(update)
+        await done
+        self.record.latency(label, time.perf_counter() - started)
+
+    def state(self):
+        conv = stock.conversations.get(self.user_id)
+        return conv.state if conv else stock.ConvState.IDLE
+
+    async def add_stock(self):
+        ticker, name, _ = self.rng.choice(self.universe)
+        await self.send('/add')
+        await self.send(ticker if self.rng.random() < 0.7 else name.split()[0])
+        if self.state() == stock.ConvState.CHOOSING_STOCK:
+            option = stock.conversations[self.user_id].options[0]
+            await self.send(f"{option.ticker} - {option.name}")
+        elif self.state() == stock.ConvState.ADDING_STOCK:
+            await self.send('/cancel')
+
+    async def run(self, stocks):
+        await self.send('/start')
+        for _ in range(stocks):
+            await self.add_stock()
+        await self.send('/list')
+
+        tracked = stock.storage.get_stocks(self.user_id)
+        if len(tracked) >= 2:
+            await self.send('/group')
+            await self.send(f"Basket {self.user_id}")
+            for symbol in self.rng.sample(tracked, min(len(tracked), self.rng.randint(2, 5))):
+                await self.send(f"{symbol.ticker} - {symbol.name}")
+            await self.send('Done selecting')
+            await self.send('/groups')
+            await self.send(f"/alert {tracked[0].ticker} above 1000")
+            await self.send('/alerts')
+
+        if tracked:
+            await self.send('/delete')
+            if self.state() == stock.ConvState.DELETING_STOCK:
+                symbol = tracked[-1]
+                await self.send('Yes, delete it' if len(tracked) == 1 else f"{symbol.ticker} - {symbol.name}")
+        await self.send('/groups')
+
+class LoadRecord:
+    def __init__(self):
+        self.update_id = 0
+        self.pending = {}  # {update_id: future resolved once the update processor is done with it}
+        self.latencies = {}  # {handler label: [seconds]}
+        self.errors = 0
+
+    def latency(self, label, seconds):
+        self.latencies.setdefault(label, []).append(seconds)
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p99_ms': samples[int(len(samples) * 0.99)] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+async def run_load(args):
+    rng = random.Random(args.seed)
+    universe = make_universe(args.symbols, rng)
+    yahoo = FakeYahoo(universe, args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed)
+    stock.yahooquery = yahoo
+    stock.storage = stock.MemoryStorage()
+    if args.budget:
+        stock.upstream_quota = stock.UpstreamQuota(args.budget, max(1, args.budget * 4))
+    else:
+        stock.upstream_quota = stock.UpstreamQuota(1e9, 1e9)
+
+    record = LoadRecord()
+    app = stock.build_application(offline=True, echo=False)
+
+    async def on_error(update, context):
+        record.errors += 1
+
+    app.add_error_handler(on_error)
+    processor = app.update_processor
+    process = processor.do_process_update
+
+    async def do_process_update(update, coroutine):
+        try:
+            await process(update, coroutine)
+        finally:
+            record.pending.pop(update.update_id).set_result(None)
+
+    processor.do_process_update = do_process_update
+    # Background refreshes would add their own upstream traffic to the measurement
+    for job in app.job_queue.jobs() if app.job_queue else ():
+        job.schedule_removal()
+    await app.initialize()
+    await app.start()
+    if args.outbox:
+        stock.outbox.start(app.bot)
+
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def session(user_id):
+        async with limit:
+            await SimulatedUser(user_id, app, universe, random.Random(args.seed + user_id), record).run(args.stocks)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+
+    if args.outbox:
+        await stock.outbox.stop()
+    await app.stop()
+    await app.shutdown()
+    stock.upstream_executor.shutdown(wait=False)
+
+    updates = sum(len(samples) for samples in record.latencies.values())
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'run'},
+        'elapsed_s': elapsed,
+        'updates': updates,
+        'throughput_updates_per_s': updates / elapsed,
+        'handler_errors': record.errors,
+        'latency': summarize([s for samples in record.latencies.values() for s in samples]),
+        'handlers': {label: summarize(samples) for label, samples in sorted(record.latencies.items())},
+        'upstream': yahoo.stats() | {
+            'breaker': stock.upstream_breaker.stats(),
+            'coalescer': stock.price_coalescer.stats(),
+            'quota': stock.upstream_quota.stats(),
+        },
+        'caches': {'quotes': stock.quote_cache.stats(), 'search': stock.search_cache.stats()},
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def bench_load(args):
+    results = asyncio.run(run_load(args))
+
+    print(f"{args.users:,} users, {results['updates']:,} updates in {results['elapsed_s']:.1f}s "
+          f"({results['throughput_updates_per_s']:.0f} updates/s), {results['handler_errors']} handler errors")
+    print(f"{'handler':<32}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, row in results['handlers'].items():
+        print(f"{label:<32}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+    overall = results['latency']
+    print(f"{'all':<32}{overall['count']:>8}{overall['p50_ms']:>10.1f}{overall['p99_ms']:>10.1f}")
+    upstream = results['upstream']
+    print(f"Upstream calls: {upstream['calls']} errors: {upstream['errors']} breaker trips: {upstream['breaker']['trips']}")
+    print(f"Answered from cache over quota: {upstream['quota']['refused']}")
+    print(f"Peak RSS: {results['peak_rss_mib']:.0f} MiB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+def install_worker_fakes(symbols, seed, latency, outbox):
+    """Runs first in each shard worker: fake Yahoo, in-memory storage, no files or ports"""
+    universe = make_universe(symbols, random.Random(seed))
+    stock.yahooquery = FakeYahoo(universe, latency, 0, 0.0, seed)
+    stock.STORAGE_BACKEND = 'memory'
+    stock.build_application = functools.partial(stock.build_application, echo=False)
+    stock.load_warm_state = stock.save_warm_state = lambda path=None: None
+    stock.METRICS_PORT = 0
+    stock.PRELOAD_MODULES = ()  # the fake backend needs neither yahooquery nor numpy
+    stock.SHUTDOWN_DRAIN_TIMEOUT = 600  # the backlog is drained on shutdown, which is what's timed
+    if not outbox:
+        # Without the outbox, replies skip Telegram's rate limits, which would otherwise cap throughput
+        stock.outbox.start = lambda bot: None
+
+def synthetic_updates(users, universe, rng):
+    """Raw Update payloads for a short scripted session per user, sessions interleaved
+
+    Scripts don't wait on replies, so every message is valid whatever state it lands in.
+    """
+    scripts = []
+    for user_id in range(1, users + 1):
+        first, second = rng.sample(universe, 2)
+        scripts.append((user_id, [
+            '/start', '/add', first[0], '/add', second[0], '/list',
+            f"/alert {first[0]} above 1000", '/alerts', '/groups', '/export',
+        ]))
+
+    updates = []
+    for step in range(max(len(script) for _, script in scripts)):
+        for user_id, script in scripts:
+            if step < len(script):
+                text = script[step]
+                message = {
+                    'message_id': len(updates) + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+                    'text': text,
+                }
+                if text.startswith('/'):
+                    message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+                updates.append({'update_id': len(updates) + 1, 'message': message})
+    return updates
+
+async def run_shard(args, count, updates, yahoo):
+    """Updates per second through a pool of `count` workers, from first dispatch to last update handled"""
+    setup = functools.partial(install_worker_fakes, args.symbols, args.seed, args.latency / 1000, args.outbox)
+    pool = stock.WorkerPool(count, offline=True, setup=setup)
+    await pool.start()
+    await pool.wait_ready()
+
+    calls_before = dict(yahoo.calls)
+    priced_before = yahoo.tickers_priced
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    for data in updates:
+        pool.dispatch(data)
+    # Workers handle everything they were sent before exiting
+    await pool.stop()
+    elapsed = time.perf_counter() - started
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Includes each worker's startup, which is small next to the updates
+    worker_cpu = (cpu_after.ru_utime + cpu_after.ru_stime) - (cpu_before.ru_utime + cpu_before.ru_stime)
+
+    return {
+        'workers': count,
+        'updates': len(updates),
+        'elapsed_s': elapsed,
+        'throughput_updates_per_s': len(updates) / elapsed,
+        'worker_cpu_ms_per_update': worker_cpu * 1000 / len(updates),
+        'quote_calls': yahoo.calls['price'] - calls_before['price'],
+        'tickers_priced': yahoo.tickers_priced - priced_before,
+    }
+
+def bench_shard(args):
+    rng = random.Random(args.seed)
+    universe = make_universe(args.symbols, rng)
+    updates = synthetic_updates(args.users, universe, rng)
+
+    # The front process runs the shared quote service, so its Yahoo is the one that counts
+    yahoo = FakeYahoo(universe, args.latency / 1000, 0, 0.0, args.seed)
+    stock.yahooquery = yahoo
+    stock.STORAGE_BACKEND = 'memory'
+    stock.SHUTDOWN_DRAIN_TIMEOUT = 600
+
+    cores = os.cpu_count() or 1
+    runs = []
+    for count in args.workers:
+        # A fresh front cache per run, so each run pays for its own quotes
+        stock.quote_cache = stock.TTLCache(stock.QUOTE_CACHE_TTL, stock.QUOTE_CACHE_MAX_ENTRIES)
+        runs.append(asyncio.run(run_shard(args, count, updates, yahoo)))
+
+    baseline = runs[0]['throughput_updates_per_s'] / runs[0]['workers']
+    print(f"{len(updates):,} updates from {args.users:,} users, {cores} CPU cores")
+    print(f"{'workers':>8}{'updates/s':>12}{'speedup':>10}{'efficiency':>12}{'cpu ms/update':>15}"
+          f"{'quote calls':>13}{'tickers':>9}")
+    for run in runs:
+        run['speedup'] = run['throughput_updates_per_s'] / runs[0]['throughput_updates_per_s']
+        run['efficiency'] = run['throughput_updates_per_s'] / (baseline * run['workers'])
+        # What the workers could sustain if each had a core and never waited on I/O
+        run['cpu_bound_updates_per_s'] = min(run['workers'], cores) * 1000 / run['worker_cpu_ms_per_update']
+        print(f"{run['workers']:>8}{run['throughput_updates_per_s']:>12.0f}{run['speedup']:>9.2f}x"
+              f"{run['efficiency']:>12.0%}{run['worker_cpu_ms_per_update']:>15.2f}"
+              f"{run['quote_calls']:>13}{run['tickers_priced']:>9}")
+    if max(args.workers) > cores:
+        print(f"[WARN] Only {cores} CPU cores: runs with more workers share them, so any speedup beyond "
+              f"{cores}x comes from overlapping waits (batch windows, upstream calls), not extra compute")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'config': {key: value for key, value in vars(args).items() if key != 'run'},
+            'cpu_count': cores,
+            'runs': runs,
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the stock bot")
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    memory = benchmarks.add_parser('memory', help="per-user storage footprint")
+    memory.add_argument('--users', type=int, default=100_000)
+    memory.add_argument('--symbols', type=int, default=5_000)
+    memory.add_argument('--stocks', type=int, default=8, help="tracked stocks per user")
+    memory.add_argument('--groups', type=int, default=2, help="groups per user")
+    memory.add_argument('--seed', type=int, default=1)
+    memory.set_defaults(run=bench_memory)
+
+    load = benchmarks.add_parser('load', help="handler latency and throughput under simulated users")
+    load.add_argument('--users', type=int, default=2_000)
+    load.add_argument('--concurrency', type=int, default=200, help="users in a session at once")
+    load.add_argument('--stocks', type=int, default=4, help="/add attempts per user")
+    load.add_argument('--symbols', type=int, default=2_000)
+    load.add_argument('--latency', type=float, default=50, help="fake Yahoo latency in ms")
+    load.add_argument('--jitter', type=float, default=50, help="extra random latency in ms")
+    load.add_argument('--error-rate', type=float, default=0.0, help="share of fake Yahoo calls that fail")
+    load.add_argument('--outbox', action='store_true', help="pace replies through the outbox like production")
+    load.add_argument('--budget', type=float, default=0,
+                      help="global upstream calls/second, as UPSTREAM_BUDGET_RATE in the bot; 0 for no budget")
+    load.add_argument('--seed', type=int, default=1)
+    load.add_argument('--output', default='bench_results.json')
+    load.set_defaults(run=bench_load)
+
+    shard = benchmarks.add_parser('shard', help="update throughput as worker processes are added")
+    shard.add_argument('--users', type=int, default=2_000)
+    shard.add_argument('--symbols', type=int, default=2_000)
+    shard.add_argument('--workers', type=lambda value: [int(n) for n in value.split(',')], default=[1, 2, 4],
+                       help="comma-separated worker counts to run, the first is the baseline")
+    shard.add_argument('--latency', type=float, default=0, help="fake Yahoo latency in ms")
+    shard.add_argument('--outbox', action='store_true', help="pace replies through the outbox like production")
+    shard.add_argument('--seed', type=int, default=1)
+    shard.add_argument('--output', default='bench_results.json')
+    shard.set_defaults(run=bench_shard)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
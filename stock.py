@@ -1,13 +1,1924 @@
+from __future__ import annotations
+
+import argparse
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, ContextTypes, filters
-from yahooquery import Ticker, search
+import bisect
+import calendar
+import contextvars
+import csv
+import functools
+import heapq
+import hmac
+import importlib
+import importlib.util
+import io
+import json
+import marshal
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from enum import Enum
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+boot_started = time.perf_counter()
+boot_marks = []  # [(phase, perf_counter when it finished)] in startup order
+
+def boot_mark(phase):
+    """Record that a startup phase just finished"""
+    boot_marks.append((phase, time.perf_counter()))
+
+def boot_report():
+    previous = boot_started
+    parts = []
+    for phase, at in boot_marks:
+        parts.append(f"{phase} {(at - previous) * 1000:.0f}ms")
+        previous = at
+    return f"Startup took {(previous - boot_started) * 1000:.0f}ms: {', '.join(parts)}"
+
+lazy_modules = {}  # {module name: LazyModule}
+
+class LazyModule:
+    """Stands in for a heavy module and imports it on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+        lazy_modules[name] = self
+
+    def _import(self):
+        # Underscored so it can't shadow an attribute of the module, such as numpy.load
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._import(), attr)
+        setattr(self, attr, value)  # later lookups skip __getattr__
+        return value
+
+# The data stack costs more to import than the rest of the bot put together, so it
+# loads in the background after startup (see preload_modules) or on first use
+np = LazyModule('numpy')
+yahooquery = LazyModule('yahooquery')  # pulls in pandas and requests
+aiohttp = LazyModule('aiohttp') if importlib.util.find_spec('aiohttp') else None
+
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+boot_mark('imports')
 
 BOT_TOKEN = 'YOUR_BOT_TOKEN_HERE'
+WEBHOOK_SECRET = 'YOUR_WEBHOOK_SECRET_HERE'  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = ''  # public URL registered with Telegram, e.g. 'https://example.com/webhook'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WORKERS = 1  # worker processes handling updates (webhook or polling), each user always lands on the same one
+POLL_TIMEOUT = 30  # seconds a getUpdates long poll waits when the front process polls for workers
+QUOTE_SERVICE_SOCKET = ''  # Unix socket workers fetch quotes through, '' for one in the temp directory
+MAX_REQUEST_BODY = 1024 * 1024
+SHUTDOWN_DRAIN_TIMEOUT = 10  # seconds to let in-flight updates finish on shutdown
+UPDATE_CONCURRENCY = 256  # updates handled at once; each user's still run one at a time, in arrival order
+UPDATE_MAX_PENDING = 4096  # updates accepted for handling, including those waiting for their user's earlier ones
+
+QUOTE_CACHE_TTL = 30  # seconds a cached quote is considered fresh
+QUOTE_CACHE_MAX_ENTRIES = 5000  # quotes are small fixed-shape dicts, so this bounds cache memory
+PRICE_BATCH_WINDOW = 0.2  # seconds to gather concurrent price requests into one upstream call
+REFRESH_TICK = 15  # seconds between runs of the background group price refresher
+REFRESH_INTERVAL_OPEN = 60  # seconds between refreshes of a ticker while the market is open
+REFRESH_INTERVAL_CLOSED = 1800  # seconds between refreshes of a ticker outside market hours
+REFRESH_BATCH_SIZE = 100  # tickers per upstream call when refreshing
+MARKET_TZ = ZoneInfo('America/New_York')
+TICK_RING_SIZE = 400  # samples kept per ticker, a 6.5 hour session at one per TICK_SAMPLE_INTERVAL fits
+TICK_SAMPLE_INTERVAL = 60  # seconds between kept samples, newer ticks replace the latest sample
+TICK_RING_MAX_TICKERS = 5000  # rings kept at once, each costs a fixed 12 bytes per sample
+SPARKLINE_WIDTH = 16  # characters in a /groups sparkline
+SEARCH_CACHE_TTL = 24 * 3600  # seconds a cached search result is reused
+SEARCH_CACHE_MAX_ENTRIES = 2000
+SUBSCRIBER_STATS_TOP = 20  # most-held tickers exported with their subscriber counts
+SEARCH_INDEX_MIN_QUERY = 3  # shortest name prefix the local symbol index answers while search is unavailable
+WARM_STATE_FILE = 'warm_state.bin'  # quote, search and symbol caches carried across restarts
+WARM_STATE_SAVE_INTERVAL = 600  # seconds between background saves of the warm state
+PRELOAD_MODULES = ('yahooquery', 'numpy')  # imported in the background once the bot is up
+STORAGE_BACKEND = 'sqlite'  # 'sqlite' or 'memory'
+STORAGE_PATH = 'stockbot.db'
+WRITE_BEHIND_INTERVAL = 0.5  # seconds of writes batched into one SQLite commit
+WRITE_BEHIND_MAX_BATCH = 500
+ALERTS_MAX_PER_USER = 50
+DIGEST_TICK = 30  # seconds between checks for due digests
+DIGEST_CLOSE_MINUTE = 16 * 60 + 5  # market-close digests go out at 16:05 New York time on weekdays
+DIGEST_RENDER_CHUNK = 500  # digests rendered between yields to the event loop
+IMPORT_MAX_ENTRIES = 500  # tickers or names accepted by one /import
+IMPORT_MAX_FILE_SIZE = 256 * 1024
+IMPORT_CONCURRENCY = 8  # searches one import runs at once, the upstream limit still applies
+SEND_GLOBAL_RATE = 25  # messages/second across all chats, under Telegram's ~30/s limit
+SEND_CHAT_RATE = 1  # messages/second to a single chat
+SEND_CHAT_BURST = 3  # messages a chat can receive back to back before SEND_CHAT_RATE applies
+SEND_MAX_RETRIES = 3
+SEND_CONCURRENCY = 16  # sends in flight at once, so round trips to Telegram overlap
+SEND_FLOOD_CHATS = 3  # chats answered 429 within a second before every chat is paused, not just those
+MAX_MESSAGE_LENGTH = 4096
+RENDER_CACHE_MAX_ENTRIES = 50000  # rendered group blocks kept between /groups calls
+UPSTREAM_WORKERS = 8  # threads dedicated to blocking Yahoo calls
+UPSTREAM_CONCURRENCY = 4  # Yahoo calls allowed in flight at once
+UPSTREAM_TIMEOUT = 10  # seconds before a Yahoo call is abandoned
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures that open the circuit breaker
+BREAKER_RESET_TIMEOUT = 30  # seconds the breaker stays open before a trial call
+USER_UPSTREAM_RATE = 0.5  # upstream lookups/second a user can cause once their burst is spent
+USER_UPSTREAM_BURST = 20
+UPSTREAM_BUDGET_RATE = 5  # upstream calls/second for the whole bot, split between worker processes and the front
+UPSTREAM_BUDGET_BURST = 20
+UPSTREAM_FRONT_SHARE = 0.5  # part of the budget the front keeps for the quotes it fetches for every worker
+UPSTREAM_QUEUE_TIMEOUT = 3  # seconds a call waits for the budget before the caller falls back to cache
+UPSTREAM_PATIENT_TIMEOUT = 60  # seconds an /import lookup waits for the budget before it's skipped
+UPSTREAM_SYSTEM_WEIGHT = 4  # fair-queuing share of background refreshes and shared price batches, a user has 1
+USE_ASYNC_HTTP = False  # fetch from Yahoo over aiohttp instead of yahooquery threads
+HISTORY_DIR = 'history'
+HISTORY_YEARS = 5  # daily bars backfilled the first time a ticker is seen
+HISTORY_INTRADAY_INTERVAL = '5m'
+HISTORY_INTRADAY_DAYS = 5  # intraday bars backfilled the first time a ticker is seen
+HISTORY_SYNC_INTERVAL = {'1d': 3600, HISTORY_INTRADAY_INTERVAL: 300}  # seconds before asking Yahoo for new bars again
+HISTORY_MAX_SEGMENTS = 8  # files of appended bars kept per ticker before they're merged back into one
+ANALYSIS_BENCHMARK = 'SPY'
+ANALYSIS_CACHE_MAX_ENTRIES = 1000
+TRADING_DAYS = 252
+SIMULATION_PATHS = 1_000_000
+SIMULATION_MAX_PATHS = 2_000_000
+SIMULATION_BATCH = 50_000  # paths per worker task; fixed so results don't depend on the core count
+SIMULATION_WORKERS = os.cpu_count() or 1
+SIMULATION_SEED = 20240601
+SIMULATION_MONTHS = 12  # note tenor, observed monthly
+RISK_FREE_RATE = 0.04
+AUTOCALL_LEVEL = 1.0  # worst performer at or above this on a quarterly date calls the note
+AUTOCALL_COUPON = 0.08  # per year, paid on call or at maturity
+AUTOCALL_BARRIER = 0.6  # worst performer below this (monthly) puts capital at risk
+PROTECTED_PARTICIPATION = 1.0  # share of the basket's upside paid at maturity
+PROTECTED_KNOCKOUT = 1.4  # basket at or above this (monthly) replaces the upside with a rebate
+PROTECTED_REBATE = 0.05
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464  # Prometheus scrape port, worker processes use the ports after it; 0 disables
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+ADMIN_USER_IDS = set()  # Telegram user IDs allowed to use /stats and /profile
+PROFILE_INTERVAL = 0.005  # seconds between stack samples while profiling
+PROFILE_OUTPUT = 'profile.folded'
+PERFORMANCE_PERIODS = {'1d': 1, '1w': 7, '1m': 30, '3m': 91, '6m': 182, '1y': 365, '3y': 3 * 365, '5y': 5 * 365}  # days
+
+latest_prices = {}  # {ticker: price_data}, the shared price table every group reads from
+price_versions = {}  # {ticker: int} bumped whenever the ticker's entry in latest_prices changes
+next_refresh_at = {}  # {ticker: timestamp} when the refresher should fetch the ticker again
+
+class TTLCache:
+    """Process-wide LRU cache with a freshness TTL, shared by all users"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {key: (stored_at, value)}, oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, max_age=None):
+        """Return the cached value if it is fresher than max_age (defaults to the TTL)"""
+        entry = self._entries.get(key)
+        limit = self.ttl if max_age is None else max_age
+
+        if entry is None or time.time() - entry[0] > limit:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, stored_at=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self._entries[key] = (stored_at or time.time(), value)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_stale(self, key):
+        """Return the cached value however old it is, for when upstream is unavailable"""
+        entry = self._entries.get(key)
+        return entry[1] if entry else None
+
+    def items(self):
+        """(key, stored_at, value) for every entry, oldest first"""
+        return [(key, stored_at, value) for key, (stored_at, value) in self._entries.items()]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class Symbol:
+    """A resolved ticker, shared by every user, group and search result that mentions it"""
+
+    __slots__ = ('ticker', 'name', 'exchange')
+
+    def __init__(self, ticker, name, exchange=''):
+        self.ticker = ticker
+        self.name = name
+        self.exchange = exchange
+
+    def __repr__(self):
+        return f"Symbol({self.ticker!r}, {self.name!r}, {self.exchange!r})"
+
+symbols = {}  # {ticker: Symbol}, the single metadata record kept per ticker
+
+def intern_symbol(ticker, name, exchange=''):
+    """The shared Symbol for a ticker, created the first time the ticker is seen"""
+    symbol = symbols.get(ticker)
+    if symbol is None:
+        ticker = sys.intern(ticker)
+        symbol = symbols[ticker] = Symbol(ticker, name, exchange or '')
+    elif exchange and not symbol.exchange:
+        symbol.exchange = exchange
+    return symbol
+
+class Group:
+    """A named basket of tickers; names and exchanges are looked up in the symbols table"""
+
+    __slots__ = ('id', 'name', 'stocks', 'active')
+
+    def __init__(self, name, stocks, active=True, id=None):
+        self.id = id or uuid.uuid4().hex
+        self.name = name
+        self.stocks = tuple(sys.intern(t) for t in stocks)
+        self.active = active
+
+    def __repr__(self):
+        return f"Group({self.name!r}, {self.stocks!r}, active={self.active})"
+
+class SymbolIndex:
+    """Prefix trie over every symbol and company name the bot has resolved"""
+
+    def __init__(self):
+        self._root = {}  # {char: child_node}, tickers ending at a node are stored under ''
+
+    def add(self, symbol):
+        for key in (symbol.ticker.lower(), normalize_query(symbol.name)):
+            node = self._root
+            for char in key:
+                node = node.setdefault(char, {})
+            node.setdefault('', set()).add(symbol.ticker)
+
+    def exact(self, query):
+        """Symbol whose ticker is exactly the query, if known"""
+        return symbols.get(query.upper())
+
+    def known(self, query):
+        """The Symbol the query can only mean: a known ticker written as one, or a known company's full name"""
+        # Anything else, like 'ford', may be a company we haven't seen yet
+        query = query.strip()
+        if query.isupper() and ' ' not in query:
+            return self.exact(query)
+        key = normalize_query(query)
+        node = self._node(key) or {}
+        named = [t for t in node.get('', ()) if normalize_query(symbols[t].name) == key]
+        return symbols[named[0]] if len(named) == 1 else None
+
+    def _node(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def lookup(self, prefix, limit=10):
+        """Symbols whose ticker or name starts with the prefix"""
+        node = self._node(prefix)
+        if node is None:
+            return []
+
+        found = []
+        stack = [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            for key, child in node.items():
+                if key == '':
+                    found.extend(t for t in sorted(child) if t not in found)
+                else:
+                    stack.append(child)
+
+        return [symbols[t] for t in found[:limit]]
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+quote_cache = TTLCache(QUOTE_CACHE_TTL, QUOTE_CACHE_MAX_ENTRIES)
+search_cache = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+symbol_index = SymbolIndex()
+
+class SubscriberIndex:
+    """Reverse index from ticker to the users watching it and the active groups holding it"""
+
+    def __init__(self):
+        self.watchers = {}  # {ticker: {user_id}}
+        self.groups = {}  # {ticker: {group_id: user_id}}, active groups only
+
+    def add_stock(self, user_id, ticker):
+        self.watchers.setdefault(ticker, set()).add(user_id)
+
+    def remove_stock(self, user_id, ticker):
+        users = self.watchers.get(ticker)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self.watchers[ticker]
+
+    def add_group(self, user_id, group_id, tickers):
+        for ticker in tickers:
+            self.groups.setdefault(ticker, {})[group_id] = user_id
+
+    def remove_group(self, group_id, tickers):
+        for ticker in tickers:
+            holders = self.groups.get(ticker)
+            if holders is not None:
+                holders.pop(group_id, None)
+                if not holders:
+                    del self.groups[ticker]
+
+    def subscribers(self, ticker):
+        """User IDs that watch the ticker or hold it in an active group"""
+        users = set(self.watchers.get(ticker, ()))
+        users.update(self.groups.get(ticker, {}).values())
+        return users
+
+    def group_holders(self, ticker):
+        """{group_id: user_id} for active groups holding the ticker"""
+        return self.groups.get(ticker, {})
+
+    def active_group_tickers(self):
+        return set(self.groups)
+
+    def most_held(self, limit=SUBSCRIBER_STATS_TOP):
+        """[(ticker, subscriber count)] for the tickers with the most subscribers"""
+        tickers = self.watchers.keys() | self.groups.keys()
+        counts = ((t, len(self.subscribers(t))) for t in tickers)
+        return heapq.nsmallest(limit, counts, key=lambda item: (-item[1], item[0]))
+
+    def stats(self):
+        return {
+            'tickers': len(self.watchers.keys() | self.groups.keys()),
+            'watches': sum(len(users) for users in self.watchers.values()),
+            'group_holdings': sum(len(holders) for holders in self.groups.values()),
+        }
+
+class MemoryStorage:
+    """Keeps each user's tracked stocks and groups in process memory
+
+    Stocks are references into the shared symbols table, so a user costs one
+    small dict entry per ticker rather than a copy of its metadata. The list
+    returned by get_groups is owned by the storage and must only be changed
+    through its methods.
+    """
+
+    def __init__(self):
+        self._stocks = {}  # {user_id: {ticker: Symbol}}, in the order they were added
+        self._groups = {}  # {user_id: [Group]}
+        self.index = SubscriberIndex()
+
+    def _load_user(self, user_id):
+        self._stocks[user_id] = {}
+        self._groups[user_id] = []
+
+    async def preload(self, user_ids):
+        """Load the users' data ahead of use, nothing to do when it's all in memory"""
+
+    def _write(self, sql, params):
+        pass
+
+    def _user_stocks(self, user_id):
+        if user_id not in self._stocks:
+            self._load_user(user_id)
+        return self._stocks[user_id]
+
+    def get_stocks(self, user_id):
+        return list(self._user_stocks(user_id).values())
+
+    def get_stock(self, user_id, ticker):
+        """The user's tracked Symbol for the ticker, or None"""
+        return self._user_stocks(user_id).get(ticker)
+
+    def has_stock(self, user_id, ticker):
+        return ticker in self._user_stocks(user_id)
+
+    def get_groups(self, user_id):
+        if user_id not in self._groups:
+            self._load_user(user_id)
+        return self._groups[user_id]
+
+    def add_stock(self, user_id, symbol):
+        self._user_stocks(user_id)[symbol.ticker] = symbol
+        self.index.add_stock(user_id, symbol.ticker)
+        self._write(
+            "INSERT OR REPLACE INTO stocks (user_id, ticker, name, exchange, position) VALUES (?, ?, ?, ?, ?)",
+            (user_id, symbol.ticker, symbol.name, symbol.exchange, time.time_ns())
+        )
+
+    def remove_stock(self, user_id, ticker):
+        self._user_stocks(user_id).pop(ticker, None)
+        self.index.remove_stock(user_id, ticker)
+        self._write("DELETE FROM stocks WHERE user_id = ? AND ticker = ?", (user_id, ticker))
+
+    def add_group(self, user_id, group):
+        self.get_groups(user_id).append(group)
+        if group.active:
+            self.index.add_group(user_id, group.id, group.stocks)
+        self._write(
+            "INSERT INTO groups (id, user_id, name, active, position) VALUES (?, ?, ?, ?, ?)",
+            (group.id, user_id, group.name, int(group.active), time.time_ns())
+        )
+        for position, ticker in enumerate(group.stocks):
+            self._write(
+                "INSERT INTO group_stocks (group_id, user_id, ticker, position) VALUES (?, ?, ?, ?)",
+                (group.id, user_id, ticker, position)
+            )
+
+    def set_group_active(self, user_id, group_id, active):
+        for group in self.get_groups(user_id):
+            if group.id == group_id:
+                if active and not group.active:
+                    self.index.add_group(user_id, group_id, group.stocks)
+                elif group.active and not active:
+                    self.index.remove_group(group_id, group.stocks)
+                group.active = active
+                self._write("UPDATE groups SET active = ? WHERE id = ?", (int(active), group_id))
+                return group
+        return None
+
+    def active_group_tickers(self):
+        """Union of tickers across all active groups"""
+        return self.index.active_group_tickers()
+
+    def add_alert(self, alert):
+        self._write(
+            "INSERT INTO alerts (id, user_id, ticker, kind, threshold) VALUES (?, ?, ?, ?, ?)",
+            (alert['id'], alert['user_id'], alert['ticker'], alert['kind'], alert['threshold'])
+        )
+
+    def remove_alert(self, alert_id):
+        self._write("DELETE FROM alerts WHERE id = ?", (alert_id,))
+
+    def load_alerts(self):
+        """Every stored alert, for the alert engine to index at startup"""
+        return []
+
+    def set_digest(self, digest):
+        self._write(
+            "INSERT OR REPLACE INTO digests (user_id, kind, minute, timezone) VALUES (?, ?, ?, ?)",
+            (digest['user_id'], digest['kind'], digest['minute'], digest['timezone'])
+        )
+
+    def remove_digest(self, user_id):
+        self._write("DELETE FROM digests WHERE user_id = ?", (user_id,))
+
+    def load_digests(self):
+        """Every digest subscription, for the scheduler to index at startup"""
+        return []
+
+    def set_holding(self, holding):
+        self._write(
+            "INSERT OR REPLACE INTO holdings (group_id, user_id, ticker, quantity, cost) VALUES (?, ?, ?, ?, ?)",
+            (holding['group_id'], holding['user_id'], holding['ticker'], holding['quantity'], holding['cost'])
+        )
+
+    def remove_holding(self, group_id, ticker):
+        self._write("DELETE FROM holdings WHERE group_id = ? AND ticker = ?", (group_id, ticker))
+
+    def load_holdings(self):
+        """Every group holding, for the portfolios to value at startup"""
+        return []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteStorage(MemoryStorage):
+    """MemoryStorage backed by SQLite
+
+    Users are loaded from disk the first time they are seen, by a reader
+    thread when preload() gets to them first. Writes are queued and committed
+    in batches by a background thread, so handlers never wait on disk.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stocks (
+            user_id INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            name TEXT NOT NULL,
+            exchange TEXT,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ticker)
+        );
+        CREATE INDEX IF NOT EXISTS idx_stocks_ticker ON stocks (ticker);
+        CREATE TABLE IF NOT EXISTS groups (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            active INTEGER NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_groups_user ON groups (user_id);
+        CREATE TABLE IF NOT EXISTS group_stocks (
+            group_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (group_id, ticker)
+        );
+        CREATE INDEX IF NOT EXISTS idx_group_stocks_user ON group_stocks (user_id);
+        CREATE INDEX IF NOT EXISTS idx_group_stocks_ticker ON group_stocks (ticker);
+        CREATE TABLE IF NOT EXISTS alerts (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            threshold REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_alerts_ticker ON alerts (ticker);
+        CREATE TABLE IF NOT EXISTS digests (
+            user_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            minute INTEGER NOT NULL,
+            timezone TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS holdings (
+            group_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (group_id, ticker)
+        );
+    """
+
+    def __init__(self, path=STORAGE_PATH, shard=None):
+        super().__init__()
+        self.path = path
+        self.shard = shard  # (index, count) when users are split across worker processes
+        self._db = self._connect()
+        self._db.executescript(self.SCHEMA)
+        self._build_index()
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-reader')
+        self._read_db = None  # the reader thread's own connection
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='storage-writer', daemon=True)
+        self._writer.start()
+
+    @classmethod
+    def prepare(cls, path=STORAGE_PATH):
+        """Create the schema and switch to WAL up front, so worker processes opening it together don't race"""
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(cls.SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def owns(self, user_id):
+        """Whether this process serves the user"""
+        return self.shard is None or user_shard(user_id, self.shard[1]) == self.shard[0]
+
+    def _build_index(self):
+        """Fill the subscriber index for every user without loading their data"""
+        for user_id, ticker in self._db.execute("SELECT user_id, ticker FROM stocks"):
+            if self.owns(user_id):
+                self.index.add_stock(user_id, sys.intern(ticker))
+        for group_id, user_id, ticker in self._db.execute(
+            "SELECT gs.group_id, gs.user_id, gs.ticker FROM group_stocks gs "
+            "JOIN groups g ON g.id = gs.group_id WHERE g.active = 1"
+        ):
+            if self.owns(user_id):
+                self.index.add_group(user_id, group_id, [sys.intern(ticker)])
+
+    def _read_user(self, db, user_id):
+        """(stock rows, group member rows, group rows) for the user"""
+        return (
+            db.execute(
+                "SELECT ticker, name, exchange FROM stocks WHERE user_id = ? ORDER BY position", (user_id,)
+            ).fetchall(),
+            db.execute(
+                "SELECT group_id, ticker FROM group_stocks WHERE user_id = ? ORDER BY position", (user_id,)
+            ).fetchall(),
+            db.execute(
+                "SELECT id, name, active FROM groups WHERE user_id = ? ORDER BY position", (user_id,)
+            ).fetchall(),
+        )
+
+    def _install_user(self, user_id, stock_rows, member_rows, group_rows):
+        stocks = {}
+        for ticker, name, exchange in stock_rows:
+            symbol = intern_symbol(ticker, name, exchange)
+            stocks[symbol.ticker] = symbol
+
+        members = {}
+        for group_id, ticker in member_rows:
+            members.setdefault(group_id, []).append(ticker)
+
+        self._stocks[user_id] = stocks
+        self._groups[user_id] = [
+            Group(name, members.get(group_id, ()), bool(active), group_id)
+            for group_id, name, active in group_rows
+        ]
+
+    def _load_user(self, user_id):
+        # Blocks the event loop, only for users that weren't preloaded
+        self._install_user(user_id, *self._read_user(self._db, user_id))
+
+    def _read_users(self, user_ids):
+        if self._read_db is None:
+            self._read_db = self._connect()
+        return {user_id: self._read_user(self._read_db, user_id) for user_id in user_ids}
+
+    async def preload(self, user_ids):
+        """Read the users not loaded yet on the reader thread, so handlers don't query SQLite on the event loop"""
+        missing = [user_id for user_id in user_ids if user_id not in self._stocks]
+        if not missing:
+            return
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(self._reader, self._read_users, missing)
+        for user_id, user_rows in rows.items():
+            # A user loaded in the meantime may already have changes the rows don't
+            if user_id not in self._stocks:
+                self._install_user(user_id, *user_rows)
+
+    def _write(self, sql, params):
+        self._queue.put((sql, params))
+
+    def _write_loop(self):
+        db = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            # Gather whatever else arrives within the batching interval
+            batch = [item]
+            deadline = time.monotonic() + WRITE_BEHIND_INTERVAL
+            stop = False
+            while len(batch) < WRITE_BEHIND_MAX_BATCH:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                with db:
+                    for sql, params in batch:
+                        db.execute(sql, params)
+            except Exception as e:
+                print(f"[ERROR] Failed to write {len(batch)} storage changes: {e}")
+
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                break
+        db.close()
+
+    def load_alerts(self):
+        return [
+            {'id': alert_id, 'user_id': user_id, 'ticker': ticker, 'kind': kind, 'threshold': threshold}
+            for alert_id, user_id, ticker, kind, threshold in self._db.execute(
+                "SELECT id, user_id, ticker, kind, threshold FROM alerts"
+            )
+            if self.owns(user_id)
+        ]
+
+    def load_digests(self):
+        return [
+            {'user_id': user_id, 'kind': kind, 'minute': minute, 'timezone': tz}
+            for user_id, kind, minute, tz in self._db.execute(
+                "SELECT user_id, kind, minute, timezone FROM digests"
+            )
+            if self.owns(user_id)
+        ]
+
+    def load_holdings(self):
+        return [
+            {'group_id': group_id, 'user_id': user_id, 'ticker': ticker, 'quantity': quantity, 'cost': cost}
+            for group_id, user_id, ticker, quantity, cost in self._db.execute(
+                "SELECT group_id, user_id, ticker, quantity, cost FROM holdings"
+            )
+            if self.owns(user_id)
+        ]
+
+    def flush(self):
+        """Block until every queued write is committed"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._reader.shutdown()
+        if self._read_db is not None:
+            self._read_db.close()
+        self._db.close()
+
+def user_shard(user_id, count):
+    return user_id % count
+
+def open_storage(backend=STORAGE_BACKEND, shard=None):
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(STORAGE_PATH, shard)
+    raise ValueError(f"Unknown storage backend '{backend}'")
+
+storage = MemoryStorage()  # replaced by open_storage() when the bot starts
+worker_index = 0  # set in worker processes, offsets the metrics port
+
+class Histogram:
+    """Fixed-bucket latency histogram, one list increment per observation"""
+
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # the last bucket is +Inf
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+class Metrics:
+    """Process-wide counters and latency histograms, keyed by name and a tuple of label pairs"""
+
+    def __init__(self):
+        self.counters = {}  # {(name, labels): int}
+        self.histograms = {}  # {(name, labels): Histogram}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(seconds)
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of everything recorded, plus (name, labels, value) gauges"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"stockbot_{name}{fmt(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"stockbot_{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"stockbot_{name}_sum{fmt(labels)} {histogram.total}")
+            lines.append(f"stockbot_{name}_count{fmt(labels)} {cumulative}")
+        for name, labels, value in gauges:
+            lines.append(f"stockbot_{name}{fmt(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def timed(name, **labels):
+    """Decorator recording an async function's duration as name_seconds and failures as name_errors_total"""
+    labels = tuple(sorted(labels.items()))
+
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc(f"{name}_errors_total", labels)
+                raise
+            finally:
+                metrics.observe(f"{name}_seconds", time.perf_counter() - started, labels)
+        return wrapper
+    return decorate
+
+def attributed(callback):
+    """Wrap a handler so the update's user is loaded off the event loop and charged for the upstream calls it makes"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = getattr(update, 'effective_user', None)
+        if user:
+            await storage.preload((user.id,))
+        token = upstream_user.set(user.id if user else None)
+        try:
+            return await callback(update, context)
+        finally:
+            upstream_user.reset(token)
+    return wrapper
+
+class SamplingProfiler:
+    """Samples every thread's stack on a timer while running
+
+    Stacks are kept folded ("outer;inner count" per line), the input format
+    of flamegraph.pl and speedscope. Costs nothing while stopped.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks = Counter()
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}  # {code: frame label}, so repeated frames aren't reformatted
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = names.get(code)
+                    if label is None:
+                        label = names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(label)
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit=10):
+        """(frame, samples) for the innermost frames seen most often"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(limit)
+
+profiler = SamplingProfiler()
+
+def message_length(text):
+    """Length as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode('utf-16-le')) // 2
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available"""
+        self._refill(now or time.monotonic())
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        self._refill(now or time.monotonic())
+        self.tokens -= 1
+
+class Outbox:
+    """Rate-limited outbound message scheduler
+
+    Interactive replies go ahead of bulk notifications. Pending bulk messages
+    to the same chat are merged into one. Sends honour a global and a
+    per-chat token bucket and up to SEND_CONCURRENCY run at once, one per
+    chat so a chat's messages stay in order. A 429 pauses and retries that
+    chat; only a flood across several chats pauses them all.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self._interactive = deque()  # messages that a handler is waiting on
+        self._bulk = OrderedDict()  # {chat_id: [message]} notifications, oldest chat first
+        self._global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._chats = {}  # {chat_id: TokenBucket}
+        self._chat_paused = {}  # {chat_id: monotonic time} the chat was told to wait until by a 429
+        self._floods = deque()  # (monotonic time, chat_id) of recent 429s
+        self._paused_until = 0  # every chat waits until then after a flood
+        self._sending = None
+        self._in_flight = {}  # {chat_id: task sending to it}
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)  # seconds from enqueue to sent, most recent sends
+
+    def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._sending = asyncio.Semaphore(SEND_CONCURRENCY)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=5):
+        """Stop the worker after giving queued messages a chance to go out"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._interactive or self._bulk or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        self._task = None
+
+    async def send(self, chat_id, send, text, **kwargs):
+        """Send an interactive message with `send(text, **kwargs)` and return its result"""
+        if self._task is None:
+            started = time.perf_counter()
+            try:
+                return await send(text, **kwargs)
+            finally:
+                metrics.observe('telegram_send_seconds', time.perf_counter() - started)
+
+        future = asyncio.get_running_loop().create_future()
+        self._interactive.append({
+            'chat_id': chat_id, 'send': send, 'text': text, 'kwargs': kwargs,
+            'future': future, 'queued_at': time.monotonic(), 'attempts': 0
+        })
+        self._wakeup.set()
+        return await future
+
+    def notify(self, chat_id, text):
+        """Queue a bulk notification, merging it with one already pending for the chat"""
+        pending = self._bulk.setdefault(chat_id, [])
+        if pending and message_length(pending[-1]['text']) + message_length(text) + 2 <= MAX_MESSAGE_LENGTH:
+            pending[-1]['text'] += "\n\n" + text
+            self.merged += 1
+        else:
+            pending.append({
+                'chat_id': chat_id, 'send': None, 'text': text, 'kwargs': {},
+                'future': None, 'queued_at': time.monotonic(), 'attempts': 0
+            })
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Drop buckets of idle chats, a new one starts full anyway
+                now = time.monotonic()
+                for idle_chat, idle_bucket in list(self._chats.items()):
+                    idle_bucket.wait_time(now)
+                    if idle_bucket.tokens >= idle_bucket.capacity:
+                        del self._chats[idle_chat]
+            bucket = self._chats[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    def _chat_wait(self, chat_id, now):
+        """Seconds until the chat may be sent to, None while a send to it is in flight"""
+        if chat_id in self._in_flight:
+            return None
+        wait = self._chat_bucket(chat_id).wait_time(now)
+        paused_until = self._chat_paused.get(chat_id)
+        if paused_until is not None:
+            if paused_until > now:
+                return max(wait, paused_until - now)
+            del self._chat_paused[chat_id]
+        return wait
+
+    def _pop_ready(self, now):
+        """Next message whose chat may be sent to, or the seconds until one will be"""
+        wait = None
+        for i, message in enumerate(self._interactive):
+            chat_wait = self._chat_wait(message['chat_id'], now)
+            if chat_wait == 0:
+                del self._interactive[i]
+                return message, 0
+            if chat_wait is not None:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+
+        for chat_id, pending in self._bulk.items():
+            chat_wait = self._chat_wait(chat_id, now)
+            if chat_wait == 0:
+                message = pending.pop(0)
+                if not pending:
+                    del self._bulk[chat_id]
+                return message, 0
+            if chat_wait is not None:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+
+        return None, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait:
+                await asyncio.sleep(global_wait)
+                continue
+
+            if self._sending.locked():
+                await self._sending.acquire()
+                self._sending.release()
+                continue
+
+            message, wait = self._pop_ready(now)
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take(now)
+            self._chat_bucket(message['chat_id']).take(now)
+            await self._sending.acquire()
+            task = asyncio.get_running_loop().create_task(self._send(message))
+            self._in_flight[message['chat_id']] = task
+
+    async def _send(self, message):
+        try:
+            await self._deliver(message)
+        finally:
+            del self._in_flight[message['chat_id']]
+            self._sending.release()
+            self._wakeup.set()
+
+    async def _deliver(self, message):
+        message['attempts'] += 1
+        started = time.perf_counter()
+        try:
+            if message['send'] is not None:
+                result = await message['send'](message['text'], **message['kwargs'])
+            else:
+                result = await self.bot.send_message(chat_id=message['chat_id'], text=message['text'])
+        except RetryAfter as e:
+            metrics.inc('telegram_retry_after_total')
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            self._back_off(message['chat_id'], delay)
+            if message['attempts'] <= SEND_MAX_RETRIES:
+                self.retries += 1
+                self._requeue(message)
+                return
+            self._fail(message, e)
+            return
+        except Exception as e:
+            self._fail(message, e)
+            return
+
+        self.sent += 1
+        metrics.observe('telegram_send_seconds', time.perf_counter() - started)
+        self.latencies.append(time.monotonic() - message['queued_at'])
+        if message['future'] is not None and not message['future'].done():
+            message['future'].set_result(result)
+
+    def _back_off(self, chat_id, delay):
+        """Pause the chat that got a 429, or every chat when several got one at once"""
+        now = time.monotonic()
+        self._chat_paused[chat_id] = now + delay
+        self._floods.append((now, chat_id))
+        while self._floods[0][0] < now - 1:
+            self._floods.popleft()
+        if len({chat for _, chat in self._floods}) >= SEND_FLOOD_CHATS:
+            self._paused_until = max(self._paused_until, now + delay)
+
+    def _requeue(self, message):
+        if message['future'] is not None:
+            self._interactive.appendleft(message)
+        else:
+            self._bulk.setdefault(message['chat_id'], []).insert(0, message)
+            self._bulk.move_to_end(message['chat_id'], last=False)
+
+    def _fail(self, message, error):
+        self.failed += 1
+        if message['future'] is not None:
+            if not message['future'].done():
+                message['future'].set_exception(error)
+        else:
+            print(f"[ERROR] Failed to send message to {message['chat_id']}: {error}")
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'interactive_depth': len(self._interactive),
+            'bulk_depth': sum(len(p) for p in self._bulk.values()),
+            'in_flight': len(self._in_flight),
+            'paused_chats': len(self._chat_paused),
+            'sent': self.sent,
+            'merged': self.merged,
+            'retries': self.retries,
+            'failed': self.failed,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0,
+        }
+
+outbox = Outbox()
+
+@timed('reply')
+async def reply(update: Update, text, **kwargs):
+    """Reply to the user's message through the outbox"""
+    return await outbox.send(update.message.chat_id, update.message.reply_text, text, **kwargs)
+
+class AlertEngine:
+    """Price alerts kept in per-ticker sorted threshold lists
+
+    A price tick bisects each list, so only the alerts that actually crossed
+    are touched. Alerts fire once, are removed and sent as bulk notifications.
+    """
+
+    KINDS = ('above', 'below', 'move')
+
+    def __init__(self):
+        self.alerts = {}  # {alert_id: alert}
+        self._by_user = {}  # {user_id: {alert_id}}
+        self._books = {}  # {ticker: {kind: [(threshold, alert_id)] sorted}}
+        self.triggered = 0
+
+    def add(self, alert):
+        self.alerts[alert['id']] = alert
+        self._by_user.setdefault(alert['user_id'], set()).add(alert['id'])
+        book = self._books.setdefault(alert['ticker'], {kind: [] for kind in self.KINDS})
+        bisect.insort(book[alert['kind']], (alert['threshold'], alert['id']))
+
+    def remove(self, alert_id):
+        alert = self.alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+
+        user_alerts = self._by_user[alert['user_id']]
+        user_alerts.discard(alert_id)
+        if not user_alerts:
+            del self._by_user[alert['user_id']]
+
+        book = self._books[alert['ticker']]
+        entries = book[alert['kind']]
+        i = bisect.bisect_left(entries, (alert['threshold'], alert_id))
+        if i < len(entries) and entries[i][1] == alert_id:
+            del entries[i]
+        if not any(book.values()):
+            del self._books[alert['ticker']]
+        return alert
+
+    def user_alerts(self, user_id):
+        return sorted(
+            (self.alerts[a] for a in self._by_user.get(user_id, ())),
+            key=lambda a: (a['ticker'], a['kind'], a['threshold'])
+        )
 
-user_selected_stocks = {}
-user_groups = {}  # {user_id: [{'name': 'Group 1', 'stocks': [ticker1, ticker2], 'prices': {}, 'active': True}]}
+    def tickers(self):
+        return set(self._books)
 
+    def on_prices(self, prices):
+        """Fire every alert crossed by the new prices"""
+        for ticker, price_data in prices.items():
+            book = self._books.get(ticker)
+            if book is None:
+                continue
+
+            price = price_data['price']
+            # yahooquery reports the day change as a fraction
+            move = abs(price_data.get('change_percent') or 0) * 100
+
+            # Sorted ascending, so crossed alerts are a prefix or suffix of each list
+            above = book['above']
+            crossed = above[:bisect.bisect_right(above, (price, '\uffff'))]
+            below = book['below']
+            crossed += below[bisect.bisect_left(below, (price, '')):]
+            moves = book['move']
+            crossed += moves[:bisect.bisect_right(moves, (move, '\uffff'))]
+
+            for _, alert_id in crossed:
+                alert = self.remove(alert_id)
+                storage.remove_alert(alert_id)
+                self.triggered += 1
+                outbox.notify(alert['user_id'], describe_alert(alert, price_data))
+
+    def stats(self):
+        return {
+            'alerts': len(self.alerts),
+            'tickers': len(self._books),
+            'triggered': self.triggered,
+        }
+
+def describe_alert(alert, price_data=None):
+    if alert['kind'] == 'move':
+        condition = f"moves ±{alert['threshold']:g}% on the day"
+    else:
+        condition = f"{alert['kind']} {alert['threshold']:g}"
+
+    if price_data is None:
+        return f"{alert['ticker']} {condition}"
+
+    return (
+        f"🔔 {alert['ticker']} {condition}\n"
+        f"Now {price_data['currency']} {price_data['price']:.2f} ({(price_data.get('change_percent') or 0) * 100:+.2f}%)"
+    )
+
+alert_engine = AlertEngine()
+
+class Position:
+    """Quantity and cost per share of one ticker in a group, with its last valuation"""
+
+    __slots__ = ('group_id', 'ticker', 'quantity', 'cost', 'currency', 'value', 'day_change')
+
+    def __init__(self, group_id, ticker, quantity, cost):
+        self.group_id = group_id
+        self.ticker = sys.intern(ticker)
+        self.quantity = quantity
+        self.cost = cost
+        self.currency = None
+        self.value = None  # None until the ticker has a price
+        self.day_change = 0.0
+
+class GroupTotals:
+    """Running totals over a group's priced positions"""
+
+    __slots__ = ('user_id', 'positions', 'cost', 'value', 'day_change', 'unpriced')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.positions = {}  # {ticker: Position}
+        self.cost = 0.0
+        self.value = 0.0
+        self.day_change = 0.0
+        self.unpriced = 0
+
+class Portfolios:
+    """Group holdings valued against the latest prices
+
+    Positions are indexed by ticker, so a price tick revalues only the
+    positions holding it and moves their group's totals by the difference.
+    /pnl reads the totals as they stand and never goes upstream.
+    """
+
+    def __init__(self):
+        self._groups = {}  # {group_id: GroupTotals}
+        self._by_ticker = {}  # {ticker: {group_id: Position}}
+        self.revaluations = 0
+
+    def set(self, holding):
+        """Add or replace the position in holding['ticker'] for the group"""
+        self.remove(holding['group_id'], holding['ticker'])
+        totals = self._groups.get(holding['group_id'])
+        if totals is None:
+            totals = self._groups[holding['group_id']] = GroupTotals(holding['user_id'])
+
+        position = Position(holding['group_id'], holding['ticker'], holding['quantity'], holding['cost'])
+        totals.positions[position.ticker] = position
+        totals.unpriced += 1
+        self._by_ticker.setdefault(position.ticker, {})[position.group_id] = position
+
+        price_data = latest_prices.get(position.ticker)
+        if price_data is not None:
+            self._revalue(totals, position, price_data)
+        return position
+
+    def remove(self, group_id, ticker):
+        totals = self._groups.get(group_id)
+        position = totals.positions.pop(ticker, None) if totals else None
+        if position is None:
+            return None
+
+        if position.value is None:
+            totals.unpriced -= 1
+        else:
+            totals.cost -= position.quantity * position.cost
+            totals.value -= position.value
+            totals.day_change -= position.day_change
+        if not totals.positions:
+            del self._groups[group_id]
+
+        holders = self._by_ticker[ticker]
+        del holders[group_id]
+        if not holders:
+            del self._by_ticker[ticker]
+        return position
+
+    def _revalue(self, totals, position, price_data):
+        value = position.quantity * price_data['price']
+        day_change = position.quantity * (price_data.get('change') or 0)
+        if position.value is None:
+            totals.unpriced -= 1
+            totals.cost += position.quantity * position.cost
+            totals.value += value
+            totals.day_change += day_change
+        else:
+            totals.value += value - position.value
+            totals.day_change += day_change - position.day_change
+        position.value = value
+        position.day_change = day_change
+        position.currency = price_data.get('currency', 'USD')
+
+    def on_prices(self, prices):
+        """Revalue the positions holding each ticker that has a new price"""
+        for ticker, price_data in prices.items():
+            holders = self._by_ticker.get(ticker)
+            if not holders:
+                continue
+            for group_id, position in holders.items():
+                self._revalue(self._groups[group_id], position, price_data)
+            self.revaluations += len(holders)
+
+    def group(self, group_id):
+        """The group's GroupTotals, or None if it holds nothing"""
+        return self._groups.get(group_id)
+
+    def stats(self):
+        return {
+            'groups': len(self._groups),
+            'positions': sum(len(totals.positions) for totals in self._groups.values()),
+            'tickers': len(self._by_ticker),
+            'revaluations': self.revaluations,
+        }
+
+portfolios = Portfolios()
+
+class TickRing:
+    """One session of sampled prices for a ticker in fixed-size arrays, the oldest sample overwritten first"""
+
+    __slots__ = ('times', 'prices', 'start', 'count', 'session', 'version')
+
+    def __init__(self, size=TICK_RING_SIZE):
+        self.times = array('I', [0]) * size  # epoch seconds
+        self.prices = array('d', [0.0]) * size
+        self.start = 0  # slot of the oldest sample
+        self.count = 0
+        self.session = None  # market date the samples belong to
+        self.version = 0  # bumped on every change, for render caches
+
+    def append(self, ts, price, session):
+        size = len(self.prices)
+        if session != self.session:
+            # A new session starts an empty ring
+            self.session = session
+            self.start = 0
+            self.count = 0
+        elif self.count:
+            last = (self.start + self.count - 1) % size
+            if ts - self.times[last] < TICK_SAMPLE_INTERVAL:
+                self.prices[last] = price
+                self.version += 1
+                return
+
+        slot = (self.start + self.count) % size
+        if self.count == size:
+            self.start = (self.start + 1) % size
+        else:
+            self.count += 1
+        self.times[slot] = int(ts)
+        self.prices[slot] = price
+        self.version += 1
+
+    def values(self):
+        """Prices oldest first"""
+        end = self.start + self.count
+        size = len(self.prices)
+        if end <= size:
+            return self.prices[self.start:end]
+        return self.prices[self.start:] + self.prices[:end - size]
+
+class TickStore:
+    """Intraday tick rings for tickers held by active groups, shared by every user"""
+
+    def __init__(self, size=TICK_RING_SIZE, max_tickers=TICK_RING_MAX_TICKERS):
+        self.size = size
+        self.max_tickers = max_tickers
+        self._rings = OrderedDict()  # {ticker: TickRing}, least recently sampled first
+
+    def record(self, prices, now=None):
+        """Sample the new prices of group tickers while the market is in session"""
+        now = now or time.time()
+        market_now = datetime.fromtimestamp(now, MARKET_TZ)
+        if not is_market_open(market_now):
+            return
+        session = market_now.date().toordinal()
+
+        for ticker, price_data in prices.items():
+            if not storage.index.group_holders(ticker):
+                continue
+            ring = self._rings.get(ticker)
+            if ring is None:
+                if len(self._rings) >= self.max_tickers:
+                    self._rings.popitem(last=False)
+                ring = self._rings[ticker] = TickRing(self.size)
+            else:
+                self._rings.move_to_end(ticker)
+            ring.append(now, price_data['price'], session)
+
+    def get(self, ticker):
+        return self._rings.get(ticker)
+
+    def version(self, ticker):
+        ring = self._rings.get(ticker)
+        return ring.version if ring is not None else 0
+
+    def stats(self):
+        sample_bytes = array('I').itemsize + array('d').itemsize
+        return {'tickers': len(self._rings), 'bytes': len(self._rings) * self.size * sample_bytes}
+
+tick_store = TickStore()
+
+def next_digest_time(digest, now):
+    """Timestamp of the digest's next delivery after now"""
+    if digest['kind'] == 'close':
+        tz, minute = MARKET_TZ, DIGEST_CLOSE_MINUTE
+    else:
+        tz, minute = ZoneInfo(digest['timezone']), digest['minute']
+
+    day = datetime.fromtimestamp(now, tz).date()
+    while True:
+        at = datetime(day.year, day.month, day.day, minute // 60, minute % 60, tzinfo=tz).timestamp()
+        if at > now and (digest['kind'] != 'close' or day.weekday() < 5):
+            return at
+        day += timedelta(days=1)
+
+class DigestScheduler:
+    """Digest subscriptions bucketed by the minute they are next due
+
+    Each tick only pops the slots that have come due, so the cost follows the
+    number of digests being sent rather than the number of subscribers.
+    """
+
+    def __init__(self):
+        self.digests = {}  # {user_id: digest}
+        self._slots = {}  # {epoch minute: {user_id}}
+        self._slot_of = {}  # {user_id: epoch minute}
+        self._heap = []  # epoch minutes with a due list, may hold stale entries
+        self.sent = 0
+
+    def add(self, digest, now=None):
+        self.remove(digest['user_id'])
+        self.digests[digest['user_id']] = digest
+        self._schedule(digest['user_id'], next_digest_time(digest, now or time.time()))
+
+    def _schedule(self, user_id, at):
+        slot = int(at // 60)
+        users = self._slots.get(slot)
+        if users is None:
+            users = self._slots[slot] = set()
+            heapq.heappush(self._heap, slot)
+        users.add(user_id)
+        self._slot_of[user_id] = slot
+
+    def remove(self, user_id):
+        digest = self.digests.pop(user_id, None)
+        slot = self._slot_of.pop(user_id, None)
+        if slot is not None:
+            users = self._slots[slot]
+            users.discard(user_id)
+            if not users:
+                del self._slots[slot]
+        return digest
+
+    def pop_due(self, now=None):
+        """User IDs whose digest is due, each rescheduled for its next delivery"""
+        now = now or time.time()
+        current = int(now // 60)
+        due = []
+        while self._heap and self._heap[0] <= current:
+            users = self._slots.pop(heapq.heappop(self._heap), None)
+            if users:
+                due.extend(users)
+
+        for user_id in due:
+            self._schedule(user_id, next_digest_time(self.digests[user_id], now))
+        return due
+
+    def stats(self):
+        return {'subscribers': len(self.digests), 'slots': len(self._slots), 'sent': self.sent}
+
+digest_scheduler = DigestScheduler()
+
+WARM_STATE_VERSION = 2  # 1 was a pickle
+
+def warm_state_path():
+    # Worker processes each cache their own shard of users
+    return f"{WARM_STATE_FILE}.{worker_index}" if worker_index else WARM_STATE_FILE
+
+def load_warm_state(path=None):
+    """Restore the symbol table, search cache and quotes saved by the previous run
+
+    Quotes keep their original fetch time, so stale ones still serve /groups
+    and fallbacks but are refreshed from Yahoo like any other stale entry.
+    """
+    path = path or warm_state_path()
+    if not os.path.exists(path):
+        return
+    try:
+        # marshal only reads plain values back, unlike pickle it can't be made to run code
+        with open(path, 'rb') as f:
+            try:
+                state = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                state = None
+        if not isinstance(state, dict) or state.get('version') != WARM_STATE_VERSION:
+            print(f"Ignoring warm state in '{path}' from another version")
+            return
+        
+        for ticker, name, exchange in state['symbols']:
+            symbol_index.add(intern_symbol(ticker, name, exchange))
+        now = time.time()
+        for key, stored_at, tickers in state['searches']:
+            if now - stored_at <= SEARCH_CACHE_TTL:
+                search_cache.set(key, [symbols[t] for t in tickers if t in symbols], stored_at)
+        for ticker, stored_at, price, currency, change, change_percent in state['quotes']:
+            price_data = {'price': price, 'currency': currency, 'change': change, 'change_percent': change_percent}
+            quote_cache.set(ticker, price_data, stored_at)
+            latest_prices[ticker] = price_data
+        print(f"Restored {len(state['symbols'])} symbols, {len(state['searches'])} searches and {len(state['quotes'])} quotes")
+    except Exception as e:
+        print(f"[ERROR] Failed to load warm state from '{path}': {e}")
+
+def save_warm_state(path=None):
+    """Write the symbol table, search cache and quote cache to disk as flat marshalled tuples"""
+    path = path or warm_state_path()
+    state = {
+        'version': WARM_STATE_VERSION,
+        'symbols': [(s.ticker, s.name, s.exchange) for s in symbols.values()],
+        'searches': [(key, stored_at, tuple(s.ticker for s in matches)) for key, stored_at, matches in search_cache.items()],
+        'quotes': [
+            # marshal only takes built-in types, quotes from yahooquery may hold numpy floats
+            (ticker, stored_at, float(q['price']), q['currency'], float(q['change'] or 0), float(q['change_percent'] or 0))
+            for ticker, stored_at, q in quote_cache.items()
+        ],
+    }
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(state, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"[ERROR] Failed to save warm state to '{path}': {e}")
+
+def preload_modules():
+    """Import the data stack off the event loop so the first upstream call doesn't pay for it"""
+    timings = []
+    for name in PRELOAD_MODULES:
+        started = time.perf_counter()
+        try:
+            lazy_modules[name]._import()
+        except Exception as e:
+            print(f"[ERROR] Failed to preload {name}: {e}")
+            continue
+        timings.append(f"{name} {(time.perf_counter() - started) * 1000:.0f}ms")
+    if timings:
+        print(f"Preloaded {', '.join(timings)}")
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling Yahoo while the circuit breaker is open"""
+
+class QuotaExceeded(UpstreamUnavailable):
+    """Raised instead of calling Yahoo when the caller's quota or the global budget is spent"""
+
+QUOTA_EXCEEDED_MESSAGE = "⏳ Too many lookups right now. Please wait a few seconds and try again."
+
+upstream_user = contextvars.ContextVar('upstream_user', default=None)  # user an upstream call is made for, None for background work
+upstream_patient = contextvars.ContextVar('upstream_patient', default=False)  # already paid for and willing to queue longer, e.g. /import
+
+class UpstreamQuota:
+    """Admission control for Yahoo calls: a token bucket per user and a global budget
+
+    A user with an empty bucket is refused at once. Calls that find the global
+    budget spent wait in a weighted fair queue. Each call's finish tag is the
+    later of the virtual clock and its lane's previous tag, plus 1/weight, and
+    calls go through in tag order as tokens come in, so one busy user can't
+    starve the others. Background work shares one heavier lane. Refused
+    calls raise QuotaExceeded, and callers answer from cache instead.
+    Patient calls, like an import's lookups, are paid for up front by their
+    caller instead of one token each, and wait UPSTREAM_PATIENT_TIMEOUT in
+    the queue.
+    """
+
+    def __init__(self, rate=UPSTREAM_BUDGET_RATE, burst=UPSTREAM_BUDGET_BURST):
+        self.budget = TokenBucket(rate, burst)
+        self._users = {}  # {user_id: TokenBucket}
+        self._finish = {}  # {user_id or None: finish tag of the lane's last queued call}
+        self._queue = []  # heap of (finish tag, sequence, future)
+        self._sequence = 0
+        self._virtual = 0.0  # finish tag of the call most recently let through
+        self._dispatcher = None
+        self.admitted = Counter()  # {user_id or None: upstream calls made}
+        self.refused = Counter()  # {user_id or None: calls answered from cache instead}
+
+    def _user_bucket(self, user_id):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            if len(self._users) > 10000:
+                # Drop buckets of idle users, a new one starts full anyway
+                now = time.monotonic()
+                for idle_user, idle_bucket in list(self._users.items()):
+                    idle_bucket.wait_time(now)
+                    if idle_bucket.tokens >= idle_bucket.capacity:
+                        del self._users[idle_user]
+                        self._finish.pop(idle_user, None)
+            bucket = self._users[user_id] = TokenBucket(USER_UPSTREAM_RATE, USER_UPSTREAM_BURST)
+        return bucket
+
+    def charge(self, user_id):
+        """Take one of the user's tokens, False if they have none left"""
+        if user_id is None:
+            return True
+        bucket = self._user_bucket(user_id)
+        if bucket.wait_time():
+            self.refused[user_id] += 1
+            metrics.inc('upstream_quota_refused_total', (('reason', 'user'),))
+            return False
+        bucket.take()
+        return True
+
+    def share(self, fraction):
+        """Keep a fraction of the bot-wide budget, for one of several processes calling Yahoo"""
+        self.budget = TokenBucket(UPSTREAM_BUDGET_RATE * fraction, max(1, UPSTREAM_BUDGET_BURST * fraction))
+
+    async def acquire(self, user_id=None, patient=False):
+        """Charge the user and wait for a budget token in fair order, or raise QuotaExceeded"""
+        if not patient and not self.charge(user_id):
+            raise QuotaExceeded("Too many lookups, please wait a moment")
+
+        if not self._queue and not self.budget.wait_time():
+            self.budget.take()
+            self.admitted[user_id] += 1
+            return
+
+        weight = UPSTREAM_SYSTEM_WEIGHT if user_id is None else 1
+        finish = max(self._virtual, self._finish.get(user_id, 0.0)) + 1 / weight
+        self._finish[user_id] = finish
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._queue, (finish, self._sequence, future))
+        self._sequence += 1
+        if self._dispatcher is None:
+            self._dispatcher = loop.create_task(self._dispatch())
+
+        try:
+            await asyncio.wait_for(future, UPSTREAM_PATIENT_TIMEOUT if patient else UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.refused[user_id] += 1
+            metrics.inc('upstream_quota_refused_total', (('reason', 'budget'),))
+            raise QuotaExceeded("The upstream budget is spent, please try again shortly") from None
+        self.admitted[user_id] += 1
+
+    async def _dispatch(self):
+        try:
+            while self._queue:
+                wait = self.budget.wait_time()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                finish, _, future = heapq.heappop(self._queue)
+                if future.done():
+                    continue  # the caller stopped waiting
+                self._virtual = finish
+                self.budget.take()
+                future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    def user_tokens(self, user_id):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            return USER_UPSTREAM_BURST
+        bucket.wait_time()
+        return bucket.tokens
+
+    def stats(self):
+        self.budget.wait_time()
+        return {
+            'budget_tokens': self.budget.tokens,
+            'queued': sum(not future.done() for _, _, future in self._queue),
+            'admitted': sum(self.admitted.values()),
+            'refused': sum(self.refused.values()),
+        }
+
+class CircuitBreaker:
+    """Stops calling upstream after repeated failures and lets a trial call through later"""
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'half-open':
+            # Let this trial call through and hold the others back until it resolves
+            self.opened_at = time.monotonic()
+            return True
+        return state == 'closed'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+upstream_limit = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+upstream_breaker = CircuitBreaker()
+upstream_quota = UpstreamQuota()
+
+async def guarded_upstream(make_call):
+    """Await make_call() under the upstream quota, concurrency limit, timeout and circuit breaker"""
+    # No point queueing for the budget while the breaker is open, and a half-open
+    # breaker's trial call shouldn't be spent on a call the quota then refuses
+    if upstream_breaker.state != 'open':
+        await upstream_quota.acquire(upstream_user.get(), upstream_patient.get())
+    if not upstream_breaker.allow():
+        metrics.inc('upstream_rejected_total')
+        raise UpstreamUnavailable("Yahoo Finance is temporarily unavailable")
+
+    waited_at = time.perf_counter()
+    async with upstream_limit:
+        started = time.perf_counter()
+        metrics.observe('upstream_wait_seconds', started - waited_at)
+        try:
+            result = await asyncio.wait_for(make_call(), UPSTREAM_TIMEOUT)
+        except Exception:
+            metrics.inc('upstream_errors_total')
+            upstream_breaker.record_failure()
+            raise
+        finally:
+            metrics.observe('upstream_seconds', time.perf_counter() - started)
+
+    upstream_breaker.record_success()
+    return result
+
+async def call_upstream(func):
+    """Run a blocking Yahoo call on the dedicated upstream executor"""
+    loop = asyncio.get_running_loop()
+
+    def run(submitted_at):
+        return time.perf_counter() - submitted_at, func()
+
+    waited, result = await guarded_upstream(lambda: loop.run_in_executor(upstream_executor, run, time.perf_counter()))
+    metrics.observe('executor_wait_seconds', waited)
+    return result
+
+class YahooHTTP:
+    """Async Yahoo Finance client over one pooled keep-alive aiohttp session"""
+
+    COOKIE_URL = 'https://fc.yahoo.com'
+    CRUMB_URL = 'https://query1.finance.yahoo.com/v1/test/getcrumb'
+    SEARCH_URL = 'https://query2.finance.yahoo.com/v1/finance/search'
+    QUOTE_URL = 'https://query2.finance.yahoo.com/v7/finance/quote'
+
+    def __init__(self):
+        self._session = None
+        self._crumb = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=UPSTREAM_CONCURRENCY, keepalive_timeout=60),
+                headers={'User-Agent': 'Mozilla/5.0'}
+            )
+            self._crumb = None
+        return self._session
+
+    async def _get_crumb(self, session):
+        # The quote endpoint wants a crumb tied to the session's consent cookie
+        if self._crumb is None:
+            async with session.get(self.COOKIE_URL, allow_redirects=True):
+                pass
+            async with session.get(self.CRUMB_URL) as response:
+                response.raise_for_status()
+                self._crumb = await response.text()
+        return self._crumb
+
+    async def search(self, query):
+        """Same response shape as yahooquery.search"""
+        session = await self._get_session()
+        async with session.get(self.SEARCH_URL, params={'q': query}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def price(self, tickers):
+        """Same response shape as yahooquery's Ticker(tickers).price"""
+        session = await self._get_session()
+        params = {'symbols': ','.join(tickers), 'crumb': await self._get_crumb(session)}
+        async with session.get(self.QUOTE_URL, params=params) as response:
+            if response.status == 401:
+                self._crumb = None
+            response.raise_for_status()
+            data = await response.json()
+
+        result = {}
+        for quote in data.get('quoteResponse', {}).get('result', []):
+            result[quote['symbol']] = {
+                'regularMarketPrice': quote.get('regularMarketPrice'),
+                'currency': quote.get('currency') or 'USD',
+                # Halted and pre-open tickers come back with nulls
+                'regularMarketChange': quote.get('regularMarketChange') or 0,
+                # The quote endpoint reports percent, yahooquery a fraction
+                'regularMarketChangePercent': (quote.get('regularMarketChangePercent') or 0) / 100
+            }
+        return result
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+yahoo_http = YahooHTTP() if USE_ASYNC_HTTP and aiohttp else None
+
+# Returned with matches from the local symbol index, which are guesses the user has to confirm
+LOCAL_MATCHES_MESSAGE = "⚠️ Search is unavailable right now. These stocks I already know may match, please select one:"
+
+@timed('search')
 async def search_companies(query, max_results=10):
     q = query.strip()
     
@@ -17,9 +1928,21 @@ async def search_companies(query, max_results=10):
     if len(q) < 2:
         return [], "Query too short. Please enter at least 2 characters"
     
+    # A known ticker or full company name needs no search, Yahoo is asked on a miss
+    known = symbol_index.known(q)
+    if known:
+        return [known], None
+    
+    key = normalize_query(q)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached[:max_results], None
+    
     try:
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, search, q)
+        if yahoo_http:
+            result = await guarded_upstream(lambda: yahoo_http.search(q))
+        else:
+            result = await call_upstream(lambda: yahooquery.search(q))
         
         quotes = result.get("quotes", [])
         
@@ -33,46 +1956,610 @@ async def search_companies(query, max_results=10):
             exchange = item.get("exchDisp", "")
             
             if symbol and name:
-                matches.append({
-                    "name": name, 
-                    "ticker": symbol,
-                    "exchange": exchange
-                })
+                matches.append(intern_symbol(symbol, name, exchange))
+        
+        for company in matches:
+            symbol_index.add(company)
+        if matches:
+            search_cache.set(key, matches)
         
         return matches, None
         
     except Exception as e:
+        if not isinstance(e, QuotaExceeded):
+            print(f"[ERROR] Search failed for '{q}': {type(e).__name__} - {e}")
+        
+        # Serve whatever we knew before rather than failing outright
+        stale = search_cache.get_stale(key)
+        if stale:
+            return stale[:max_results], None
+        
+        # A ticker or name prefix we've seen isn't necessarily what Yahoo would answer
+        local_matches = symbol_index.lookup(key, max_results) if len(key) >= SEARCH_INDEX_MIN_QUERY else []
+        known = symbol_index.exact(key)
+        if known and known not in local_matches:
+            local_matches = [known] + local_matches[:max_results - 1]
+        if local_matches:
+            return local_matches, LOCAL_MATCHES_MESSAGE
+        
+        if isinstance(e, QuotaExceeded):
+            return [], QUOTA_EXCEEDED_MESSAGE
         error_msg = f"Sorry, search failed. Please try again later."
-        print(f"[ERROR] Search failed for '{q}': {type(e).__name__} - {e}")
         return [], error_msg
 
-async def get_stock_prices(tickers):
-    """Fetch current prices for multiple tickers"""
+async def fetch_quotes(tickers):
+    """Fetch prices for the given tickers in a single Ticker call"""
+    if yahoo_http:
+        result = await guarded_upstream(lambda: yahoo_http.price(tickers))
+    else:
+        result = await call_upstream(lambda: yahooquery.Ticker(tickers).price)
+    
+    prices = {}
+    for ticker in tickers:
+        if ticker in result and isinstance(result[ticker], dict):
+            price_data = result[ticker]
+            current_price = price_data.get('regularMarketPrice')
+            if current_price:
+                prices[ticker] = {
+                    'price': current_price,
+                    'currency': price_data.get('currency') or 'USD',
+                    'change': price_data.get('regularMarketChange') or 0,
+                    'change_percent': price_data.get('regularMarketChangePercent') or 0
+                }
+    return prices
+
+class QuoteClient:
+    """Fetches quotes through the front process's quote service, so shards share one cache"""
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self._replies = {}  # {request id: future}
+        self._next_id = 0
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                asyncio.get_running_loop().create_task(self._read_replies(reader))
+
+    async def _read_replies(self, reader):
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = self._replies.pop(reply['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(reply['prices'])
+        finally:
+            # Fail whatever is still waiting, the next fetch reconnects
+            for future in self._replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("quote service went away"))
+            self._replies.clear()
+
+    async def fetch(self, tickers):
+        await self._connect()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        self._writer.write(json.dumps({'id': request_id, 'tickers': tickers}).encode() + b'\n')
+        try:
+            return await asyncio.wait_for(future, UPSTREAM_TIMEOUT * 2)
+        finally:
+            self._replies.pop(request_id, None)
+
+quote_client = None  # set in worker processes, which leave Yahoo quotes to the front process
+
+async def fetch_prices_upstream(tickers):
+    """Fetch prices for the given tickers, from Yahoo or the shared quote service, and cache them"""
+    if quote_client is not None:
+        prices = await quote_client.fetch(tickers)
+    else:
+        prices = await fetch_quotes(tickers)
+    
+    for ticker, price_data in prices.items():
+        quote_cache.set(ticker, price_data)
+        if latest_prices.get(ticker) != price_data:
+            price_versions[ticker] = price_versions.get(ticker, 0) + 1
+    latest_prices.update(prices)
+    tick_store.record(prices)
+    alert_engine.on_prices(prices)
+    portfolios.on_prices(prices)
+    return prices
+
+class PriceCoalescer:
+    """Gathers tickers from concurrent callers and fetches them in one batched upstream call"""
+
+    def __init__(self, fetch, window=PRICE_BATCH_WINDOW):
+        self.fetch = fetch
+        self.window = window
+        self._pending = {}  # {ticker: future} waiting for the next batch
+        self._in_flight = {}  # {ticker: future} for the batch currently being fetched
+        self._flush_task = None
+        self.requests = 0
+        self.batches = 0
+
+    async def get(self, tickers):
+        """Return {ticker: price_data} for the tickers that could be priced"""
+        loop = asyncio.get_running_loop()
+        self.requests += 1
+
+        futures = {}
+        for ticker in tickers:
+            future = self._in_flight.get(ticker) or self._pending.get(ticker)
+            if future is None:
+                future = loop.create_future()
+                self._pending[ticker] = future
+            futures[ticker] = future
+
+        if self._pending and self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_after_window())
+
+        # Shield the shared futures so one cancelled caller doesn't cancel the others
+        results = await asyncio.gather(*(asyncio.shield(f) for f in futures.values()))
+        return {ticker: data for ticker, data in zip(futures, results) if data is not None}
+
+    async def _flush_after_window(self):
+        # The batch serves every caller in it, so it's background work rather than the first caller's
+        upstream_user.set(None)
+        await asyncio.sleep(self.window)
+        batch = self._pending
+        self._pending = {}
+        self._flush_task = None
+        self._in_flight.update(batch)
+        self.batches += 1
+
+        try:
+            prices = await self.fetch(list(batch))
+        except QuotaExceeded:
+            prices = {}  # callers fall back to the last known quotes
+        except Exception as e:
+            print(f"[ERROR] Failed to fetch prices: {e}")
+            prices = {}
+        finally:
+            for ticker in batch:
+                self._in_flight.pop(ticker, None)
+
+        for ticker, future in batch.items():
+            if not future.done():
+                future.set_result(prices.get(ticker))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'pending': len(self._pending),
+        }
+
+price_coalescer = PriceCoalescer(fetch_prices_upstream)
+
+@timed('get_stock_prices')
+async def get_stock_prices(tickers, max_age=None):
+    """Fetch current prices for multiple tickers, only going upstream for missing or stale ones"""
+    found = {}
+    missing = []
+    for ticker in tickers:
+        cached = quote_cache.get(ticker, max_age)
+        if cached is not None:
+            found[ticker] = cached
+        elif ticker not in missing:
+            missing.append(ticker)
+
+    if missing:
+        # A user over their quota gets the last known quotes instead of a fetch
+        if upstream_quota.charge(upstream_user.get()):
+            found.update(await price_coalescer.get(missing))
+
+        # Serve the last known quote for anything upstream couldn't price
+        for ticker in missing:
+            if ticker not in found:
+                stale = quote_cache.get_stale(ticker)
+                if stale is not None:
+                    found[ticker] = stale
+
+    # Keep the caller's ticker order
+    return {ticker: found[ticker] for ticker in tickers if ticker in found}
+
+def is_market_open(now=None):
+    """Whether the US market is in its regular session"""
+    now = now or datetime.now(MARKET_TZ)
+    if now.weekday() >= 5:
+        return False
+    minutes = now.hour * 60 + now.minute
+    return 9 * 60 + 30 <= minutes < 16 * 60
+
+async def refresh_group_prices(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback that refreshes the shared price table for active groups and alerts"""
+    now = time.time()
+    interval = REFRESH_INTERVAL_OPEN if is_market_open() else REFRESH_INTERVAL_CLOSED
+    tickers = storage.active_group_tickers() | alert_engine.tickers()
+
+    # Forget tickers that are no longer held by any active group
+    for ticker in list(next_refresh_at):
+        if ticker not in tickers:
+            del next_refresh_at[ticker]
+
+    due = sorted(t for t in tickers if next_refresh_at.get(t, 0) <= now)
+    if not due:
+        return
+
+    for i in range(0, len(due), REFRESH_BATCH_SIZE):
+        batch = due[i:i + REFRESH_BATCH_SIZE]
+        # Quotes fetched by users within the interval are fresh enough to reuse
+        await get_stock_prices(batch, max_age=interval)
+        for ticker in batch:
+            next_refresh_at[ticker] = now + interval
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback that sends every digest that has come due"""
+    due = digest_scheduler.pop_due()
+    if not due:
+        return
+    await storage.preload(due)
+
+    # One set of batched quote fetches covers every digest in this round
+    tickers = set()
+    for user_id in due:
+        tickers.update(s.ticker for s in storage.get_stocks(user_id))
+        for group in storage.get_groups(user_id):
+            if group.active:
+                tickers.update(group.stocks)
+    tickers = sorted(tickers)
+    for i in range(0, len(tickers), REFRESH_BATCH_SIZE):
+        await get_stock_prices(tickers[i:i + REFRESH_BATCH_SIZE])
+
+    for i in range(0, len(due), DIGEST_RENDER_CHUNK):
+        for user_id in due[i:i + DIGEST_RENDER_CHUNK]:
+            for page in render_digest_pages(user_id):
+                outbox.notify(user_id, page)
+        # Let handlers run between chunks of a large round
+        await asyncio.sleep(0)
+
+    digest_scheduler.sent += len(due)
+
+class HistoryStore:
+    """Columnar OHLC bars per ticker, in memory-mappable .npy files per ticker and interval
+
+    Each file holds a (6, n) float64 array whose rows are timestamp, open,
+    high, low, close and volume, so every column is contiguous on disk.
+    Syncing only asks Yahoo for bars after the last stored one, and writes
+    them to a new segment file next to the first rather than rewriting it.
+    Every HISTORY_MAX_SEGMENTS appends the segments are merged back into one
+    file. Files are only touched on the store's I/O thread.
+    """
+
+    TS, OPEN, HIGH, LOW, CLOSE, VOLUME = range(6)
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._synced_at = {}  # {(ticker, interval): timestamp} of the last upstream sync
+        self._locks = {}  # {(ticker, interval): asyncio.Lock} so one sync per file runs at a time
+        self._segments = {}  # {(ticker, interval): segment files after the first}
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-io')
+
+    def _path(self, ticker, interval, segment=0):
+        safe = ''.join(c if c.isalnum() or c in '-_.^=' else '_' for c in ticker)
+        return os.path.join(self.directory, f"{safe}.{interval}{f'.{segment}' if segment else ''}.npy")
+
+    def _segment_count(self, ticker, interval):
+        count = self._segments.get((ticker, interval))
+        if count is None:
+            count = 0
+            while os.path.exists(self._path(ticker, interval, count + 1)):
+                count += 1
+            self._segments[(ticker, interval)] = count
+        return count
+
+    def load(self, ticker, interval='1d'):
+        """The stored (6, n) bar array, memory-mapped while it's in one file, or an empty one"""
+        arrays = []
+        for segment in range(self._segment_count(ticker, interval) + 1):
+            path = self._path(ticker, interval, segment)
+            if not os.path.exists(path):
+                break
+            bars = np.load(path, mmap_mode='r')
+            if arrays:
+                # Bars a merge cut short by a crash left behind are already in the first file
+                bars = bars[:, bars[self.TS] > arrays[-1][self.TS, -1]]
+            if bars.shape[1]:
+                arrays.append(bars)
+        if not arrays:
+            return np.empty((6, 0))
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays, axis=1)
+
+    def _save(self, path, bars):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(bars, dtype=np.float64))
+        os.replace(tmp_path, path)
+
+    def _append(self, ticker, interval, bars):
+        existing = self.load(ticker, interval)
+        os.makedirs(self.directory, exist_ok=True)
+        if not existing.shape[1]:
+            self._save(self._path(ticker, interval), bars)
+            return
+
+        bars = bars[:, bars[self.TS] > existing[self.TS, -1]]
+        if not bars.shape[1]:
+            return
+        segments = self._segment_count(ticker, interval)
+        if segments < HISTORY_MAX_SEGMENTS:
+            self._save(self._path(ticker, interval, segments + 1), bars)
+            self._segments[(ticker, interval)] = segments + 1
+            return
+
+        # Merge back into one file so loads stay a single memory map
+        self._save(self._path(ticker, interval), np.concatenate([existing, bars], axis=1))
+        for segment in range(segments, 0, -1):
+            os.remove(self._path(ticker, interval, segment))
+        self._segments[(ticker, interval)] = 0
+
+    async def _in_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    def _lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def sync(self, tickers, interval='1d'):
+        """Fetch the bars missing since each ticker's last stored bar"""
+        now = time.time()
+        # Locks aren't re-entrant, so take each once and always in the same order
+        due = sorted({t for t in tickers if now - self._synced_at.get((t, interval), 0) > HISTORY_SYNC_INTERVAL[interval]})
+        if not due:
+            return
+
+        locks = [self._lock((t, interval)) for t in due]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            # Tickers synced up to the same bar can share one upstream call
+            starts = await self._in_io(lambda: [self._fetch_start(t, interval) for t in due])
+            by_start = {}
+            for ticker, start in zip(due, starts):
+                by_start.setdefault(start, []).append(ticker)
+
+            for start, batch in by_start.items():
+                try:
+                    df = await call_upstream(lambda: yahooquery.Ticker(batch).history(interval=interval, start=start))
+                except QuotaExceeded:
+                    continue  # answer from the bars already stored
+                except Exception as e:
+                    print(f"[ERROR] Failed to fetch {interval} history for {', '.join(batch)}: {e}")
+                    continue
+
+                bars = history_to_bars(df, interval)
+                for ticker in batch:
+                    if ticker in bars:
+                        await self._in_io(self._append, ticker, interval, bars[ticker])
+                    self._synced_at[(ticker, interval)] = now
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _fetch_start(self, ticker, interval):
+        stored = self.load(ticker, interval)
+        if stored.shape[1]:
+            last = bar_time(stored[self.TS, -1], interval)
+            return (last.date() + timedelta(days=1 if interval == '1d' else 0)).isoformat()
+        days = HISTORY_YEARS * 365 if interval == '1d' else HISTORY_INTRADAY_DAYS
+        return (date.today() - timedelta(days=days)).isoformat()
+
+    async def aligned_closes(self, tickers, interval='1d', since=None):
+        """(timestamps, closes) on the bars every ticker has, closes shaped (len(tickers), n)"""
+        return await self._in_io(self._aligned_closes, tickers, interval, since)
+
+    def _aligned_closes(self, tickers, interval, since):
+        arrays = [self.load(t, interval) for t in tickers]
+        common = arrays[0][self.TS]
+        for bars in arrays[1:]:
+            common = np.intersect1d(common, bars[self.TS], assume_unique=True)
+        if since is not None:
+            common = common[common >= since]
+
+        closes = np.empty((len(tickers), len(common)))
+        for i, bars in enumerate(arrays):
+            closes[i] = bars[self.CLOSE, np.searchsorted(bars[self.TS], common)]
+        return common, closes
+
+def bar_time(ts, interval):
+    """Datetime of a bar; daily bars are stamped at UTC midnight of their trading date"""
+    return datetime.fromtimestamp(ts, timezone.utc if interval == '1d' else MARKET_TZ)
+
+def history_to_bars(df, interval):
+    """{ticker: (6, n) bar array} from a yahooquery history DataFrame"""
+    # yahooquery returns a dict of error messages when nothing was found
+    if not hasattr(df, 'reset_index') or df.empty:
+        return {}
+
+    df = df.reset_index()
+    if interval == '1d':
+        # A datetime instead of a date marks today's still-open session, which isn't final yet
+        df = df[[type(d) is date for d in df['date']]]
+
+    bars = {}
+    for symbol, rows in df.groupby('symbol'):
+        ts = [d.timestamp() if hasattr(d, 'timestamp') else calendar.timegm(d.timetuple()) for d in rows['date']]
+        bars[symbol] = np.vstack([
+            np.asarray(ts, dtype=np.float64),
+            rows['open'].to_numpy(dtype=np.float64),
+            rows['high'].to_numpy(dtype=np.float64),
+            rows['low'].to_numpy(dtype=np.float64),
+            rows['close'].to_numpy(dtype=np.float64),
+            rows['volume'].to_numpy(dtype=np.float64),
+        ])
+        # Drop bars Yahoo sends without a close
+        bars[symbol] = bars[symbol][:, ~np.isnan(bars[symbol][HistoryStore.CLOSE])]
+    return bars
+
+history_store = HistoryStore()
+
+def group_performance(closes):
+    """Vectorized return statistics for aligned closes shaped (tickers, bars)"""
+    returns = closes[:, 1:] / closes[:, :-1] - 1
+    # Equal weight, rebalanced every bar
+    index = np.concatenate([[1.0], np.cumprod(1 + returns.mean(axis=0))])
+    paths = closes / closes[:, :1]
+
+    def max_drawdown(values):
+        return (values / np.maximum.accumulate(values, axis=-1) - 1).min(axis=-1)
+
+    return {
+        'index': index,
+        'total_return': index[-1] - 1,
+        'max_drawdown': max_drawdown(index),
+        'stock_returns': paths[:, -1] - 1,
+        'stock_drawdowns': max_drawdown(paths),
+    }
+
+def group_risk(closes, benchmark_closes):
+    """Correlation, annualized volatility, beta and equal-weight variance from aligned daily closes"""
+    returns = closes[:, 1:] / closes[:, :-1] - 1
+    market = benchmark_closes[1:] / benchmark_closes[:-1] - 1
+
+    cov = np.cov(returns)
+    centered = returns - returns.mean(axis=1, keepdims=True)
+    market_centered = market - market.mean()
+    weights = np.full(len(closes), 1 / len(closes))
+    portfolio_variance = weights @ cov @ weights * TRADING_DAYS
+
+    return {
+        'correlation': np.corrcoef(returns),
+        'volatility': np.sqrt(np.diag(cov) * TRADING_DAYS),
+        'beta': centered @ market_centered / (market_centered @ market_centered),
+        'portfolio_variance': portfolio_variance,
+        'portfolio_volatility': np.sqrt(portfolio_variance),
+    }
+
+analysis_cache = TTLCache(float('inf'), ANALYSIS_CACHE_MAX_ENTRIES)  # keyed by inputs and last bar, never stale
+
+def simulate_batch(shm_name, shape, start, count, seed, chol, drift, vol):
+    """Simulate `count` correlated GBM paths and write their worst-of and basket performance
+
+    Runs in a worker process; the results go straight into the shared-memory
+    array of the given shape, (2, paths, months), at rows start:start+count.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
     try:
-        loop = asyncio.get_event_loop()
-        ticker_obj = Ticker(tickers)
-        result = await loop.run_in_executor(None, lambda: ticker_obj.price)
-        
-        prices = {}
-        for ticker in tickers:
-            if ticker in result and isinstance(result[ticker], dict):
-                price_data = result[ticker]
-                current_price = price_data.get('regularMarketPrice')
-                if current_price:
-                    prices[ticker] = {
-                        'price': current_price,
-                        'currency': price_data.get('currency', 'USD'),
-                        'change': price_data.get('regularMarketChange', 0),
-                        'change_percent': price_data.get('regularMarketChangePercent', 0)
-                    }
-        
-        return prices
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch prices: {e}")
-        return {}
+        out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        rng = np.random.default_rng(seed)
+        shocks = rng.standard_normal((count, shape[2], len(vol))) @ chol.T
+        performance = np.exp(np.cumsum(drift + vol * shocks, axis=1))
+        out[0, start:start + count] = performance.min(axis=2)
+        out[1, start:start + count] = performance.mean(axis=2)
+    finally:
+        shm.close()
+    return count
+
+def price_autocallable(worst, rate=RISK_FREE_RATE):
+    """Worst-of autocallable payoffs (fraction of notional, discounted) and call quarters (0 = not called)"""
+    months = worst.shape[1]
+    quarter_ends = np.arange(2, months, 3)
+    above = worst[:, quarter_ends] >= AUTOCALL_LEVEL
+    called = above.any(axis=1)
+    call_quarter = np.where(called, above.argmax(axis=1) + 1, 0)
+
+    knocked_in = worst.min(axis=1) < AUTOCALL_BARRIER
+    years = np.where(called, call_quarter / 4, months / 12)
+    redemption = np.where(
+        called,
+        1 + AUTOCALL_COUPON * call_quarter / 4,
+        np.where(knocked_in, worst[:, -1], 1.0)
+    )
+    return redemption * np.exp(-rate * years), call_quarter
+
+def price_protected(basket, rate=RISK_FREE_RATE):
+    """Capital-protected knock-out note payoffs (fraction of notional, discounted) and knock-out flags"""
+    knocked_out = basket.max(axis=1) >= PROTECTED_KNOCKOUT
+    upside = PROTECTED_PARTICIPATION * np.maximum(basket[:, -1] - 1, 0)
+    redemption = np.where(knocked_out, 1 + PROTECTED_REBATE, 1 + upside)
+    return redemption * np.exp(-rate * basket.shape[1] / 12), knocked_out
+
+simulation_pool = None
+simulation_lock = asyncio.Lock()  # one simulation at a time keeps the pool's cores for it
+
+def get_simulation_pool():
+    global simulation_pool
+    if simulation_pool is None:
+        # spawn: forking a process that runs an event loop and threads isn't safe
+        simulation_pool = ProcessPoolExecutor(SIMULATION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return simulation_pool
+
+async def run_simulation(vol, corr, paths, on_progress=None):
+    """Worst-of and basket performance paths, shaped (2, paths, months), from correlated GBM"""
+    months = SIMULATION_MONTHS
+    dt = 1 / 12
+    chol = np.linalg.cholesky(corr + np.eye(len(vol)) * 1e-10)
+    drift = (RISK_FREE_RATE - 0.5 * vol ** 2) * dt
+    step_vol = vol * np.sqrt(dt)
+
+    shape = (2, paths, months)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+    try:
+        loop = asyncio.get_running_loop()
+        pool = get_simulation_pool()
+        starts = range(0, paths, SIMULATION_BATCH)
+        seeds = np.random.SeedSequence(SIMULATION_SEED).spawn(len(starts))
+        tasks = [
+            loop.run_in_executor(
+                pool, simulate_batch, shm.name, shape, start, min(SIMULATION_BATCH, paths - start),
+                seed, chol, drift, step_vol
+            )
+            for start, seed in zip(starts, seeds)
+        ]
+
+        done = 0
+        for task in asyncio.as_completed(tasks):
+            done += await task
+            if on_progress:
+                await on_progress(done / paths)
+
+        return np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+class ConvState(Enum):
+    IDLE = 0
+    ADDING_STOCK = 1
+    CHOOSING_STOCK = 2
+    DELETING_STOCK = 3
+    NAMING_GROUP = 4
+    SELECTING_GROUP_STOCKS = 5
+    DISBANDING_GROUP = 6
+    ACTIVATING_GROUP = 7
+    IMPORTING = 8
+
+class Conversation:
+    """Where a user is in a multi-step command, kept only while a flow is in progress"""
+
+    __slots__ = ('state', 'options', 'target', 'group_name', 'group_stocks')
+
+    def __init__(self, state):
+        self.state = state
+        self.options = None  # search matches offered while choosing a stock
+        self.target = None  # stock or group awaiting a yes/no confirmation
+        self.group_name = None
+        self.group_stocks = None  # {ticker: Symbol} picked so far for a new group
+
+conversations = {}  # {user_id: Conversation}, idle users have no entry
+
+def start_conversation(user_id, state):
+    """Begin a flow, replacing whatever flow the user was in"""
+    conv = conversations[user_id] = Conversation(state)
+    return conv
+
+def end_conversation(user_id):
+    conversations.pop(user_id, None)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await reply(
+        update,
         "Welcome to Stock Tracker Bot! 📈\n\n"
         "Commands:\n"
         "/add - Add a new stock to track\n"
@@ -82,13 +2569,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/groups - View your groups\n"
         "/disband - Disband a group (keeps for future)\n"
         "/activate - Reactivate a disbanded group\n"
+        "/alert - Set a price alert (e.g. /alert AAPL above 200)\n"
+        "/alerts - View your price alerts\n"
+        "/unalert - Remove a price alert\n"
+        "/digest - Get a daily or market-close summary\n"
+        "/hold - Record a position in a group (e.g. /hold Tech AAPL 10 150)\n"
+        "/pnl - Value and profit/loss of your positions\n"
+        "/import - Add many stocks from a list, CSV or JSON file\n"
+        "/export - Download your tracked stocks as CSV\n"
+        "/performance - Show a group's performance over time\n"
+        "/analyze - Correlation, volatility and beta of a group\n"
+        "/simulate - Price a structured note on a group's basket\n"
         "/help - Show this message"
     )
 
 async def add_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    context.user_data["adding_stock"] = True
-    await update.message.reply_text(
+    start_conversation(user_id, ConvState.ADDING_STOCK)
+    await reply(
+        update,
         "🔍 Please send me a company name or ticker symbol to search.\n"
         "Example: 'Apple' or 'AAPL'\n\n"
         "Send /cancel to stop."
@@ -96,33 +2595,34 @@ async def add_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
+    stocks = storage.get_stocks(user_id)
     
-    if user_id not in user_selected_stocks or not user_selected_stocks[user_id]:
-        await update.message.reply_text("You don't have any stocks to delete. Use /add to start tracking!")
+    if not stocks:
+        await reply(update, "You don't have any stocks to delete. Use /add to start tracking!")
         return
     
-    stocks = user_selected_stocks[user_id]
-    
     if len(stocks) == 1:
         stock = stocks[0]
-        context.user_data["deleting_stock"] = True
-        context.user_data["stock_to_delete"] = stock
+        conv = start_conversation(user_id, ConvState.DELETING_STOCK)
+        conv.target = stock
         
         keyboard = [["Yes, delete it"], ["No, keep it"]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
-            f"Are you sure you want to delete:\n{stock['name']} ({stock['ticker']})?",
+        await reply(
+            update,
+            f"Are you sure you want to delete:\n{stock.name} ({stock.ticker})?",
             reply_markup=reply_markup
         )
     else:
-        context.user_data["deleting_stock"] = True
+        start_conversation(user_id, ConvState.DELETING_STOCK)
         
-        keyboard = [[f"{stock['ticker']} - {stock['name'][:40]}"] for stock in stocks]
+        keyboard = [[f"{stock.ticker} - {stock.name[:40]}"] for stock in stocks]
         keyboard.append(["Cancel"])
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await reply(
+            update,
             "Select the stock you want to delete:",
             reply_markup=reply_markup
         )
@@ -130,30 +2630,31 @@ async def delete_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def create_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the process of creating a stock group"""
     user_id = update.message.from_user.id
+    stocks = storage.get_stocks(user_id)
     
     # Check if user has added stocks
-    if user_id not in user_selected_stocks or not user_selected_stocks[user_id]:
-        await update.message.reply_text(
+    if not stocks:
+        await reply(
+            update,
             "❌ You need to add stocks first!\n\n"
             "Use /add to add stocks to your tracking list."
         )
         return
     
-    stocks = user_selected_stocks[user_id]
-    
     if len(stocks) < 2:
-        await update.message.reply_text(
+        await reply(
+            update,
             "❌ You need at least 2 stocks to create a group.\n\n"
             f"You currently have {len(stocks)} stock. Use /add to add more stocks."
         )
         return
     
     # Initialize group creation state
-    context.user_data["creating_group"] = True
-    context.user_data["group_stocks"] = []
-    context.user_data["group_step"] = "name"
+    conv = start_conversation(user_id, ConvState.NAMING_GROUP)
+    conv.group_stocks = {}
     
-    await update.message.reply_text(
+    await reply(
+        update,
         "📊 Let's create a stock group!\n\n"
         "First, give your group a name (e.g., 'Tech Giants', 'My Portfolio'):"
     )
@@ -161,40 +2662,43 @@ async def create_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def disband_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Disband a group (set as inactive)"""
     user_id = update.message.from_user.id
+    groups = storage.get_groups(user_id)
     
-    if user_id not in user_groups or not user_groups[user_id]:
-        await update.message.reply_text("You don't have any groups. Use /group to create one!")
+    if not groups:
+        await reply(update, "You don't have any groups. Use /group to create one!")
         return
     
     # Filter only active groups
-    active_groups = [g for g in user_groups[user_id] if g.get('active', True)]
+    active_groups = [g for g in groups if g.active]
     
     if not active_groups:
-        await update.message.reply_text("You don't have any active groups. Use /activate to reactivate disbanded groups.")
+        await reply(update, "You don't have any active groups. Use /activate to reactivate disbanded groups.")
         return
     
     if len(active_groups) == 1:
         group = active_groups[0]
-        context.user_data["disbanding_group"] = True
-        context.user_data["group_to_disband"] = group
+        conv = start_conversation(user_id, ConvState.DISBANDING_GROUP)
+        conv.target = group
         
         keyboard = [["Yes, disband it"], ["No, keep it active"]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
-            f"Are you sure you want to disband:\n'{group['name']}'?\n\n"
-            f"Stocks: {', '.join(group['stocks'])}\n\n"
+        await reply(
+            update,
+            f"Are you sure you want to disband:\n'{group.name}'?\n\n"
+            f"Stocks: {', '.join(group.stocks)}\n\n"
             f"(The group will be saved and can be reactivated later)",
             reply_markup=reply_markup
         )
     else:
-        context.user_data["disbanding_group"] = True
+        start_conversation(user_id, ConvState.DISBANDING_GROUP)
         
-        keyboard = [[f"{g['name']} ({', '.join(g['stocks'][:2])}...)"] for g in active_groups]
+        keyboard = [[f"{g.name} ({', '.join(g.stocks[:2])}...)"] for g in active_groups]
         keyboard.append(["Cancel"])
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await reply(
+            update,
             "Select the group you want to disband:",
             reply_markup=reply_markup
         )
@@ -202,101 +2706,939 @@ async def disband_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def activate_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reactivate a disbanded group"""
     user_id = update.message.from_user.id
+    groups = storage.get_groups(user_id)
     
-    if user_id not in user_groups or not user_groups[user_id]:
-        await update.message.reply_text("You don't have any groups. Use /group to create one!")
+    if not groups:
+        await reply(update, "You don't have any groups. Use /group to create one!")
         return
     
     # Filter only inactive groups
-    inactive_groups = [g for g in user_groups[user_id] if not g.get('active', True)]
+    inactive_groups = [g for g in groups if not g.active]
     
     if not inactive_groups:
-        await update.message.reply_text("You don't have any disbanded groups. All your groups are active!")
+        await reply(update, "You don't have any disbanded groups. All your groups are active!")
         return
     
     if len(inactive_groups) == 1:
         group = inactive_groups[0]
-        context.user_data["activating_group"] = True
-        context.user_data["group_to_activate"] = group
+        conv = start_conversation(user_id, ConvState.ACTIVATING_GROUP)
+        conv.target = group
         
         keyboard = [["Yes, activate it"], ["No, keep it disbanded"]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
-            f"Reactivate this group?\n'{group['name']}'\n\n"
-            f"Stocks: {', '.join(group['stocks'])}",
+        await reply(
+            update,
+            f"Reactivate this group?\n'{group.name}'\n\n"
+            f"Stocks: {', '.join(group.stocks)}",
             reply_markup=reply_markup
         )
     else:
-        context.user_data["activating_group"] = True
+        start_conversation(user_id, ConvState.ACTIVATING_GROUP)
         
-        keyboard = [[f"{g['name']} ({', '.join(g['stocks'][:2])}...)"] for g in inactive_groups]
+        keyboard = [[f"{g.name} ({', '.join(g.stocks[:2])}...)"] for g in inactive_groups]
         keyboard.append(["Cancel"])
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
+        await reply(
+            update,
             "Select the group you want to reactivate:",
             reply_markup=reply_markup
         )
 
-async def view_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display all groups for the user"""
+def format_price_line(ticker, price_data):
+    change_symbol = "📈" if (price_data.get('change') or 0) >= 0 else "📉"
+    change_percent = (price_data.get('change_percent') or 0) * 100
+    return f"• {ticker}: {price_data['currency']} {price_data['price']:.2f} {change_symbol} ({change_percent:.2f}%)\n"
+
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+def sparkline(values, width=SPARKLINE_WIDTH):
+    """The values drawn as block characters, squeezed into at most `width` columns"""
+    if len(values) > width:
+        # Last sample in each column, so the line ends on the latest price
+        values = [values[(i + 1) * len(values) // width - 1] for i in range(width)]
+    low = min(values)
+    span = max(values) - low
+    if not span:
+        return SPARK_CHARS[3] * len(values)
+    top = len(SPARK_CHARS) - 1
+    return ''.join(SPARK_CHARS[round((v - low) / span * top)] for v in values)
+
+def format_tick_line(ticker):
+    """Sparkline with the session's low and high for the ticker, or '' until it has two samples"""
+    ring = tick_store.get(ticker)
+    if ring is None or ring.count < 2:
+        return ""
+    values = ring.values()
+    return f"{sparkline(values)} L {min(values):.2f} H {max(values):.2f}\n"
+
+group_block_cache = TTLCache(float('inf'), RENDER_CACHE_MAX_ENTRIES)  # {group_id: (key, text)}
+
+def render_group_block(group):
+    """Text for one group without its list number, rebuilt only when its prices or membership change"""
+    key = (
+        group.name, group.stocks, group.active,
+        tuple((price_versions.get(t, 0), tick_store.version(t)) for t in group.stocks),
+    )
+    cached = group_block_cache.get(group.id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    
+    if not group.active:
+        parts = [f"{group.name} (Inactive)\n", f"   Stocks: {', '.join(group.stocks)}\n\n"]
+    else:
+        parts = [f"{group.name} ✅\n", f"   Stocks: {', '.join(group.stocks)}\n"]
+        
+        # Show prices if available
+        prices = [(t, latest_prices[t]) for t in group.stocks if t in latest_prices]
+        if prices:
+            parts.append("   Prices:\n")
+            for ticker, price_data in prices:
+                parts.append(f"   {format_price_line(ticker, price_data)}")
+                ticks = format_tick_line(ticker)
+                if ticks:
+                    parts.append(f"      {ticks}")
+        
+        parts.append("\n")
+    
+    text = ''.join(parts)
+    group_block_cache.set(group.id, (key, text))
+    return text
+
+def paginate(chunks, limit=MAX_MESSAGE_LENGTH):
+    """Pack text chunks into as few pages under the message limit as possible"""
+    pages = []
+    current = []
+    size = 0
+    for chunk in chunks:
+        length = message_length(chunk)
+        if length > limit:
+            # A single chunk longer than a page gets cut up on its own (emoji count double)
+            step = limit // 2
+            pieces = [chunk[k:k + step] for k in range(0, len(chunk), step)]
+        else:
+            pieces = [chunk]
+        
+        for piece in pieces:
+            length = message_length(piece)
+            if current and size + length > limit:
+                pages.append(''.join(current))
+                current = []
+                size = 0
+            current.append(piece)
+            size += length
+    
+    if current:
+        pages.append(''.join(current))
+    return pages
+
+def render_group_pages(user_id):
+    groups = storage.get_groups(user_id)
+    chunks = []
+    
+    active_groups = [g for g in groups if g.active]
+    if active_groups:
+        chunks.append("📊 Active Groups:\n\n")
+        chunks.extend(f"{i}. {render_group_block(g)}" for i, g in enumerate(active_groups, 1))
+    
+    inactive_groups = [g for g in groups if not g.active]
+    if inactive_groups:
+        chunks.append("💤 Disbanded Groups:\n\n")
+        chunks.extend(f"{i}. {render_group_block(g)}" for i, g in enumerate(inactive_groups, 1))
+    
+    return paginate(chunks)
+
+def render_stock_pages(user_id):
+    stocks = storage.get_stocks(user_id)
+    
+    if len(stocks) == 1:
+        stock = stocks[0]
+        return [f"📊 Your tracked stock:\n\n• {stock.name} ({stock.ticker})"]
+    
+    chunks = ["📊 Your tracked stocks:\n\n"]
+    chunks.extend(f"{i}. {stock.name} ({stock.ticker})\n" for i, stock in enumerate(stocks, 1))
+    return paginate(chunks)
+
+def render_digest_pages(user_id):
+    """Watchlist prices followed by the active groups in the /groups format, or [] if there's nothing to send"""
+    stocks = storage.get_stocks(user_id)
+    active_groups = [g for g in storage.get_groups(user_id) if g.active]
+    if not stocks and not active_groups:
+        return []
+    
+    digest = digest_scheduler.digests.get(user_id)
+    kind = 'market close' if digest and digest['kind'] == 'close' else 'daily'
+    chunks = [f"🗞 Your {kind} digest\n\n"]
+    
+    if stocks:
+        chunks.append("📊 Tracked stocks:\n")
+        for stock in stocks:
+            price_data = latest_prices.get(stock.ticker)
+            chunks.append(format_price_line(stock.ticker, price_data) if price_data else f"• {stock.ticker}: price unavailable\n")
+        chunks.append("\n")
+    
+    if active_groups:
+        chunks.append("📊 Active Groups:\n\n")
+        chunks.extend(f"{i}. {render_group_block(g)}" for i, g in enumerate(active_groups, 1))
+    
+    return paginate(chunks)
+
+def format_pnl(amount, base):
+    """Signed amount with its share of base as a percentage"""
+    percent = f" ({amount / base * 100:+.2f}%)" if base else ""
+    return f"{amount:+,.2f}{percent}"
+
+def currency_label(positions):
+    currencies = {p.currency for p in positions if p.currency}
+    return currencies.pop() if len(currencies) == 1 else "mixed"
+
+def render_pnl_block(value, day_change, cost, currency):
+    return (
+        f"   Value: {currency} {value:,.2f}\n"
+        f"   Day: {format_pnl(day_change, value - day_change)}\n"
+        f"   Unrealized: {format_pnl(value - cost, cost)}\n"
+    )
+
+def render_pnl_pages(user_id):
+    """P&L of each active group with holdings, read from the running totals without fetching prices"""
+    held = []
+    for group in storage.get_groups(user_id):
+        totals = portfolios.group(group.id) if group.active else None
+        if totals is not None:
+            held.append((group, totals))
+    if not held:
+        return []
+    
+    chunks = ["💼 Portfolio P&L\n\n"]
+    for group, totals in held:
+        positions = totals.positions.values()
+        parts = [f"{group.name}\n"]
+        parts.append(render_pnl_block(totals.value, totals.day_change, totals.cost, currency_label(positions)))
+        for position in positions:
+            line = f"   • {position.ticker} {position.quantity:g} @ {position.cost:,.2f}: "
+            if position.value is None:
+                line += "awaiting price\n"
+            else:
+                cost = position.quantity * position.cost
+                line += f"{position.value:,.2f}, P&L {format_pnl(position.value - cost, cost)}\n"
+            parts.append(line)
+        parts.append("\n")
+        chunks.append(''.join(parts))
+    
+    if len(held) > 1:
+        positions = [p for _, totals in held for p in totals.positions.values()]
+        chunks.append(f"Total ({len(held)} groups)\n" + render_pnl_block(
+            sum(totals.value for _, totals in held),
+            sum(totals.day_change for _, totals in held),
+            sum(totals.cost for _, totals in held),
+            currency_label(positions),
+        ))
+    
+    unpriced = sum(totals.unpriced for _, totals in held)
+    if unpriced:
+        chunks.append(f"\n⏳ {unpriced} position{'s' if unpriced != 1 else ''} awaiting a price, not counted above\n")
+    
+    return paginate(chunks)
+
+PAGE_RENDERERS = {
+    'groups': render_group_pages,
+    'list': render_stock_pages,
+    'pnl': render_pnl_pages,
+}
+
+def page_keyboard(kind, index, count):
+    if count <= 1:
+        return None
+    
+    buttons = []
+    if index > 0:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data=f"page:{kind}:{index - 1}"))
+    buttons.append(InlineKeyboardButton(f"{index + 1}/{count}", callback_data="page:noop"))
+    if index < count - 1:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"page:{kind}:{index + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+async def change_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inline keyboard callback for the Prev/Next buttons under paged output"""
+    query = update.callback_query
+    await query.answer()
+    
+    _, kind, *rest = query.data.split(':')
+    if kind not in PAGE_RENDERERS or not rest:
+        return
+    
+    # Pages are re-rendered from cached blocks rather than stored per message
+    pages = PAGE_RENDERERS[kind](query.from_user.id)
+    if not pages:
+        return
+    index = min(int(rest[0]), len(pages) - 1)
+    
+    await outbox.send(
+        query.message.chat_id,
+        query.edit_message_text,
+        pages[index],
+        reply_markup=page_keyboard(kind, index, len(pages))
+    )
+
+async def view_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Display all groups for the user"""
+    user_id = update.message.from_user.id
+    
+    if not storage.get_groups(user_id):
+        await reply(
+            update,
+            "You don't have any groups yet.\n\n"
+            "Use /group to create your first stock group!"
+        )
+        return
+    
+    pages = render_group_pages(user_id)
+    await reply(update, pages[0], reply_markup=page_keyboard('groups', 0, len(pages)))
+
+async def set_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set a price alert: /alert <ticker> above|below|move <value>"""
+    user_id = update.message.from_user.id
+    args = context.args or []
+    
+    usage = (
+        "Usage:\n"
+        "/alert AAPL above 200\n"
+        "/alert AAPL below 150\n"
+        "/alert AAPL move 3  (moves ±3% on the day)"
+    )
+    
+    if len(args) != 3 or args[1].lower() not in AlertEngine.KINDS:
+        await reply(update, usage)
+        return
+    
+    ticker = args[0].upper()
+    kind = args[1].lower()
+    try:
+        threshold = float(args[2].rstrip('%'))
+    except ValueError:
+        await reply(update, usage)
+        return
+    
+    if threshold <= 0:
+        await reply(update, "❌ The alert value must be positive.")
+        return
+    
+    if len(alert_engine.user_alerts(user_id)) >= ALERTS_MAX_PER_USER:
+        await reply(update, f"❌ You can have at most {ALERTS_MAX_PER_USER} alerts. Use /unalert to remove some.")
+        return
+    
+    prices = await get_stock_prices([ticker])
+    if ticker not in prices:
+        await reply(update, f"❌ Couldn't find a price for {ticker}. Check the ticker symbol.")
+        return
+    
+    alert = {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'ticker': ticker,
+        'kind': kind,
+        'threshold': threshold
+    }
+    alert_engine.add(alert)
+    storage.add_alert(alert)
+    
+    price_data = prices[ticker]
+    await reply(
+        update,
+        f"🔔 Alert set: {describe_alert(alert)}\n"
+        f"Current price: {price_data['currency']} {price_data['price']:.2f}"
+    )
+
+async def list_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    alerts = alert_engine.user_alerts(user_id)
+    
+    if not alerts:
+        await reply(update, "You don't have any alerts. Use /alert to set one!")
+        return
+    
+    response = "🔔 Your alerts:\n\n"
+    for i, alert in enumerate(alerts, 1):
+        response += f"{i}. {describe_alert(alert)}\n"
+    response += "\nUse /unalert <number> to remove one."
+    
+    await reply(update, response)
+
+async def remove_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Remove an alert by its number in /alerts"""
+    user_id = update.message.from_user.id
+    alerts = alert_engine.user_alerts(user_id)
+    args = context.args or []
+    
+    if not alerts:
+        await reply(update, "You don't have any alerts. Use /alert to set one!")
+        return
+    
+    if len(args) != 1 or not args[0].isdigit() or not 1 <= int(args[0]) <= len(alerts):
+        await reply(update, "Usage: /unalert <number> (see /alerts for the numbers)")
+        return
+    
+    alert = alerts[int(args[0]) - 1]
+    alert_engine.remove(alert['id'])
+    storage.remove_alert(alert['id'])
+    
+    await reply(update, f"✅ Alert removed: {describe_alert(alert)}")
+
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Subscribe to a digest: /digest daily <HH:MM> [timezone], /digest close or /digest off"""
+    user_id = update.message.from_user.id
+    args = context.args or []
+    current = digest_scheduler.digests.get(user_id)
+    
+    usage = (
+        "Usage:\n"
+        "/digest daily 08:00 Europe/London - every day at a time in your timezone\n"
+        "/digest close - weekdays after the US market closes\n"
+        "/digest off - stop sending digests"
+    )
+    
+    if not args:
+        if current is None:
+            status = "You aren't subscribed to a digest."
+        elif current['kind'] == 'close':
+            status = "You get a digest on weekdays after the US market closes."
+        else:
+            status = f"You get a digest every day at {current['minute'] // 60:02d}:{current['minute'] % 60:02d} {current['timezone']}."
+        await reply(update, f"🗞 {status}\n\n{usage}")
+        return
+    
+    kind = args[0].lower()
+    if kind == 'off':
+        digest_scheduler.remove(user_id)
+        storage.remove_digest(user_id)
+        await reply(update, "✅ Digest turned off.")
+        return
+    
+    if kind == 'close' and len(args) == 1:
+        subscription = {'user_id': user_id, 'kind': 'close', 'minute': DIGEST_CLOSE_MINUTE, 'timezone': MARKET_TZ.key}
+    elif kind == 'daily' and len(args) in (2, 3):
+        try:
+            hour, minute = (int(part) for part in args[1].split(':'))
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError
+        except ValueError:
+            await reply(update, f"❌ '{args[1]}' isn't a time like 08:00.\n\n{usage}")
+            return
+        
+        tz = args[2] if len(args) == 3 else (current['timezone'] if current else MARKET_TZ.key)
+        try:
+            ZoneInfo(tz)
+        except (ZoneInfoNotFoundError, ValueError):
+            await reply(update, f"❌ Unknown timezone '{tz}'. Use a name like Europe/London or Asia/Tokyo.")
+            return
+        subscription = {'user_id': user_id, 'kind': 'daily', 'minute': hour * 60 + minute, 'timezone': tz}
+    else:
+        await reply(update, usage)
+        return
+    
+    digest_scheduler.add(subscription)
+    storage.set_digest(subscription)
+    
+    next_at = datetime.fromtimestamp(next_digest_time(subscription, time.time()), ZoneInfo(subscription['timezone']))
+    await reply(update, f"✅ Digest scheduled. The next one arrives {next_at:%a %d %b at %H:%M} ({subscription['timezone']}).")
+
+def parse_number(text):
+    """Finite float from user input, or None"""
+    try:
+        value = float(text.replace(',', ''))
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+async def hold(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set a position in a group: /hold <group> <ticker> <quantity> <cost per share>, quantity 0 removes it"""
+    user_id = update.message.from_user.id
+    args = context.args or []
+    
+    usage = (
+        "Usage:\n"
+        "/hold <group> <ticker> <quantity> <cost per share>\n"
+        "/hold Tech AAPL 10 150.25\n"
+        "/hold Tech AAPL 0  (removes the position)"
+    )
+    
+    if len(args) >= 4 and parse_number(args[-2]) is not None and parse_number(args[-1]) is not None:
+        name, ticker, quantity, cost = ' '.join(args[:-3]), args[-3].upper(), parse_number(args[-2]), parse_number(args[-1])
+    elif len(args) >= 3 and parse_number(args[-1]) == 0:
+        name, ticker, quantity, cost = ' '.join(args[:-2]), args[-2].upper(), 0, 0
+    else:
+        await reply(update, usage)
+        return
+    
+    group = find_group(user_id, name)
+    if group is None:
+        groups = storage.get_groups(user_id)
+        await reply(
+            update,
+            f"❌ You don't have a group named '{name}'.\n\n"
+            + (f"Your groups: {', '.join(g.name for g in groups)}" if groups else "Use /group to create one!")
+        )
+        return
+    
+    if ticker not in group.stocks:
+        await reply(update, f"❌ {ticker} isn't in '{group.name}'. Its stocks are: {', '.join(group.stocks)}")
+        return
+    
+    if quantity == 0:
+        if portfolios.remove(group.id, ticker) is None:
+            await reply(update, f"You don't hold {ticker} in '{group.name}'.")
+            return
+        storage.remove_holding(group.id, ticker)
+        await reply(update, f"🗑️ Removed your {ticker} position from '{group.name}'.")
+        return
+    
+    if quantity < 0 or cost < 0:
+        await reply(update, "❌ Quantity and cost must be positive.")
+        return
+    
+    if ticker not in latest_prices:
+        await get_stock_prices([ticker])
+    
+    holding = {'group_id': group.id, 'user_id': user_id, 'ticker': ticker, 'quantity': quantity, 'cost': cost}
+    position = portfolios.set(holding)
+    storage.set_holding(holding)
+    
+    response = f"💼 {group.name}: {quantity:g} {ticker} at {cost:,.2f} per share\n"
+    if position.value is None:
+        response += "Its value will show in /pnl once a price comes in."
+    else:
+        basis = quantity * cost
+        response += (
+            f"Value: {position.currency} {position.value:,.2f}\n"
+            f"Unrealized: {format_pnl(position.value - basis, basis)}"
+        )
+    await reply(update, response)
+
+async def pnl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Market value, day change and unrealized P&L of the user's positions"""
+    user_id = update.message.from_user.id
+    
+    pages = render_pnl_pages(user_id)
+    if not pages:
+        await reply(
+            update,
+            "You don't hold any positions in active groups yet.\n\n"
+            "Use /hold <group> <ticker> <quantity> <cost per share> to add one."
+        )
+        return
+    
+    await reply(update, pages[0], reply_markup=page_keyboard('pnl', 0, len(pages)))
+
+IMPORT_COLUMNS = ('ticker', 'symbol', 'name', 'company')  # columns or JSON keys an import reads, best first
+
+def import_json_rows(text):
+    """Rows from a JSON array of tickers, names or objects, None if the text isn't one"""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, list):
+        return None
+    
+    rows = []
+    for item in data:
+        if isinstance(item, dict):
+            item = next((item[key] for key in IMPORT_COLUMNS if item.get(key)), None)
+        if isinstance(item, str):
+            rows.append([item.strip()])
+    return rows
+
+def parse_import_entries(text):
+    """Tickers or company names from a pasted list, CSV or JSON array, deduplicated, in order
+
+    A header row naming a ticker/symbol or name/company column selects that
+    column; otherwise every non-numeric cell counts.
+    """
+    rows = import_json_rows(text) if text.lstrip().startswith('[') else None
+    if rows is None:
+        rows = csv.reader(io.StringIO(text.replace(';', ',').replace('\t', ',')))
+        rows = [[cell.strip() for cell in row] for row in rows if any(cell.strip() for cell in row)]
+        if rows:
+            header = [cell.lower() for cell in rows[0]]
+            for wanted in IMPORT_COLUMNS:
+                if wanted in header:
+                    column = header.index(wanted)
+                    rows = [row[column:column + 1] for row in rows[1:]]
+                    break
+    
+    entries = {}
+    for row in rows:
+        for cell in row:
+            try:
+                float(cell.rstrip('%'))
+                continue
+            except ValueError:
+                pass
+            if cell:
+                entries.setdefault(normalize_query(cell), cell)
+    return list(entries.values())
+
+async def resolve_import_entry(entry, limit):
+    """(symbol, matches, error) for one entry, symbol is None unless exactly one company fits"""
+    # Known tickers and full names don't need a search at all, names like 'ford' do:
+    # the company may not be the FORD we know
+    known = symbol_index.known(entry)
+    if known:
+        return known, [known], None
+    is_ticker = entry.isupper() and ' ' not in entry
+    
+    # The import paid for its lookups up front, they queue for the budget instead of being refused
+    patient = upstream_patient.set(True)
+    try:
+        async with limit:
+            matches, error = await search_companies(entry)
+    finally:
+        upstream_patient.reset(patient)
+    
+    if error is not None:
+        return None, matches, error
+    exact = [m for m in matches if m.ticker == entry.upper()]
+    if exact and (is_ticker or matches[0] is exact[0]):
+        return exact[0], exact, None
+    if len(matches) == 1:
+        return matches[0], matches, None
+    return None, matches, error
+
+async def import_entries(update: Update, text):
+    """Resolve and add every entry in text, then send one summary"""
+    user_id = update.message.from_user.id
+    entries = parse_import_entries(text)
+    
+    if not entries:
+        await reply(update, "❌ I couldn't find any tickers or company names to import.")
+        return
+    
+    if len(entries) > IMPORT_MAX_ENTRIES:
+        await reply(update, f"❌ You can import at most {IMPORT_MAX_ENTRIES} stocks at once, this list has {len(entries)}.")
+        return
+    
+    # One token from the user's quota covers the whole import. A user's updates run one
+    # at a time, so they can't have more than one import queueing lookups
+    if not upstream_quota.charge(user_id):
+        await reply(update, QUOTA_EXCEEDED_MESSAGE)
+        return
+    
+    limit = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    results = await asyncio.gather(*(resolve_import_entry(entry, limit) for entry in entries))
+    
+    added, tracked, ambiguous, failed, deferred = [], [], [], [], []
+    seen = set()
+    for entry, (symbol, matches, error) in zip(entries, results):
+        if symbol is None:
+            if error == QUOTA_EXCEEDED_MESSAGE:
+                deferred.append(entry)
+            elif matches:
+                ambiguous.append(f"{entry} ({', '.join(m.ticker for m in matches[:3])}{', ...' if len(matches) > 3 else ''})")
+            else:
+                failed.append(entry)
+        elif symbol.ticker not in seen:
+            seen.add(symbol.ticker)
+            if storage.has_stock(user_id, symbol.ticker):
+                tracked.append(symbol.ticker)
+            else:
+                storage.add_stock(user_id, symbol)
+                added.append(symbol.ticker)
+    
+    chunks = [f"📥 Import finished: {len(entries)} entries\n\n"]
+    if added:
+        chunks.append(f"✅ Added {len(added)}: {', '.join(added)}\n\n")
+    if tracked:
+        chunks.append(f"ℹ️ Already tracked {len(tracked)}: {', '.join(tracked)}\n\n")
+    if ambiguous:
+        chunks.append(f"⚠️ Ambiguous {len(ambiguous)}, use /add or the exact ticker:\n")
+        chunks.extend(f"• {line}\n" for line in ambiguous)
+        chunks.append("\n")
+    if failed:
+        chunks.append(f"❌ Not found {len(failed)}: {', '.join(failed)}\n")
+    if deferred:
+        chunks.append(f"\n⏳ Skipped {len(deferred)}, lookup limit reached. Import them again in a minute: {', '.join(deferred)}\n")
+    
+    for page in paginate(chunks):
+        await reply(update, page, reply_markup=ReplyKeyboardRemove())
+
+async def import_stocks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add many stocks at once: /import AAPL, MSFT, Tesla or /import followed by a list, CSV or JSON file"""
+    user_id = update.message.from_user.id
+    parts = update.message.text.split(None, 1)
+    
+    if len(parts) > 1:
+        end_conversation(user_id)
+        await import_entries(update, parts[1])
+        return
+    
+    start_conversation(user_id, ConvState.IMPORTING)
+    await reply(
+        update,
+        "📥 Send me the tickers or company names to add, separated by commas or one per line, "
+        f"or upload a CSV or JSON file (up to {IMPORT_MAX_ENTRIES} stocks).\n\n"
+        "Send /cancel to stop."
+    )
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Import an uploaded CSV, JSON or text file, sent after /import or captioned with it"""
+    user_id = update.message.from_user.id
+    conv = conversations.get(user_id)
+    caption = (update.message.caption or '').strip().lower()
+    
+    if not (conv and conv.state == ConvState.IMPORTING) and not caption.startswith('/import'):
+        await reply(update, "To import stocks from a file, send /import first or caption the file with /import.")
+        return
+    
+    end_conversation(user_id)
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await reply(update, f"❌ That file is too large, the limit is {IMPORT_MAX_FILE_SIZE // 1024} KB.")
+        return
+    
+    try:
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+    except Exception as e:
+        print(f"[ERROR] Failed to download import file from {user_id}: {e}")
+        await reply(update, "Sorry, I couldn't download that file. Please try again later.")
+        return
+    
+    await import_entries(update, bytes(data).decode('utf-8-sig', errors='replace'))
+
+async def export_stocks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user's tracked stocks as a CSV file that /import accepts"""
+    user_id = update.message.from_user.id
+    stocks = storage.get_stocks(user_id)
+    
+    if not stocks:
+        await reply(update, "You haven't added any stocks yet. Use /add or /import to start tracking!")
+        return
+    
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['ticker', 'name', 'exchange'])
+    writer.writerows((s.ticker, s.name, s.exchange) for s in stocks)
+    
+    # The outbox passes its text argument as the first positional one, here the document
+    await outbox.send(
+        update.message.chat_id, update.message.reply_document, out.getvalue().encode(),
+        filename='watchlist.csv', caption=f"📤 {len(stocks)} tracked stocks"
+    )
+
+def find_group(user_id, name):
+    """The user's group with the given name, ignoring case"""
+    wanted = name.strip().lower()
+    for group in storage.get_groups(user_id):
+        if group.name.lower() == wanted:
+            return group
+    return None
+
+def split_group_args(args, options):
+    """Split command args into a group name and a trailing option such as a period"""
+    if args and args[-1].lower() in options:
+        return ' '.join(args[:-1]), args[-1].lower()
+    return ' '.join(args), None
+
+async def performance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show a group's equal-weight return and drawdown: /performance <group> [period]"""
+    user_id = update.message.from_user.id
+    groups = storage.get_groups(user_id)
+    
+    if not groups:
+        await reply(update, "You don't have any groups. Use /group to create one!")
+        return
+    
+    name, period = split_group_args(context.args or [], PERFORMANCE_PERIODS)
+    period = period or '1y'
+    group = find_group(user_id, name) if name else (groups[0] if len(groups) == 1 else None)
+    
+    if group is None:
+        await reply(
+            update,
+            "Usage: /performance <group> [period]\n"
+            f"Periods: {', '.join(PERFORMANCE_PERIODS)}\n\n"
+            f"Your groups: {', '.join(g.name for g in groups)}"
+        )
+        return
+    
+    tickers = group.stocks
+    interval = HISTORY_INTRADAY_INTERVAL if period == '1d' else '1d'
+    await history_store.sync(tickers, interval)
+    
+    since = time.time() - PERFORMANCE_PERIODS[period] * 86400
+    timestamps, closes = await history_store.aligned_closes(tickers, interval, since)
+    if interval != '1d' and len(timestamps):
+        # Intraday: only the most recent session
+        session = bar_time(timestamps[-1], interval).replace(hour=0, minute=0, second=0)
+        keep = timestamps >= session.timestamp()
+        timestamps, closes = timestamps[keep], closes[:, keep]
+    
+    if len(timestamps) < 2:
+        await reply(update, f"❌ Not enough price history for '{group.name}' yet. Please try again later.")
+        return
+    
+    stats = group_performance(closes)
+    start_date = bar_time(timestamps[0], interval)
+    end_date = bar_time(timestamps[-1], interval)
+    fmt = '%Y-%m-%d %H:%M' if interval != '1d' else '%Y-%m-%d'
+    
+    response = f"📈 Performance: {group.name} ({period})\n"
+    response += f"{start_date.strftime(fmt)} → {end_date.strftime(fmt)} ({len(timestamps)} bars)\n\n"
+    response += f"Equal-weight return: {stats['total_return'] * 100:+.2f}%\n"
+    response += f"Max drawdown: {stats['max_drawdown'] * 100:.2f}%\n\n"
+    response += "By stock:\n"
+    for ticker, ret, drawdown in zip(tickers, stats['stock_returns'], stats['stock_drawdowns']):
+        response += f"• {ticker}: {ret * 100:+.2f}% (max drawdown {drawdown * 100:.2f}%)\n"
+    
+    await reply(update, response)
+
+async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Risk analytics for a group: /analyze <group> [period] [vs <benchmark>]"""
+    user_id = update.message.from_user.id
+    groups = storage.get_groups(user_id)
+    
+    if not groups:
+        await reply(update, "You don't have any groups. Use /group to create one!")
+        return
+    
+    args = list(context.args or [])
+    benchmark = ANALYSIS_BENCHMARK
+    if len(args) >= 2 and args[-2].lower() == 'vs':
+        benchmark = args[-1].upper()
+        args = args[:-2]
+    
+    name, period = split_group_args(args, PERFORMANCE_PERIODS)
+    period = period or '1y'
+    group = find_group(user_id, name) if name else (groups[0] if len(groups) == 1 else None)
+    
+    if group is None or period == '1d':
+        await reply(
+            update,
+            "Usage: /analyze <group> [period] [vs <benchmark>]\n"
+            f"Periods: {', '.join(p for p in PERFORMANCE_PERIODS if p != '1d')}\n"
+            f"Benchmark defaults to {ANALYSIS_BENCHMARK}.\n\n"
+            f"Your groups: {', '.join(g.name for g in groups)}"
+        )
+        return
+    
+    # Sorted so groups holding the same stocks share cached results
+    tickers = sorted(group.stocks)
+    # The benchmark may be one of the group's own stocks
+    series = tickers if benchmark in tickers else tickers + [benchmark]
+    await history_store.sync(series)
+    
+    since = time.time() - PERFORMANCE_PERIODS[period] * 86400
+    timestamps, closes = await history_store.aligned_closes(series, since=since)
+    
+    if len(timestamps) < 20:
+        await reply(update, f"❌ Not enough price history for '{group.name}' and {benchmark} yet. Please try again later.")
+        return
+    
+    key = (tuple(tickers), benchmark, period, timestamps[-1])
+    stats = analysis_cache.get(key)
+    if stats is None:
+        stats = group_risk(closes[:len(tickers)], closes[series.index(benchmark)])
+        analysis_cache.set(key, stats)
+    
+    response = f"🔬 Analysis: {group.name} ({period}, {len(timestamps)} days)\n\n"
+    response += f"Equal-weight volatility: {stats['portfolio_volatility'] * 100:.2f}% "
+    response += f"(variance {stats['portfolio_variance']:.4f})\n\n"
+    response += f"Volatility / beta vs {benchmark}:\n"
+    for ticker, vol, beta in zip(tickers, stats['volatility'], stats['beta']):
+        response += f"• {ticker}: {vol * 100:.2f}% / β {beta:.2f}\n"
+    
+    response += "\nCorrelation:\n"
+    for i in range(len(tickers)):
+        for j in range(i + 1, len(tickers)):
+            response += f"• {tickers[i]} – {tickers[j]}: {stats['correlation'][i, j]:+.2f}\n"
+    
+    await reply(update, response)
+
+async def simulate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Monte Carlo a structured note on a group's basket: /simulate <group> [autocall|protected] [paths]"""
     user_id = update.message.from_user.id
+    groups = storage.get_groups(user_id)
     
-    if user_id not in user_groups or not user_groups[user_id]:
-        await update.message.reply_text(
-            "You don't have any groups yet.\n\n"
-            "Use /group to create your first stock group!"
+    if not groups:
+        await reply(update, "You don't have any groups. Use /group to create one!")
+        return
+    
+    args = list(context.args or [])
+    paths = SIMULATION_PATHS
+    if args and args[-1].replace('_', '').isdigit():
+        paths = max(SIMULATION_BATCH, min(int(args.pop().replace('_', '')), SIMULATION_MAX_PATHS))
+    
+    name, product = split_group_args(args, ('autocall', 'protected'))
+    product = product or 'autocall'
+    group = find_group(user_id, name) if name else (groups[0] if len(groups) == 1 else None)
+    
+    if group is None:
+        await reply(
+            update,
+            "Usage: /simulate <group> [autocall|protected] [paths]\n\n"
+            f"autocall: 1y worst-of autocallable, {AUTOCALL_COUPON * 100:g}% p.a. coupon, "
+            f"quarterly calls at {AUTOCALL_LEVEL * 100:g}%, {AUTOCALL_BARRIER * 100:g}% barrier\n"
+            f"protected: 1y capital-protected note, {PROTECTED_PARTICIPATION * 100:g}% basket upside, "
+            f"knock-out at {PROTECTED_KNOCKOUT * 100:g}% with a {PROTECTED_REBATE * 100:g}% rebate\n\n"
+            f"Your groups: {', '.join(g.name for g in groups)}"
         )
         return
     
-    groups = user_groups[user_id]
-    active_groups = [g for g in groups if g.get('active', True)]
-    inactive_groups = [g for g in groups if not g.get('active', True)]
+    # Volatility and correlation from a year of daily history
+    tickers = group.stocks
+    await history_store.sync(tickers)
+    timestamps, closes = await history_store.aligned_closes(tickers, since=time.time() - 365 * 86400)
+    if len(timestamps) < 20:
+        await reply(update, f"❌ Not enough price history for '{group.name}' yet. Please try again later.")
+        return
     
-    response = ""
+    log_returns = np.diff(np.log(closes), axis=1)
+    vol = log_returns.std(axis=1, ddof=1) * np.sqrt(TRADING_DAYS)
+    corr = np.corrcoef(log_returns) if len(tickers) > 1 else np.ones((1, 1))
     
-    if active_groups:
-        response += "📊 Active Groups:\n\n"
-        for i, group in enumerate(active_groups, 1):
-            response += f"{i}. {group['name']} ✅\n"
-            response += f"   Stocks: {', '.join(group['stocks'])}\n"
-            
-            # Show prices if available
-            if group.get('prices'):
-                response += "   Prices:\n"
-                for ticker, price_data in group['prices'].items():
-                    change_symbol = "📈" if price_data['change'] >= 0 else "📉"
-                    response += f"   • {ticker}: {price_data['currency']} {price_data['price']:.2f} {change_symbol} ({price_data['change_percent']:.2f}%)\n"
-            
-            response += "\n"
+    chat_id = update.message.chat_id
+    progress = await reply(update, f"⏳ Simulating {paths:,} paths for '{group.name}'... 0%")
+    last_shown = [0]
     
-    if inactive_groups:
-        response += "💤 Disbanded Groups:\n\n"
-        for i, group in enumerate(inactive_groups, 1):
-            response += f"{i}. {group['name']} (Inactive)\n"
-            response += f"   Stocks: {', '.join(group['stocks'])}\n\n"
+    async def on_progress(fraction):
+        # Edit in place at most every 20% to stay well inside Telegram's edit limits
+        if fraction - last_shown[0] >= 0.2 and fraction < 1:
+            last_shown[0] = fraction
+            await outbox.send(chat_id, progress.edit_text, f"⏳ Simulating {paths:,} paths for '{group.name}'... {fraction:.0%}")
+    
+    started = time.perf_counter()
+    async with simulation_lock:
+        simulated = await run_simulation(vol, corr, paths, on_progress)
+    elapsed = time.perf_counter() - started
     
-    if not response:
-        response = "You don't have any groups yet."
+    response = f"🎲 {group.name}: {paths:,} paths in {elapsed:.1f}s\n"
+    response += f"Vols: {', '.join(f'{t} {v * 100:.0f}%' for t, v in zip(tickers, vol))}\n\n"
+    
+    if product == 'autocall':
+        payoffs, call_quarter = price_autocallable(simulated[0])
+        # Not called means the worst performer finished below the call level
+        redemption_loss = (call_quarter == 0) & (simulated[0].min(axis=1) < AUTOCALL_BARRIER)
+        response += "Worst-of autocallable (1y)\n"
+        response += f"Fair value: {payoffs.mean() * 100:.2f}% ± {payoffs.std() / np.sqrt(paths) * 100:.2f}%\n"
+        for quarter in range(1, 5):
+            response += f"Called at Q{quarter}: {(call_quarter == quarter).mean() * 100:.1f}%\n"
+        response += f"Capital loss: {redemption_loss.mean() * 100:.1f}%\n"
+        response += f"5% worst case: {np.percentile(payoffs, 5) * 100:.1f}%"
+    else:
+        payoffs, knocked_out = price_protected(simulated[1])
+        response += "Capital-protected knock-out note (1y)\n"
+        response += f"Fair value: {payoffs.mean() * 100:.2f}% ± {payoffs.std() / np.sqrt(paths) * 100:.2f}%\n"
+        response += f"Knocked out: {knocked_out.mean() * 100:.1f}%\n"
+        response += f"Median payoff: {np.median(payoffs) * 100:.1f}%\n"
+        response += f"95% best case: {np.percentile(payoffs, 95) * 100:.1f}%"
     
-    await update.message.reply_text(response)
+    await outbox.send(chat_id, progress.edit_text, response)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["adding_stock"] = False
-    context.user_data["awaiting_choice"] = False
-    context.user_data["deleting_stock"] = False
-    context.user_data["creating_group"] = False
-    context.user_data["disbanding_group"] = False
-    context.user_data["activating_group"] = False
-    context.user_data["group_step"] = None
-    context.user_data.pop("options", None)
-    context.user_data.pop("stock_to_delete", None)
-    context.user_data.pop("group_stocks", None)
-    context.user_data.pop("group_name", None)
-    context.user_data.pop("group_to_disband", None)
-    context.user_data.pop("group_to_activate", None)
-    await update.message.reply_text(
+    end_conversation(update.message.from_user.id)
+    await reply(
+        update,
         "❌ Operation cancelled.",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -304,349 +3646,614 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def list_stocks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
-    if user_id not in user_selected_stocks or not user_selected_stocks[user_id]:
-        await update.message.reply_text("You haven't added any stocks yet. Use /add to start tracking!")
+    if not storage.get_stocks(user_id):
+        await reply(update, "You haven't added any stocks yet. Use /add to start tracking!")
         return
     
-    stocks = user_selected_stocks[user_id]
-    
-    if len(stocks) == 1:
-        stock = stocks[0]
-        response = f"📊 Your tracked stock:\n\n• {stock['name']} ({stock['ticker']})"
-    else:
-        response = "📊 Your tracked stocks:\n\n"
-        for i, stock in enumerate(stocks, 1):
-            response += f"{i}. {stock['name']} ({stock['ticker']})\n"
-    
-    await update.message.reply_text(response)
+    pages = render_stock_pages(user_id)
+    await reply(update, pages[0], reply_markup=page_keyboard('list', 0, len(pages)))
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_input = update.message.text.strip()
+async def on_importing(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Import the list pasted after /import"""
+    end_conversation(update.message.from_user.id)
+    await import_entries(update, user_input)
+
+async def on_idle(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    await reply(
+        update,
+        "Please use /add to start adding a stock, or /help for available commands."
+    )
+
+async def on_activating_group(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
     user_id = update.message.from_user.id
     
-    if user_id not in user_selected_stocks:
-        user_selected_stocks[user_id] = []
-    
-    if user_id not in user_groups:
-        user_groups[user_id] = []
-    
-    # Handle group activation
-    if context.user_data.get("activating_group"):
-        if user_input == "Cancel":
-            await cancel(update, context)
-            return
-        
-        if user_input in ["Yes, activate it", "No, keep it disbanded"]:
-            if user_input == "Yes, activate it":
-                group = context.user_data.get("group_to_activate")
-                group['active'] = True
-                
-                # Refresh prices
-                tickers = group['stocks']
-                prices = await get_stock_prices(tickers)
-                group['prices'] = prices
-                
-                await update.message.reply_text(
-                    f"✅ Group '{group['name']}' has been reactivated!\n"
-                    f"Prices updated.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            else:
-                await update.message.reply_text(
-                    "Group remains disbanded.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            
-            context.user_data["activating_group"] = False
-            context.user_data.pop("group_to_activate", None)
-            return
-        
-        # Multiple groups - find and activate selected one
-        group_name = user_input.split(" (")[0].strip()
-        inactive_groups = [g for g in user_groups[user_id] if not g.get('active', True)]
-        
-        for group in inactive_groups:
-            if group['name'] == group_name:
-                group['active'] = True
-                
-                # Refresh prices
-                tickers = group['stocks']
-                prices = await get_stock_prices(tickers)
-                group['prices'] = prices
-                
-                await update.message.reply_text(
-                    f"✅ Group '{group['name']}' has been reactivated!\n"
-                    f"Prices updated.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-                context.user_data["activating_group"] = False
-                return
-        
-        await update.message.reply_text("Invalid selection. Please try again or use /cancel")
+    if user_input == "Cancel":
+        await cancel(update, context)
         return
     
-    # Handle group disbanding
-    if context.user_data.get("disbanding_group"):
-        if user_input == "Cancel":
-            await cancel(update, context)
-            return
-        
-        if user_input in ["Yes, disband it", "No, keep it active"]:
-            if user_input == "Yes, disband it":
-                group = context.user_data.get("group_to_disband")
-                group['active'] = False
-                await update.message.reply_text(
-                    f"✅ Group '{group['name']}' has been disbanded.\n"
-                    f"You can reactivate it anytime with /activate",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            else:
-                await update.message.reply_text(
-                    "Group remains active.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
+    if user_input in ["Yes, activate it", "No, keep it disbanded"] and conv.target is not None:
+        if user_input == "Yes, activate it":
+            group = conv.target
+            storage.set_group_active(user_id, group.id, True)
             
-            context.user_data["disbanding_group"] = False
-            context.user_data.pop("group_to_disband", None)
-            return
-        
-        # Multiple groups - find and disband selected one
-        group_name = user_input.split(" (")[0].strip()
-        active_groups = [g for g in user_groups[user_id] if g.get('active', True)]
-        
-        for group in active_groups:
-            if group['name'] == group_name:
-                group['active'] = False
-                await update.message.reply_text(
-                    f"✅ Group '{group['name']}' has been disbanded.\n"
-                    f"You can reactivate it anytime with /activate",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-                context.user_data["disbanding_group"] = False
-                return
+            # Refresh prices
+            await get_stock_prices(group.stocks)
+            
+            await reply(
+                update,
+                f"✅ Group '{group.name}' has been reactivated!\n"
+                f"Prices updated.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+        else:
+            await reply(
+                update,
+                "Group remains disbanded.",
+                reply_markup=ReplyKeyboardRemove()
+            )
         
-        await update.message.reply_text("Invalid selection. Please try again or use /cancel")
+        end_conversation(user_id)
         return
     
-    # Handle group creation flow
-    if context.user_data.get("creating_group"):
-        step = context.user_data.get("group_step")
-        
-        # Step 1: Get group name
-        if step == "name":
-            context.user_data["group_name"] = user_input
-            context.user_data["group_step"] = "select_stocks"
+    # Multiple groups - find and activate selected one
+    group_name = user_input.split(" (")[0].strip()
+    inactive_groups = [g for g in storage.get_groups(user_id) if not g.active]
+    
+    for group in inactive_groups:
+        if group.name == group_name:
+            storage.set_group_active(user_id, group.id, True)
             
-            stocks = user_selected_stocks[user_id]
-            keyboard = [[f"{stock['ticker']} - {stock['name'][:30]}"] for stock in stocks]
-            keyboard.append(["Done selecting"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+            # Refresh prices
+            await get_stock_prices(group.stocks)
             
-            await update.message.reply_text(
-                f"✅ Group name: '{user_input}'\n\n"
-                f"Now select stocks for this group (2-5 stocks).\n"
-                f"Tap each stock you want to add, then tap 'Done selecting'.",
-                reply_markup=reply_markup
+            await reply(
+                update,
+                f"✅ Group '{group.name}' has been reactivated!\n"
+                f"Prices updated.",
+                reply_markup=ReplyKeyboardRemove()
             )
+            end_conversation(user_id)
             return
+    
+    await reply(update, "Invalid selection. Please try again or use /cancel")
+
+async def on_disbanding_group(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    user_id = update.message.from_user.id
+    
+    if user_input == "Cancel":
+        await cancel(update, context)
+        return
+    
+    if user_input in ["Yes, disband it", "No, keep it active"] and conv.target is not None:
+        if user_input == "Yes, disband it":
+            group = conv.target
+            storage.set_group_active(user_id, group.id, False)
+            await reply(
+                update,
+                f"✅ Group '{group.name}' has been disbanded.\n"
+                f"You can reactivate it anytime with /activate",
+                reply_markup=ReplyKeyboardRemove()
+            )
+        else:
+            await reply(
+                update,
+                "Group remains active.",
+                reply_markup=ReplyKeyboardRemove()
+            )
         
-        # Step 2: Select stocks
-        elif step == "select_stocks":
-            if user_input == "Done selecting":
-                selected_stocks = context.user_data.get("group_stocks", [])
-                
-                if len(selected_stocks) < 2:
-                    await update.message.reply_text(
-                        f"❌ You need at least 2 stocks in a group. You've selected {len(selected_stocks)}.\n"
-                        "Please select more stocks."
-                    )
-                    return
-                
-                if len(selected_stocks) > 5:
-                    await update.message.reply_text(
-                        f"❌ Maximum 5 stocks per group. You've selected {len(selected_stocks)}.\n"
-                        "Please create the group with 5 stocks or select fewer."
-                    )
-                    return
-                
-                # Fetch prices for the group
-                tickers = [s['ticker'] for s in selected_stocks]
-                prices = await get_stock_prices(tickers)
-                
-                # Create the group
-                group = {
-                    'name': context.user_data["group_name"],
-                    'stocks': tickers,
-                    'stock_details': selected_stocks,
-                    'prices': prices,
-                    'active': True
-                }
-                
-                user_groups[user_id].append(group)
-                
-                response = f"✅ Group '{group['name']}' created successfully!\n\n"
-                response += f"Stocks: {', '.join(tickers)}\n\n"
-                response += "Prices fetched and tracking started. Use /groups to view details."
-                
-                await update.message.reply_text(response, reply_markup=ReplyKeyboardRemove())
-                
-                # Reset state
-                context.user_data["creating_group"] = False
-                context.user_data["group_step"] = None
-                context.user_data.pop("group_stocks", None)
-                context.user_data.pop("group_name", None)
-                return
-            
-            # Add stock to group
-            selected_ticker = user_input.split(" - ")[0].strip().upper()
-            stocks = user_selected_stocks[user_id]
-            group_stocks = context.user_data.get("group_stocks", [])
-            
-            for stock in stocks:
-                if stock['ticker'] == selected_ticker:
-                    # Check if already added
-                    if any(s['ticker'] == selected_ticker for s in group_stocks):
-                        await update.message.reply_text(
-                            f"⚠️ {selected_ticker} is already in this group!"
-                        )
-                        return
-                    
-                    # Check max limit
-                    if len(group_stocks) >= 5:
-                        await update.message.reply_text(
-                            f"⚠️ Maximum 5 stocks per group reached!"
-                        )
-                        return
-                    
-                    group_stocks.append(stock)
-                    context.user_data["group_stocks"] = group_stocks
-                    
-                    await update.message.reply_text(
-                        f"✅ Added {stock['name']} ({selected_ticker})\n"
-                        f"Total: {len(group_stocks)}/5 stocks selected.\n\n"
-                        f"Continue selecting or tap 'Done selecting'."
-                    )
-                    return
-            
-            await update.message.reply_text("Invalid selection. Please select from the list.")
+        end_conversation(user_id)
+        return
+    
+    # Multiple groups - find and disband selected one
+    group_name = user_input.split(" (")[0].strip()
+    active_groups = [g for g in storage.get_groups(user_id) if g.active]
+    
+    for group in active_groups:
+        if group.name == group_name:
+            storage.set_group_active(user_id, group.id, False)
+            await reply(
+                update,
+                f"✅ Group '{group.name}' has been disbanded.\n"
+                f"You can reactivate it anytime with /activate",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            end_conversation(user_id)
             return
     
-    # Handle deletion confirmation or selection
-    if context.user_data.get("deleting_stock"):
-        if user_input == "Cancel":
-            await cancel(update, context)
+    await reply(update, "Invalid selection. Please try again or use /cancel")
+
+async def on_naming_group(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Step 1 of group creation: get the group name"""
+    user_id = update.message.from_user.id
+    conv.group_name = user_input
+    conv.state = ConvState.SELECTING_GROUP_STOCKS
+    
+    stocks = storage.get_stocks(user_id)
+    keyboard = [[f"{stock.ticker} - {stock.name[:30]}"] for stock in stocks]
+    keyboard.append(["Done selecting"])
+    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    
+    await reply(
+        update,
+        f"✅ Group name: '{user_input}'\n\n"
+        f"Now select stocks for this group (2-5 stocks).\n"
+        f"Tap each stock you want to add, then tap 'Done selecting'.",
+        reply_markup=reply_markup
+    )
+
+async def on_selecting_group_stocks(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Step 2 of group creation: select stocks"""
+    user_id = update.message.from_user.id
+    
+    if user_input == "Done selecting":
+        selected_stocks = conv.group_stocks
+        
+        if len(selected_stocks) < 2:
+            await reply(
+                update,
+                f"❌ You need at least 2 stocks in a group. You've selected {len(selected_stocks)}.\n"
+                "Please select more stocks."
+            )
             return
         
-        if user_input in ["Yes, delete it", "No, keep it"]:
-            if user_input == "Yes, delete it":
-                stock = context.user_data.get("stock_to_delete")
-                user_selected_stocks[user_id].remove(stock)
-                await update.message.reply_text(
-                    f"✅ {stock['name']} ({stock['ticker']}) has been removed from your tracking list.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            else:
-                await update.message.reply_text(
-                    "Stock kept in your tracking list.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            
-            context.user_data["deleting_stock"] = False
-            context.user_data.pop("stock_to_delete", None)
+        if len(selected_stocks) > 5:
+            await reply(
+                update,
+                f"❌ Maximum 5 stocks per group. You've selected {len(selected_stocks)}.\n"
+                "Please create the group with 5 stocks or select fewer."
+            )
             return
         
-        selected_ticker = user_input.split(" - ")[0].strip().upper()
-        stocks = user_selected_stocks[user_id]
+        # Fetch prices for the group
+        tickers = list(selected_stocks)
+        await get_stock_prices(tickers)
         
-        for stock in stocks:
-            if stock['ticker'] == selected_ticker:
-                user_selected_stocks[user_id].remove(stock)
-                await update.message.reply_text(
-                    f"✅ {stock['name']} ({stock['ticker']}) has been removed from your tracking list.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-                context.user_data["deleting_stock"] = False
-                return
+        # Create the group
+        group = Group(conv.group_name, tickers)
+        storage.add_group(user_id, group)
         
-        await update.message.reply_text("Invalid selection. Please try again or use /cancel")
+        response = f"✅ Group '{group.name}' created successfully!\n\n"
+        response += f"Stocks: {', '.join(tickers)}\n\n"
+        response += "Prices fetched and tracking started. Use /groups to view details."
+        
+        await reply(update, response, reply_markup=ReplyKeyboardRemove())
+        
+        end_conversation(user_id)
+        return
+    
+    # Add stock to group
+    selected_ticker = user_input.split(" - ")[0].strip().upper()
+    stock = storage.get_stock(user_id, selected_ticker)
+    group_stocks = conv.group_stocks
+    
+    if stock is None:
+        await reply(update, "Invalid selection. Please select from the list.")
         return
     
-    # Check if user is in "adding stock" mode
-    if not context.user_data.get("adding_stock"):
-        await update.message.reply_text(
-            "Please use /add to start adding a stock, or /help for available commands."
+    # Check if already added
+    if selected_ticker in group_stocks:
+        await reply(
+            update,
+            f"⚠️ {selected_ticker} is already in this group!"
         )
         return
     
-    # Handle ticker selection from keyboard
-    if context.user_data.get("awaiting_choice"):
-        selected_ticker = user_input.split(" - ")[0].strip().upper()
-        possible = context.user_data.get("options", [])
-        
-        for company in possible:
-            if selected_ticker == company["ticker"]:
-                if any(s['ticker'] == company['ticker'] for s in user_selected_stocks[user_id]):
-                    await update.message.reply_text(
-                        f"⚠️ {company['name']} ({company['ticker']}) is already in your tracking list!",
-                        reply_markup=ReplyKeyboardRemove()
-                    )
-                else:
-                    user_selected_stocks[user_id].append(company)
-                    await update.message.reply_text(
-                        f"✅ Stock '{company['name']}' ({company['ticker']}) added to your tracking list!",
-                        reply_markup=ReplyKeyboardRemove()
-                    )
-                
-                context.user_data["awaiting_choice"] = False
-                context.user_data["adding_stock"] = False
-                context.user_data.pop("options", None)
-                return
+    # Check max limit
+    if len(group_stocks) >= 5:
+        await reply(
+            update,
+            f"⚠️ Maximum 5 stocks per group reached!"
+        )
+        return
+    
+    group_stocks[selected_ticker] = stock
+    
+    await reply(
+        update,
+        f"✅ Added {stock.name} ({selected_ticker})\n"
+        f"Total: {len(group_stocks)}/5 stocks selected.\n\n"
+        f"Continue selecting or tap 'Done selecting'."
+    )
+
+async def on_deleting_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Handle deletion confirmation or selection"""
+    user_id = update.message.from_user.id
+    
+    if user_input == "Cancel":
+        await cancel(update, context)
+        return
+    
+    if user_input in ["Yes, delete it", "No, keep it"] and conv.target is not None:
+        if user_input == "Yes, delete it":
+            stock = conv.target
+            storage.remove_stock(user_id, stock.ticker)
+            await reply(
+                update,
+                f"✅ {stock.name} ({stock.ticker}) has been removed from your tracking list.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+        else:
+            await reply(
+                update,
+                "Stock kept in your tracking list.",
+                reply_markup=ReplyKeyboardRemove()
+            )
         
-        await update.message.reply_text("Invalid selection. Please reply with a valid ticker from the options.")
+        end_conversation(user_id)
         return
     
-    # Search for companies
-    matches, error = await search_companies(user_input)
+    selected_ticker = user_input.split(" - ")[0].strip().upper()
+    stock = storage.get_stock(user_id, selected_ticker)
     
-    if error:
-        await update.message.reply_text(error)
+    if stock is None:
+        await reply(update, "Invalid selection. Please try again or use /cancel")
         return
     
+    storage.remove_stock(user_id, stock.ticker)
+    await reply(
+        update,
+        f"✅ {stock.name} ({stock.ticker}) has been removed from your tracking list.",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    end_conversation(user_id)
+
+async def on_choosing_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Handle ticker selection from the search results keyboard"""
+    user_id = update.message.from_user.id
+    selected_ticker = user_input.split(" - ")[0].strip().upper()
+    
+    for company in conv.options:
+        if selected_ticker == company.ticker:
+            if storage.has_stock(user_id, company.ticker):
+                await reply(
+                    update,
+                    f"⚠️ {company.name} ({company.ticker}) is already in your tracking list!",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+            else:
+                storage.add_stock(user_id, company)
+                await reply(
+                    update,
+                    f"✅ Stock '{company.name}' ({company.ticker}) added to your tracking list!",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+            
+            end_conversation(user_id)
+            return
+    
+    await reply(update, "Invalid selection. Please reply with a valid ticker from the options.")
+
+async def on_adding_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, conv, user_input):
+    """Search for companies matching the user's query"""
+    user_id = update.message.from_user.id
+    matches, error = await search_companies(user_input)
+    
     if not matches:
-        await update.message.reply_text(
-            "No matching companies found. Try another search or use /cancel to stop."
+        await reply(
+            update,
+            error or "No matching companies found. Try another search or use /cancel to stop."
         )
         return
     
-    if len(matches) == 1:
+    # Matches that only came from the local index are offered, never added outright
+    if len(matches) == 1 and error is None:
         selected = matches[0]
         
-        if any(s['ticker'] == selected['ticker'] for s in user_selected_stocks[user_id]):
-            await update.message.reply_text(
-                f"⚠️ {selected['name']} ({selected['ticker']}) is already in your tracking list!"
+        if storage.has_stock(user_id, selected.ticker):
+            await reply(
+                update,
+                f"⚠️ {selected.name} ({selected.ticker}) is already in your tracking list!"
             )
         else:
-            user_selected_stocks[user_id].append(selected)
-            await update.message.reply_text(
-                f"✅ Stock '{selected['name']}' ({selected['ticker']}) added to your tracking list!"
+            storage.add_stock(user_id, selected)
+            await reply(
+                update,
+                f"✅ Stock '{selected.name}' ({selected.ticker}) added to your tracking list!"
             )
         
-        context.user_data["adding_stock"] = False
+        end_conversation(user_id)
     else:
         options = matches[:5]
-        context.user_data["awaiting_choice"] = True
-        context.user_data["options"] = options
+        conv.state = ConvState.CHOOSING_STOCK
+        conv.options = options
         
-        keyboard = [[f"{comp['ticker']} - {comp['name'][:40]}"] for comp in options]
+        keyboard = [[f"{comp.ticker} - {comp.name[:40]}"] for comp in options]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
         
-        await update.message.reply_text(
-            "Multiple matches found. Please select one:",
+        await reply(
+            update,
+            error or "Multiple matches found. Please select one:",
             reply_markup=reply_markup
         )
 
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+MESSAGE_HANDLERS = {
+    ConvState.IDLE: on_idle,
+    ConvState.ADDING_STOCK: on_adding_stock,
+    ConvState.CHOOSING_STOCK: on_choosing_stock,
+    ConvState.DELETING_STOCK: on_deleting_stock,
+    ConvState.NAMING_GROUP: on_naming_group,
+    ConvState.SELECTING_GROUP_STOCKS: on_selecting_group_stocks,
+    ConvState.DISBANDING_GROUP: on_disbanding_group,
+    ConvState.ACTIVATING_GROUP: on_activating_group,
+    ConvState.IMPORTING: on_importing,
+}
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route a plain text message to the handler for the user's conversation state"""
+    user_input = update.message.text.strip()
+    conv = conversations.get(update.message.from_user.id)
+    state = conv.state if conv else ConvState.IDLE
+    await MESSAGE_HANDLERS[state](update, context, conv, user_input)
+
+def metric_gauges():
+    """Point-in-time values from the caches, breaker, outbox and indexes, as (name, labels, value)"""
+    gauges = []
+    for cache_name, cache in (('quotes', quote_cache), ('search', search_cache), ('group_blocks', group_block_cache)):
+        for key, value in cache.stats().items():
+            gauges.append((f"cache_{key}", (('cache', cache_name),), value))
+    breaker = upstream_breaker.stats()
+    gauges.append(('upstream_breaker_open', (), int(breaker['state'] != 'closed')))
+    gauges.append(('upstream_breaker_trips', (), breaker['trips']))
+    for key, value in outbox.stats().items():
+        gauges.append((f"outbox_{key}", (), value))
+    for key, value in portfolios.stats().items():
+        gauges.append((f"portfolio_{key}", (), value))
+    for key, value in tick_store.stats().items():
+        gauges.append((f"tick_ring_{key}", (), value))
+    for key, value in upstream_quota.stats().items():
+        gauges.append((f"upstream_quota_{key}", (), value))
+    for key, value in storage.index.stats().items():
+        gauges.append((f"subscriber_index_{key}", (), value))
+    for ticker, count in storage.index.most_held():
+        gauges.append(('subscribers', (('ticker', ticker),), count))
+    for key, value in alert_engine.stats().items():
+        gauges.append((f"alert_engine_{key}", (), value))
+    for key, value in digest_scheduler.stats().items():
+        gauges.append((f"digest_scheduler_{key}", (), value))
+    gauges.append(('conversations', (), len(conversations)))
+    gauges.append(('symbols', (), len(symbols)))
+    return gauges
+
+async def handle_metrics_request(method, path, headers, body):
+    if path != '/metrics':
+        return 404, 'text/plain', b'not found'
+    return 200, 'text/plain; version=0.0.4', metrics.render(metric_gauges()).encode()
+
+def is_admin(update: Update):
+    return update.message.from_user.id in ADMIN_USER_IDS
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only summary of latencies, errors and cache health"""
+    if not is_admin(update):
+        await reply(update, "❌ This command is only available to bot admins.")
+        return
+    
+    response = "📟 Bot stats\n\nLatency (count, p50, p99):\n"
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        label = ','.join(str(v) for _, v in labels)
+        response += (
+            f"• {name.removesuffix('_seconds')}{f' [{label}]' if label else ''}: {histogram.count}, "
+            f"≤{histogram.quantile(0.5) * 1000:g}ms, ≤{histogram.quantile(0.99) * 1000:g}ms\n"
+        )
+    
+    if metrics.counters:
+        response += "\nCounters:\n"
+        for (name, labels), value in sorted(metrics.counters.items()):
+            label = ','.join(str(v) for _, v in labels)
+            response += f"• {name}{f' [{label}]' if label else ''}: {value}\n"
+    
+    quotes = quote_cache.stats()
+    outbox_stats = outbox.stats()
+    portfolio_stats = portfolios.stats()
+    quota_stats = upstream_quota.stats()
+    index_stats = storage.index.stats()
+    alert_stats = alert_engine.stats()
+    digest_stats = digest_scheduler.stats()
+    most_held = ', '.join(f"{ticker} {count}" for ticker, count in storage.index.most_held(5))
+    response += (
+        f"\nQuote cache: {quotes['entries']} entries, {quotes['hits']} hits, {quotes['misses']} misses\n"
+        f"Subscriptions: {index_stats['watches']} watches and {index_stats['group_holdings']} active group holdings "
+        f"on {index_stats['tickers']} tickers{f', most held: {most_held}' if most_held else ''}\n"
+        f"Alerts: {alert_stats['alerts']} pending on {alert_stats['tickers']} tickers, {alert_stats['triggered']} triggered\n"
+        f"Digests: {digest_stats['subscribers']} subscribers, {digest_stats['sent']} sent\n"
+        f"Upstream breaker: {upstream_breaker.state}\n"
+        f"Upstream quota: {quota_stats['queued']} queued, {quota_stats['refused']} answered from cache (see /quota)\n"
+        f"Outbox: {outbox_stats['interactive_depth']} queued, {outbox_stats['sent']} sent, {outbox_stats['failed']} failed\n"
+        f"Portfolios: {portfolio_stats['positions']} positions in {portfolio_stats['groups']} groups, "
+        f"{portfolio_stats['revaluations']} revaluations\n"
+        f"Profiler: {'running' if profiler.running else 'stopped'}"
+    )
+    
+    for page in paginate([response]):
+        await reply(update, page)
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only sampling profiler toggle: /profile start|stop"""
+    if not is_admin(update):
+        await reply(update, "❌ This command is only available to bot admins.")
+        return
+    
+    action = (context.args or ['status'])[0].lower()
+    if action == 'start':
+        profiler.start()
+        await reply(update, f"🔬 Profiler started, sampling every {profiler.interval * 1000:g}ms. Send /profile stop to finish.")
+    elif action == 'stop' and profiler.running:
+        profiler.stop()
+        elapsed = time.monotonic() - profiler.started_at
+        path = f"{PROFILE_OUTPUT}.{worker_index}" if worker_index else PROFILE_OUTPUT
+        with open(path, 'w') as f:
+            f.write(profiler.folded())
+        
+        samples = sum(profiler.stacks.values())
+        response = f"🔬 Profiled {elapsed:.1f}s, {samples} samples written to {path}\n\nHottest frames:\n"
+        for frame, count in profiler.top():
+            response += f"• {count / samples:.1%} {frame}\n"
+        await reply(update, response)
+    else:
+        await reply(update, f"Profiler is {'running' if profiler.running else 'stopped'}.\nUsage: /profile start|stop")
+
+async def quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only view of the upstream budget and the users consuming it: /quota [count]"""
+    if not is_admin(update):
+        await reply(update, "❌ This command is only available to bot admins.")
+        return
+    
+    args = context.args or []
+    count = int(args[0]) if args and args[0].isdigit() else 10
+    
+    quota_stats = upstream_quota.stats()
+    response = (
+        f"🚦 Upstream quota\n\n"
+        f"Budget: {quota_stats['budget_tokens']:.1f}/{upstream_quota.budget.capacity:g} tokens, "
+        f"refilling {upstream_quota.budget.rate:g}/s\n"
+        f"Queued: {quota_stats['queued']}\n"
+        f"Admitted: {quota_stats['admitted']}, answered from cache: {quota_stats['refused']}\n"
+    )
+    
+    consumers = (upstream_quota.admitted + upstream_quota.refused).most_common(count)
+    if consumers:
+        response += f"\nTop {len(consumers)} consumers (admitted, from cache, tokens left):\n"
+        for user_id, _ in consumers:
+            name = "background" if user_id is None else str(user_id)
+            tokens = "" if user_id is None else f", {upstream_quota.user_tokens(user_id):.1f}"
+            response += f"• {name}: {upstream_quota.admitted[user_id]}, {upstream_quota.refused[user_id]}{tokens}\n"
+    
+    for page in paginate([response]):
+        await reply(update, page)
+
+async def save_state(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback that periodically persists caches"""
+    save_warm_state()
+
+metrics_server = None
+
+async def on_startup(app):
+    global metrics_server
+    boot_mark('telegram')
+    outbox.start(app.bot)
+    load_warm_state()
+    boot_mark('warm state')
+    for alert in storage.load_alerts():
+        alert_engine.add(alert)
+    for subscription in storage.load_digests():
+        digest_scheduler.add(subscription)
+    for holding in storage.load_holdings():
+        portfolios.set(holding)
+    boot_mark('subscriptions')
+    if METRICS_PORT:
+        try:
+            metrics_server = await serve_http(METRICS_HOST, METRICS_PORT + worker_index, handle_metrics_request)
+        except OSError as e:
+            print(f"[ERROR] Failed to start metrics endpoint on port {METRICS_PORT + worker_index}: {e}")
+    boot_mark('metrics')
+    print(boot_report())
+    asyncio.get_running_loop().run_in_executor(upstream_executor, preload_modules)
+
+async def on_shutdown(app):
+    if metrics_server is not None:
+        metrics_server.close()
+    profiler.stop()
+    await outbox.stop()
+    if yahoo_http:
+        await yahoo_http.close()
+    upstream_executor.shutdown(wait=False)
+    if simulation_pool is not None:
+        simulation_pool.shutdown(cancel_futures=True)
+    save_warm_state()
+    storage.close()
+
+class OfflineRequest(BaseRequest):
+    """Answers Bot API calls locally, so the bot can be exercised without Telegram"""
+
+    def __init__(self, echo=True):
+        self.echo = echo  # print each message the bot sends
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stock Tracker Bot', 'username': 'offline_stock_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self.message_id += 1
+            if self.echo:
+                print(f"[OFFLINE] {endpoint} to {params.get('chat_id')}:\n{params.get('text', params.get('caption'))}\n")
+            result = {
+                'message_id': params.get('message_id', self.message_id),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        else:
+            if self.echo:
+                print(f"[OFFLINE] {endpoint} {params}")
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+def user_ordered_processor(limit=UPDATE_CONCURRENCY):
+    """Update processor running different users' updates concurrently and each user's in order
+
+    An update waits for its user's earlier ones before taking one of the
+    `limit` slots, so a user with a backlog can't hold slots others need.
+    Built on demand because telegram.ext is only imported with the application.
+    """
+    from telegram.ext import BaseUpdateProcessor
+
+    class UserOrderedProcessor(BaseUpdateProcessor):
+        def __init__(self):
+            super().__init__(UPDATE_MAX_PENDING)
+            self.limit = limit
+            self._running = None
+            self._users = {}  # {user_id: [asyncio.Lock, updates holding or waiting for it]}
+
+        async def initialize(self):
+            self._running = asyncio.Semaphore(self.limit)
+
+        async def shutdown(self):
+            pass
+
+        async def do_process_update(self, update, coroutine):
+            user = getattr(update, 'effective_user', None)
+            if user is None:
+                async with self._running:
+                    await coroutine
+                return
+
+            entry = self._users.get(user.id)
+            if entry is None:
+                entry = self._users[user.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0], self._running:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._users[user.id]
+
+    return UserOrderedProcessor()
+
+def build_application(offline=False, echo=True):
+    from telegram.ext import ApplicationBuilder, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+    
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    builder = builder.concurrent_updates(user_ordered_processor())
+    if offline:
+        builder = builder.request(OfflineRequest(echo)).get_updates_request(OfflineRequest(echo))
+    app = builder.build()
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", start))
@@ -658,8 +4265,403 @@ if __name__ == '__main__':
     app.add_handler(CommandHandler("activate", activate_group))
     app.add_handler(CommandHandler("cancel", cancel))
     app.add_handler(CommandHandler("list", list_stocks))
+    app.add_handler(CommandHandler("alert", set_alert))
+    app.add_handler(CommandHandler("alerts", list_alerts))
+    app.add_handler(CommandHandler("unalert", remove_alert))
+    app.add_handler(CommandHandler("digest", digest))
+    app.add_handler(CommandHandler("hold", hold))
+    app.add_handler(CommandHandler("pnl", pnl))
+    app.add_handler(CommandHandler("import", import_stocks))
+    app.add_handler(CommandHandler("export", export_stocks))
+    app.add_handler(CommandHandler("performance", performance))
+    app.add_handler(CommandHandler("analyze", analyze))
+    app.add_handler(CommandHandler("simulate", simulate))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("profile", profile))
+    app.add_handler(CommandHandler("quota", quota))
     
+    app.add_handler(CallbackQueryHandler(change_page, pattern=r'^page:'))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(filters.Document.ALL, import_document))
+    
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed('handler', handler=handler.callback.__name__)(attributed(handler.callback))
     
+    # Needs python-telegram-bot[job-queue]
+    if app.job_queue:
+        app.job_queue.run_repeating(refresh_group_prices, interval=REFRESH_TICK, first=REFRESH_TICK)
+        app.job_queue.run_repeating(send_digests, interval=DIGEST_TICK, first=DIGEST_TICK)
+        app.job_queue.run_repeating(save_state, interval=WARM_STATE_SAVE_INTERVAL, first=WARM_STATE_SAVE_INTERVAL)
+    else:
+        print("[WARN] Job queue not available, group prices, alerts and digests will not be updated in the background")
+    
+    boot_mark('application')
+    return app
+
+async def serve_http(host, port, handle, reuse_port=False):
+    """Minimal keep-alive HTTP/1.1 server
+
+    handle(method, path, headers, body) returns (status, content_type, body).
+    """
+    reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                path = target.split('?', 1)[0]
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_REQUEST_BODY:
+                    status, content_type, payload = 413, 'text/plain', b'too large'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, payload = await handle(method, path, headers, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+
+                writer.write(
+                    f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port, reuse_port=reuse_port)
+
+def update_user_id(data):
+    """User ID of a raw Update payload, so each user is always routed to the same worker"""
+    for value in data.values():
+        if isinstance(value, dict):
+            for field in ('from', 'user', 'chat'):
+                sender = value.get(field)
+                if isinstance(sender, dict) and 'id' in sender:
+                    return sender['id']
+    return 0
+
+class WebhookServer:
+    """Accepts Telegram updates posted over HTTP and hands the JSON to dispatch(data)"""
+
+    def __init__(self, dispatch, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH):
+        self.dispatch = dispatch
+        self.secret = secret
+        self.path = path
+        self.accepting = True
+        self.received = 0
+        self.rejected = 0
+
+    async def handle(self, method, path, headers, body):
+        if path != self.path:
+            return 404, 'text/plain', b'not found'
+        if method != 'POST':
+            return 405, 'text/plain', b'method not allowed'
+        if self.secret and not hmac.compare_digest(
+            headers.get('x-telegram-bot-api-secret-token', '').encode(), self.secret.encode()
+        ):
+            self.rejected += 1
+            return 403, 'text/plain', b'forbidden'
+        if not self.accepting:
+            return 503, 'text/plain', b'shutting down'
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, 'text/plain', b'invalid json'
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return 400, 'text/plain', b'not an update'
+
+        self.received += 1
+        await self.dispatch(data)
+        return 200, 'text/plain', b'ok'
+
+def wait_for_stop_signal():
+    """Event set on SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_application(app, updates, offline=False, register_webhook=False, ready=None):
+    """Run the application, feeding it updates from the `updates` async iterator until it ends"""
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    if ready is not None:
+        ready.set()
+
+    if register_webhook and WEBHOOK_URL and not offline:
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES)
+
+    try:
+        async for data in updates:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        # Application.stop handles every update still queued before returning
+        try:
+            await asyncio.wait_for(app.stop(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("[ERROR] Timed out waiting for in-flight updates to finish")
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+async def run_webhook(host, port, offline=False):
+    """Serve webhook updates in this process"""
+    inbox = asyncio.Queue()
+
+    async def updates():
+        while (data := await inbox.get()) is not None:
+            yield data
+
+    app = build_application(offline)
+    server = WebhookServer(inbox.put)
+    http = await serve_http(host, port, server.handle)
+    runner = asyncio.create_task(run_application(app, updates(), offline, register_webhook=True))
+    print(f"Stock bot webhook listening on {host}:{port}{WEBHOOK_PATH}")
+
+    await wait_for_stop_signal().wait()
+    server.accepting = False
+    http.close()
+    await inbox.put(None)
+    await runner
+    await http.wait_closed()
+
+async def serve_quotes(path):
+    """Answer quote requests from worker processes out of this process's cache and coalescer
+
+    Requests and replies are JSON lines, {"id", "tickers"} in and {"id", "prices"} out.
+    Each worker already batches its own tickers, this merges batches across workers.
+    """
+    async def answer(request, writer):
+        try:
+            prices = await get_stock_prices(request['tickers'])
+        except Exception as e:
+            print(f"[ERROR] Quote service failed to fetch {len(request['tickers'])} tickers: {e}")
+            prices = {}
+        if not writer.is_closing():
+            writer.write(json.dumps({'id': request['id'], 'prices': prices}).encode() + b'\n')
+
+    async def on_connection(reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                loop.create_task(answer(json.loads(line), writer))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # Workers already wait out a batch window before asking, so don't add a second one
+    price_coalescer.window = 0
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(on_connection, path)
+
+def run_worker(index, count, inbox, offline, quote_socket=None, ready=None, setup=None):
+    """Worker process entry point: handle the updates the front process routes to this shard"""
+    global storage, worker_index, quote_client
+    if setup is not None:
+        setup()
+    storage = open_storage(STORAGE_BACKEND, shard=(index, count))
+    worker_index = index + 1
+    # Workers split what the front process, which fetches every worker's quotes, leaves of the budget
+    upstream_quota.share((1 - UPSTREAM_FRONT_SHARE) / count)
+    if quote_socket:
+        quote_client = QuoteClient(quote_socket)
+    boot_mark('storage')
+
+    async def updates():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            while (data := await loop.run_in_executor(reader, inbox.get)) is not None:
+                yield data
+
+    # The front process decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_application(build_application(offline), updates(), offline, ready=ready))
+
+class WorkerPool:
+    """Worker processes that each own the users hashed to them, fed by the front process
+
+    The front process also runs the quote service, so a ticker watched by users on
+    several shards is still fetched from Yahoo once.
+    """
+
+    def __init__(self, count, offline=False, setup=None):
+        self.count = count
+        self.offline = offline
+        self.setup = setup  # called first thing in each worker, e.g. to install a fake backend
+        self.quote_socket = QUOTE_SERVICE_SOCKET or os.path.join(
+            tempfile.gettempdir(), f"stockbot-quotes-{os.getpid()}.sock"
+        )
+        # Spawned rather than forked: a forked worker would inherit executors whose threads didn't come along
+        self.context = multiprocessing.get_context('spawn')
+        self.inboxes = [self.context.Queue() for _ in range(count)]
+        self.ready = [self.context.Event() for _ in range(count)]
+        self.workers = []
+        self.quote_server = None
+        self.dispatched = 0
+
+    async def start(self):
+        if STORAGE_BACKEND == 'sqlite':
+            SQLiteStorage.prepare()
+        for i in range(self.count):
+            worker = self.context.Process(
+                target=run_worker,
+                args=(i, self.count, self.inboxes[i], self.offline, self.quote_socket, self.ready[i], self.setup),
+                name=f'worker-{i}',
+            )
+            worker.start()
+            self.workers.append(worker)
+        upstream_quota.share(UPSTREAM_FRONT_SHARE)
+        # Workers connect on their first quote fetch, after this is listening
+        self.quote_server = await serve_quotes(self.quote_socket)
+
+    async def wait_ready(self):
+        """Wait until every worker has started its application"""
+        loop = asyncio.get_running_loop()
+        for event in self.ready:
+            await loop.run_in_executor(None, event.wait)
+
+    def dispatch(self, data):
+        self.inboxes[user_shard(update_user_id(data), self.count)].put(data)
+        self.dispatched += 1
+
+    async def stop(self):
+        """Let each worker finish what it was sent, then close the quote service"""
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.join, SHUTDOWN_DRAIN_TIMEOUT + 5)
+            if worker.is_alive():
+                worker.terminate()
+
+        self.quote_server.close()
+        await self.quote_server.wait_closed()
+        if os.path.exists(self.quote_socket):
+            os.unlink(self.quote_socket)
+
+async def run_webhook_workers(host, port, count, offline=False):
+    """Serve webhook updates, routing each user to one of `count` worker processes"""
+    pool = WorkerPool(count, offline)
+    await pool.start()
+
+    async def dispatch(data):
+        pool.dispatch(data)
+
+    server = WebhookServer(dispatch)
+    http = await serve_http(host, port, server.handle)
+    print(f"Stock bot webhook listening on {host}:{port}{WEBHOOK_PATH} with {count} workers")
+
+    # Only the front process talks to Telegram about the webhook itself
+    if WEBHOOK_URL and not offline:
+        app = build_application()
+        async with app:
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES)
+
+    await wait_for_stop_signal().wait()
+    server.accepting = False
+    http.close()
+    await pool.stop()
+    await http.wait_closed()
+
+async def run_polling_workers(count):
+    """Long-poll Telegram in this process, routing each user to one of `count` worker processes"""
+    from telegram import Bot
+
+    pool = WorkerPool(count)
+    await pool.start()
+    stop = wait_for_stop_signal()
+    print(f"Stock bot polling with {count} workers...")
+
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while not stop.is_set():
+            poll = asyncio.ensure_future(bot.get_updates(
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES,
+                read_timeout=POLL_TIMEOUT + 10,
+            ))
+            await asyncio.wait([poll, asyncio.ensure_future(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                # Unacknowledged updates are redelivered on the next start
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                print(f"[ERROR] Failed to poll for updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                pool.dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+        # Acknowledge what was dispatched, so it isn't handled twice after a restart
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0)
+            except Exception as e:
+                print(f"[ERROR] Failed to acknowledge updates: {e}")
+
+    await pool.stop()
+
+def main():
+    global storage
+    parser = argparse.ArgumentParser(description="Stock Tracker Telegram bot")
+    parser.add_argument('--webhook', action='store_true', help="receive updates over HTTP instead of polling")
+    parser.add_argument('--host', default=WEBHOOK_HOST)
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help="worker processes, users are sharded across them")
+    parser.add_argument('--offline', action='store_true',
+                        help="don't contact Telegram; bot API calls are printed instead (post recorded updates to the webhook)")
+    args = parser.parse_args()
+
+    if args.webhook and args.workers > 1:
+        asyncio.run(run_webhook_workers(args.host, args.port, args.workers, args.offline))
+        return
+    if args.workers > 1:
+        if args.offline:
+            parser.error("there is nothing to poll offline, use --webhook to post recorded updates to the workers")
+        asyncio.run(run_polling_workers(args.workers))
+        return
+
+    storage = open_storage()
+    boot_mark('storage')
+    if args.webhook:
+        asyncio.run(run_webhook(args.host, args.port, args.offline))
+        return
+
+    app = build_application(args.offline)
     print("Stock bot with Yahoo Finance is running...")
     app.run_polling()
+
+boot_mark('module')
+
+if __name__ == '__main__':
+    main()
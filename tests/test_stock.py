@@ -0,0 +1,642 @@
+import asyncio
+import pickle
+
+import pytest
+
+import stock
+
+
+def run(coro, timeout=5):
+    return asyncio.run(asyncio.wait_for(coro, timeout))
+
+
+def fake_upstream(monkeypatch, calls):
+    async def call_upstream(fn):
+        calls.append(fn)
+        await asyncio.sleep(0)
+        return {}  # what yahooquery returns when nothing was found
+    monkeypatch.setattr(stock, 'call_upstream', call_upstream)
+
+
+def test_null_quote_fields_read_as_zero(monkeypatch):
+    async def call_upstream(fn):
+        return {
+            'HALT': {'regularMarketPrice': 12.5, 'currency': None, 'regularMarketChange': None, 'regularMarketChangePercent': None},
+            'PRE': {'regularMarketPrice': None},
+        }
+    monkeypatch.setattr(stock, 'yahoo_http', None)
+    monkeypatch.setattr(stock, 'call_upstream', call_upstream)
+
+    prices = run(stock.fetch_quotes(['HALT', 'PRE']))
+    assert prices == {'HALT': {'price': 12.5, 'currency': 'USD', 'change': 0, 'change_percent': 0}}
+
+
+def test_yahoo_http_reads_null_quote_fields_as_zero():
+    class Response:
+        status = 200
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        def raise_for_status(self):
+            pass
+
+        async def json(self):
+            quote = {'symbol': 'HALT', 'regularMarketPrice': 12.5, 'regularMarketChange': None, 'regularMarketChangePercent': None}
+            return {'quoteResponse': {'result': [quote]}}
+
+    yahoo = stock.YahooHTTP()
+    yahoo._session = type('Session', (), {'closed': False, 'get': lambda self, url, **kwargs: Response()})()
+    yahoo._crumb = 'crumb'
+    assert run(yahoo.price(['HALT']))['HALT'] == {
+        'regularMarketPrice': 12.5, 'currency': 'USD', 'regularMarketChange': 0, 'regularMarketChangePercent': 0,
+    }
+
+
+def test_sqlite_users_are_preloaded_off_the_event_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / 'bot.db')
+    storage = stock.SQLiteStorage(path)
+    storage.add_stock(1, stock.Symbol('AAPL', 'Apple Inc.', 'NASDAQ'))
+    storage.add_group(1, stock.Group('Core', ['AAPL', 'MSFT'], id='g1'))
+    storage.flush()
+    storage.close()
+
+    storage = stock.SQLiteStorage(path)
+    monkeypatch.setattr(storage, '_load_user', lambda user_id: pytest.fail('loaded on the event loop'))
+    run(storage.preload([1, 2]))
+    assert [s.ticker for s in storage.get_stocks(1)] == ['AAPL']
+    assert [(g.id, g.stocks) for g in storage.get_groups(1)] == [('g1', ('AAPL', 'MSFT'))]
+    assert storage.get_stocks(2) == [] and storage.get_groups(2) == []
+    storage.close()
+
+
+def test_history_sync_takes_each_lock_once(tmp_path, monkeypatch):
+    calls = []
+    fake_upstream(monkeypatch, calls)
+    store = stock.HistoryStore(str(tmp_path))
+
+    run(store.sync(['SPY', 'AAPL', 'SPY']))
+    assert len(calls) == 1
+
+
+
+class FakeMessage:
+    def __init__(self, user_id, text):
+        self.from_user = type('User', (), {'id': user_id})()
+        self.chat_id = user_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+
+def fake_update(user_id, text):
+    update = type('Update', (), {})()
+    update.message = update.effective_message = FakeMessage(user_id, text)
+    update.effective_user = update.message.from_user
+    update.callback_query = None
+    return update
+
+
+def store_bars(store, ticker, closes, start=None):
+    start = start or stock.time.time() - len(closes) * 86400
+    ts = stock.np.arange(len(closes)) * 86400.0 + (start // 86400) * 86400
+    closes = stock.np.asarray(closes, dtype=float)
+    store._append(ticker, '1d', stock.np.vstack([ts, closes, closes, closes, closes, stock.np.ones(len(closes))]))
+
+
+def test_history_appends_segments_and_merges_them(tmp_path, monkeypatch):
+    monkeypatch.setattr(stock, 'HISTORY_MAX_SEGMENTS', 2)
+    store = stock.HistoryStore(str(tmp_path))
+    day = 86400
+    store_bars(store, 'AAPL', [1.0, 2.0], start=100 * day)
+    first = (tmp_path / 'AAPL.1d.npy').stat().st_ino
+
+    # Each append repeats the last stored bar, which is dropped
+    store_bars(store, 'AAPL', [2.0, 3.0], start=101 * day)
+    store_bars(store, 'AAPL', [3.0, 4.0], start=102 * day)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['AAPL.1d.1.npy', 'AAPL.1d.2.npy', 'AAPL.1d.npy']
+    assert (tmp_path / 'AAPL.1d.npy').stat().st_ino == first
+
+    store_bars(store, 'AAPL', [4.0, 5.0], start=103 * day)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['AAPL.1d.npy']
+
+    store_bars(store, 'AAPL', [6.0], start=105 * day)
+    assert list(stock.HistoryStore(str(tmp_path)).load('AAPL')[store.CLOSE]) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+
+def test_analyze_benchmark_in_group(tmp_path, monkeypatch):
+    store = stock.HistoryStore(str(tmp_path))
+    rng = stock.np.random.default_rng(1)
+    for ticker in ('AAPL', 'SPY'):
+        store_bars(store, ticker, 100 * stock.np.cumprod(1 + rng.normal(0, 0.01, 60)))
+        store._synced_at[(ticker, '1d')] = stock.time.time()
+
+    synced = []
+    real_sync = store.sync
+
+    async def sync(tickers, interval='1d'):
+        synced.append(list(tickers))
+        await real_sync(tickers, interval)
+
+    monkeypatch.setattr(store, 'sync', sync)
+    monkeypatch.setattr(stock, 'history_store', store)
+    monkeypatch.setattr(stock, 'storage', stock.MemoryStorage())
+    stock.storage.add_group(7, stock.Group('Core', ['SPY', 'AAPL']))
+
+    update = fake_update(7, '/analyze Core 3m')
+    context = type('Context', (), {'args': ['Core', '3m'], 'user_data': {}})()
+    run(stock.analyze(update, context))
+
+    assert synced == [['AAPL', 'SPY']]
+    response = update.message.replies[-1]
+    assert 'vs SPY' in response
+    assert '• SPY:' in response and 'β 1.00' in response
+
+
+def fake_search(monkeypatch, quotes):
+    async def call_upstream(fn):
+        if quotes is None:
+            raise ConnectionError('Yahoo is down')
+        return {'quotes': quotes}
+    monkeypatch.setattr(stock, 'yahoo_http', None)
+    monkeypatch.setattr(stock, 'call_upstream', call_upstream)
+    monkeypatch.setattr(stock, 'search_cache', stock.TTLCache(60, 100))
+    monkeypatch.setattr(stock, 'symbol_index', stock.SymbolIndex())
+    monkeypatch.setattr(stock, 'storage', stock.MemoryStorage())
+    stock.symbol_index.add(stock.intern_symbol('APLE', 'Apple Hospitality REIT', 'NYSE'))
+
+
+def add_by_search(text):
+    update = fake_update(11, text)
+    conv = stock.start_conversation(11, stock.ConvState.ADDING_STOCK)
+    run(stock.on_adding_stock(update, None, conv, text))
+    return update.message.replies[-1], conv
+
+
+def test_search_asks_yahoo_before_the_local_index(monkeypatch):
+    fake_search(monkeypatch, [{'symbol': 'AAPL', 'shortname': 'Apple Inc.', 'exchDisp': 'NASDAQ'}])
+
+    response, _ = add_by_search('apple')
+    assert 'AAPL' in response
+    assert [s.ticker for s in stock.storage.get_stocks(11)] == ['AAPL']
+
+
+def test_local_index_matches_are_offered_not_added(monkeypatch):
+    fake_search(monkeypatch, None)
+
+    response, conv = add_by_search('apple')
+    assert response == stock.LOCAL_MATCHES_MESSAGE
+    assert conv.state == stock.ConvState.CHOOSING_STOCK
+    assert [s.ticker for s in conv.options] == ['APLE']
+    assert stock.storage.get_stocks(11) == []
+
+
+def test_subscriber_index_counts_each_user_once_per_ticker():
+    storage = stock.MemoryStorage()
+    storage.add_stock(1, stock.Symbol('AAPL', 'Apple Inc.', 'NASDAQ'))
+    storage.add_stock(2, stock.Symbol('AAPL', 'Apple Inc.', 'NASDAQ'))
+    storage.add_group(1, stock.Group('Core', ['AAPL', 'MSFT']))
+    storage.add_group(3, stock.Group('Cars', ['TSLA'], active=False))
+
+    assert storage.index.most_held() == [('AAPL', 2), ('MSFT', 1)]
+    assert storage.index.stats() == {'tickers': 2, 'watches': 2, 'group_holdings': 2}
+
+
+def test_known_tickers_and_names_are_answered_locally(monkeypatch):
+    fake_search(monkeypatch, [{'symbol': 'FORD', 'shortname': 'Forward Industries', 'exchDisp': 'NASDAQ'}])
+    asked = []
+    answer = stock.call_upstream
+
+    async def call_upstream(fn):
+        asked.append(fn)
+        return await answer(fn)
+    monkeypatch.setattr(stock, 'call_upstream', call_upstream)
+
+    assert run(stock.search_companies('APLE')) == ([stock.symbols['APLE']], None)
+    assert run(stock.search_companies('apple hospitality reit')) == ([stock.symbols['APLE']], None)
+    assert asked == []
+
+    run(stock.search_companies('aple'))
+    run(stock.search_companies('ford'))
+    assert len(asked) == 2
+    symbol, _, _ = run(stock.resolve_import_entry('FORD', asyncio.Semaphore(1)))
+    assert symbol.ticker == 'FORD' and len(asked) == 2
+
+
+def test_price_line_shows_change_as_percent():
+    line = stock.format_price_line('AAPL', {'price': 101.5, 'currency': 'USD', 'change': 1.23, 'change_percent': 0.0123})
+    assert line == "• AAPL: USD 101.50 📈 (1.23%)\n"
+
+    line = stock.format_price_line('HALT', {'price': 12.5, 'currency': 'USD', 'change': None, 'change_percent': None})
+    assert line == "• HALT: USD 12.50 📈 (0.00%)\n"
+
+
+def test_quota_interleaves_queued_users():
+    quota = stock.UpstreamQuota(rate=100, burst=1)
+    admitted = []
+
+    async def call(user_id):
+        await quota.acquire(user_id)
+        admitted.append(user_id)
+
+    async def scenario():
+        await call(1)  # spends the burst, so the rest queue
+        calls = [asyncio.ensure_future(call(1)) for _ in range(6)]
+        calls += [asyncio.ensure_future(call(2)) for _ in range(2)]
+        await asyncio.gather(*calls)
+    run(scenario())
+
+    assert admitted == [1, 1, 2, 1, 2, 1, 1, 1, 1]
+    assert quota.admitted == {1: 7, 2: 2}
+
+
+def test_quota_refuses_spent_users_but_not_patient_calls(monkeypatch):
+    monkeypatch.setattr(stock, 'USER_UPSTREAM_BURST', 2)
+    quota = stock.UpstreamQuota(rate=1000, burst=1000)
+
+    async def scenario():
+        await quota.acquire(1)
+        await quota.acquire(1)
+        try:
+            await quota.acquire(1)
+        except stock.QuotaExceeded:
+            pass
+        else:
+            raise AssertionError('third lookup should be refused')
+        await quota.acquire(1, patient=True)
+    run(scenario())
+
+    assert quota.refused == {1: 1}
+    assert quota.admitted == {1: 3}
+
+
+def test_import_costs_the_user_one_token(monkeypatch):
+    fake_search(monkeypatch, [{'symbol': 'AAPL', 'shortname': 'Apple Inc.', 'exchDisp': 'NASDAQ'}])
+    monkeypatch.setattr(stock, 'upstream_quota', stock.UpstreamQuota())
+
+    update = fake_update(11, '/import')
+    run(stock.import_entries(update, 'apple, apples, apple computer'))
+    assert 'Added 1: AAPL' in update.message.replies[-1]
+    assert stock.USER_UPSTREAM_BURST - 1 <= stock.upstream_quota.user_tokens(11) < stock.USER_UPSTREAM_BURST - 0.5
+
+    stock.upstream_quota._users[11].tokens = 0
+    run(stock.import_entries(update, 'microsoft'))
+    assert update.message.replies[-1] == stock.QUOTA_EXCEEDED_MESSAGE
+
+
+def make_alert(alert_id, ticker, kind, threshold):
+    return {'id': alert_id, 'user_id': 1, 'ticker': ticker, 'kind': kind, 'threshold': threshold}
+
+
+def test_alerts_fire_once_when_crossed(monkeypatch):
+    monkeypatch.setattr(stock, 'storage', stock.MemoryStorage())
+    monkeypatch.setattr(stock, 'outbox', stock.Outbox())
+    engine = stock.AlertEngine()
+    for alert in (
+        make_alert('a1', 'AAPL', 'above', 110), make_alert('a2', 'AAPL', 'above', 120),
+        make_alert('b1', 'AAPL', 'below', 90), make_alert('b2', 'AAPL', 'below', 80),
+        make_alert('m1', 'AAPL', 'move', 3), make_alert('x1', 'MSFT', 'above', 1),
+    ):
+        engine.add(alert)
+
+    def tick(price, change_percent=0.0):
+        before = set(engine.alerts)
+        engine.on_prices({'AAPL': {'price': price, 'currency': 'USD', 'change': 0, 'change_percent': change_percent}})
+        return before - set(engine.alerts)
+
+    assert tick(100) == set()
+    assert tick(110) == {'a1'}
+    assert tick(110) == set()
+    assert tick(85, -0.035) == {'b1', 'm1'}
+    assert tick(125) == {'a2'}
+    assert set(engine.alerts) == {'b2', 'x1'}
+    assert engine.tickers() == {'AAPL', 'MSFT'}
+    assert engine.stats()['triggered'] == 4
+    assert len(stock.outbox._bulk[1]) == 1 and stock.outbox.merged == 3
+
+
+def test_alert_description_survives_a_null_change():
+    alert = make_alert('a1', 'HALT', 'above', 10)
+    text = stock.describe_alert(alert, {'price': 12.5, 'currency': 'USD', 'change': None, 'change_percent': None})
+    assert text.endswith("Now USD 12.50 (+0.00%)")
+
+
+def test_digest_slots_pop_due_users_and_reschedule():
+    scheduler = stock.DigestScheduler()
+    monday = stock.datetime(2026, 10, 12, 8, 0, tzinfo=stock.timezone.utc).timestamp()
+    for user_id in (1, 2):
+        scheduler.add({'user_id': user_id, 'kind': 'daily', 'minute': 9 * 60, 'timezone': 'UTC'}, monday)
+    scheduler.add({'user_id': 3, 'kind': 'daily', 'minute': 10 * 60, 'timezone': 'UTC'}, monday)
+    assert scheduler.stats()['slots'] == 2
+
+    assert scheduler.pop_due(monday + 59 * 60) == []
+    assert sorted(scheduler.pop_due(monday + 60 * 60 + 30)) == [1, 2]
+    assert scheduler.pop_due(monday + 60 * 60 + 45) == []
+
+    scheduler.remove(3)
+    assert scheduler.pop_due(monday + 3 * 3600) == []
+    assert sorted(scheduler.pop_due(monday + 25 * 3600)) == [1, 2]
+    assert scheduler.stats() == {'subscribers': 2, 'slots': 1, 'sent': 0}
+
+
+def test_close_digest_skips_the_weekend():
+    friday_evening = stock.datetime(2026, 10, 16, 17, 0, tzinfo=stock.MARKET_TZ).timestamp()
+    digest = {'user_id': 1, 'kind': 'close', 'minute': stock.DIGEST_CLOSE_MINUTE, 'timezone': stock.MARKET_TZ.key}
+    at = stock.datetime.fromtimestamp(stock.next_digest_time(digest, friday_evening), stock.MARKET_TZ)
+    assert (at.weekday(), at.hour, at.minute) == (0, 16, 5)
+
+
+def test_portfolio_totals_follow_price_ticks(monkeypatch):
+    monkeypatch.setattr(stock, 'latest_prices', {'AAPL': {'price': 100.0, 'currency': 'USD', 'change': 2.0}})
+    portfolios = stock.Portfolios()
+    portfolios.set({'group_id': 'g', 'user_id': 1, 'ticker': 'AAPL', 'quantity': 10, 'cost': 90.0})
+    portfolios.set({'group_id': 'g', 'user_id': 1, 'ticker': 'MSFT', 'quantity': 2, 'cost': 300.0})
+
+    totals = portfolios.group('g')
+    assert (totals.value, totals.cost, totals.day_change, totals.unpriced) == (1000.0, 900.0, 20.0, 1)
+
+    portfolios.on_prices({'MSFT': {'price': 310.0, 'currency': 'USD', 'change': -5.0}})
+    portfolios.on_prices({'AAPL': {'price': 105.0, 'currency': 'USD', 'change': 7.0}})
+    assert (totals.value, totals.cost, totals.day_change, totals.unpriced) == (1670.0, 1500.0, 60.0, 0)
+
+    stock.latest_prices['AAPL'] = {'price': 105.0, 'currency': 'USD', 'change': 7.0}
+    portfolios.set({'group_id': 'g', 'user_id': 1, 'ticker': 'AAPL', 'quantity': 4, 'cost': 95.0})
+    assert (totals.value, totals.cost, totals.day_change) == (1040.0, 980.0, 18.0)
+
+    portfolios.remove('g', 'MSFT')
+    portfolios.remove('g', 'AAPL')
+    assert portfolios.group('g') is None
+    assert portfolios.stats()['tickers'] == 0
+
+
+def test_tick_ring_wraps_and_starts_over_each_session(monkeypatch):
+    monkeypatch.setattr(stock, 'TICK_SAMPLE_INTERVAL', 60)
+    ring = stock.TickRing(size=5)
+    for i in range(7):
+        ring.append(1000 + i * 60, float(i), session=1)
+    assert list(ring.values()) == [2.0, 3.0, 4.0, 5.0, 6.0]
+
+    ring.append(1000 + 6 * 60 + 10, 6.5, session=1)  # inside the interval, replaces the last sample
+    assert list(ring.values()) == [2.0, 3.0, 4.0, 5.0, 6.5]
+
+    ring.append(90000, 7.0, session=2)
+    assert list(ring.values()) == [7.0]
+
+
+def test_price_coalescer_shares_one_call_per_window():
+    fetched = []
+    release = asyncio.Event()
+
+    async def fetch(tickers):
+        fetched.append(sorted(tickers))
+        await release.wait()
+        return {t: {'price': 1.0} for t in tickers if t != 'GONE'}
+
+    coalescer = stock.PriceCoalescer(fetch, window=0.01)
+
+    async def scenario():
+        first = [asyncio.ensure_future(coalescer.get(t)) for t in (['AAPL', 'MSFT'], ['MSFT', 'GONE'], ['AAPL'])]
+        while not fetched:
+            await asyncio.sleep(0.005)
+        # Tickers already being fetched join that call, new ones wait for the next window
+        second = asyncio.ensure_future(coalescer.get(['AAPL', 'TSLA']))
+        await asyncio.sleep(0.03)
+        release.set()
+        return await asyncio.gather(*first), await second
+    first, second = run(scenario())
+
+    assert fetched == [['AAPL', 'GONE', 'MSFT'], ['TSLA']]
+    assert first == [{'AAPL': {'price': 1.0}, 'MSFT': {'price': 1.0}}, {'MSFT': {'price': 1.0}}, {'AAPL': {'price': 1.0}}]
+    assert second == {'AAPL': {'price': 1.0}, 'TSLA': {'price': 1.0}}
+    assert coalescer.stats() == {'requests': 4, 'batches': 2, 'pending': 0}
+
+
+def test_warm_state_round_trips_and_ignores_old_pickles(tmp_path, monkeypatch):
+    monkeypatch.setattr(stock, 'quote_cache', stock.TTLCache(60, 100))
+    monkeypatch.setattr(stock, 'search_cache', stock.TTLCache(60, 100))
+    monkeypatch.setattr(stock, 'symbol_index', stock.SymbolIndex())
+    monkeypatch.setattr(stock, 'latest_prices', {})
+    apple = stock.intern_symbol('AAPL', 'Apple Inc.', 'NASDAQ')
+    stock.search_cache.set('apple', [apple])
+    stock.quote_cache.set('AAPL', {'price': stock.np.float64(101.5), 'currency': 'USD', 'change': None, 'change_percent': 0.01})
+    path = str(tmp_path / 'warm_state.bin')
+    stock.save_warm_state(path)
+
+    monkeypatch.setattr(stock, 'quote_cache', stock.TTLCache(60, 100))
+    monkeypatch.setattr(stock, 'search_cache', stock.TTLCache(60, 100))
+    stock.load_warm_state(path)
+    assert stock.search_cache.get('apple') == [apple]
+    assert stock.quote_cache.get('AAPL') == {'price': 101.5, 'currency': 'USD', 'change': 0.0, 'change_percent': 0.01}
+    assert stock.symbol_index.known('apple inc.') is apple
+
+    with open(path, 'wb') as f:
+        pickle.dump({'version': 1, 'symbols': [('EVIL', 'Evil Corp', '')]}, f)
+    monkeypatch.setattr(stock, 'quote_cache', stock.TTLCache(60, 100))
+    stock.load_warm_state(path)
+    assert stock.quote_cache.get('AAPL') is None and 'EVIL' not in stock.symbols
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(stock.time, 'time', lambda: now[0])
+    cache = stock.TTLCache(ttl=30, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('c') == 3
+
+    now[0] += 31
+    assert cache.get('a') is None
+    assert cache.get('a', max_age=60) == 1
+    assert cache.get_stale('c') == 3
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 2, 'evictions': 1}
+
+
+def test_refresher_fetches_due_tickers_of_active_groups_and_alerts(monkeypatch):
+    monkeypatch.setattr(stock, 'storage', stock.MemoryStorage())
+    monkeypatch.setattr(stock, 'alert_engine', stock.AlertEngine())
+    monkeypatch.setattr(stock, 'next_refresh_at', {'GONE': 0})
+    monkeypatch.setattr(stock, 'REFRESH_BATCH_SIZE', 2)
+    monkeypatch.setattr(stock, 'is_market_open', lambda: True)
+    fetched = []
+
+    async def get_stock_prices(tickers, max_age=None):
+        fetched.append((tickers, max_age))
+        return {}
+    monkeypatch.setattr(stock, 'get_stock_prices', get_stock_prices)
+
+    core = stock.Group('Core', ['MSFT', 'AAPL'])
+    stock.storage.add_group(1, core)
+    stock.storage.add_group(1, stock.Group('Cars', ['TSLA'], active=False))
+    stock.alert_engine.add(make_alert('n1', 'NVDA', 'above', 200))
+
+    run(stock.refresh_group_prices(None))
+    assert fetched == [(['AAPL', 'MSFT'], stock.REFRESH_INTERVAL_OPEN), (['NVDA'], stock.REFRESH_INTERVAL_OPEN)]
+    assert sorted(stock.next_refresh_at) == ['AAPL', 'MSFT', 'NVDA']
+
+    # Nothing is due again until the interval has passed, and a disbanded group adds no load
+    stock.storage.set_group_active(1, core.id, False)
+    run(stock.refresh_group_prices(None))
+    assert len(fetched) == 2
+    assert list(stock.next_refresh_at) == ['NVDA']
+
+    stock.next_refresh_at['NVDA'] = 0
+    monkeypatch.setattr(stock, 'is_market_open', lambda: False)
+    run(stock.refresh_group_prices(None))
+    assert fetched[-1] == (['NVDA'], stock.REFRESH_INTERVAL_CLOSED)
+
+
+def test_outbox_keeps_chat_order_and_requeues_after_retry_after(monkeypatch):
+    for name in ('SEND_GLOBAL_RATE', 'SEND_CHAT_RATE', 'SEND_CHAT_BURST'):
+        monkeypatch.setattr(stock, name, 1000)
+    outbox = stock.Outbox()
+    delivered = []
+    refused = []
+
+    def sender(chat_id):
+        async def send(text):
+            await asyncio.sleep(0.01)
+            if text == 'a1' and not refused:
+                refused.append(text)
+                raise stock.RetryAfter(stock.timedelta(seconds=0.05))
+            delivered.append(text)
+            return text
+        return send
+
+    async def scenario():
+        outbox.start(None)
+        sends = [outbox.send(1, sender(1), text) for text in ('a1', 'a2', 'a3')]
+        sends += [outbox.send(2, sender(2), text) for text in ('b1', 'b2')]
+        results = await asyncio.gather(*sends)
+        await outbox.stop()
+        return results
+    results = run(scenario())
+
+    assert results == ['a1', 'a2', 'a3', 'b1', 'b2']
+    assert [t for t in delivered if t[0] == 'a'] == ['a1', 'a2', 'a3']
+    # Only the chat that got the 429 waited
+    assert delivered.index('b2') < delivered.index('a1')
+    assert outbox.stats()['retries'] == 1 and outbox.stats()['sent'] == 5
+
+
+def test_breaker_opens_half_opens_and_closes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(stock.time, 'monotonic', lambda: now[0])
+    breaker = stock.CircuitBreaker(threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    now[0] += 30
+    assert breaker.state == 'half-open'
+    assert breaker.allow()  # the trial call
+    assert not breaker.allow()  # the rest wait for it
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    now[0] += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+    assert breaker.stats() == {'state': 'closed', 'failures': 0, 'trips': 1}
+
+
+def test_conversation_states_route_messages_and_end_cleanly(monkeypatch):
+    monkeypatch.setattr(stock, 'storage', stock.MemoryStorage())
+    monkeypatch.setattr(stock, 'conversations', {})
+
+    async def get_stock_prices(tickers, max_age=None):
+        return {}
+    monkeypatch.setattr(stock, 'get_stock_prices', get_stock_prices)
+    for ticker, name in (('AAPL', 'Apple Inc.'), ('MSFT', 'Microsoft')):
+        stock.storage.add_stock(5, stock.Symbol(ticker, name, 'NASDAQ'))
+
+    def say(text, handler=stock.handle_message):
+        update = fake_update(5, text)
+        run(handler(update, None))
+        conv = stock.conversations.get(5)
+        return conv.state if conv else None
+
+    assert say('/creategroup', stock.create_group) == stock.ConvState.NAMING_GROUP
+    assert say('Tech') == stock.ConvState.SELECTING_GROUP_STOCKS
+    assert say('AAPL - Apple Inc.') == stock.ConvState.SELECTING_GROUP_STOCKS
+    assert say('Done selecting') == stock.ConvState.SELECTING_GROUP_STOCKS  # one stock isn't a group
+    assert say('MSFT - Microsoft') == stock.ConvState.SELECTING_GROUP_STOCKS
+    assert say('Done selecting') is None
+    assert [(g.name, g.stocks) for g in stock.storage.get_groups(5)] == [('Tech', ('AAPL', 'MSFT'))]
+
+    assert say('/creategroup', stock.create_group) == stock.ConvState.NAMING_GROUP
+    assert say('/cancel', stock.cancel) is None
+    assert stock.conversations == {}
+
+
+def test_paginate_counts_utf16_units_and_keeps_chunks_whole():
+    line = "• AAPL 📈\n"
+    assert stock.message_length(line) == 10  # the emoji takes two UTF-16 units
+    pages = stock.paginate([line] * 25, limit=100)
+    assert [stock.message_length(p) for p in pages] == [100, 100, 50]
+    assert ''.join(pages) == line * 25
+
+    long = "📈" * 120  # 240 units in one chunk
+    pages = stock.paginate(["head\n", long], limit=100)
+    assert ''.join(pages) == "head\n" + long
+    assert all(stock.message_length(p) <= 100 for p in pages)
+
+
+def test_import_parses_lists_csv_and_json_including_malformed_rows():
+    parse = stock.parse_import_entries
+    assert parse("AAPL, msft\nTesla;aapl\n\n  Apple Inc.  ") == ['AAPL', 'msft', 'Tesla', 'Apple Inc.']
+
+    csv_text = (
+        "Symbol,Shares,Price\n"
+        "AAPL,10,190.5\n"
+        "\n"
+        "MSFT\n"  # short row
+        ",5,1\n"  # no symbol
+        '"BRK,B",1,2,extra\n'  # quoted comma and a stray column
+        "nvda,3%\n"
+    )
+    assert parse(csv_text) == ['AAPL', 'MSFT', 'BRK,B', 'nvda']
+    assert parse("AAPL,12.5,-3%,1e3\n") == ['AAPL']  # numbers are never entries
+
+    json_text = '[{"ticker": "AAPL", "name": "Apple Inc."}, {"name": "Tesla"}, "MSFT", 42, null, {"shares": 3}, "aapl"]'
+    assert parse(json_text) == ['AAPL', 'Tesla', 'MSFT']
+    assert parse('[{"symbol": "AAPL"},') == ['[{"symbol": "AAPL"}']  # broken JSON is read as a plain list
+
+
+def test_quote_client_round_trips_through_the_quote_service(tmp_path, monkeypatch):
+    monkeypatch.setattr(stock, 'price_coalescer', stock.PriceCoalescer(None))
+    asked = []
+
+    async def get_stock_prices(tickers, max_age=None):
+        asked.append(tickers)
+        await asyncio.sleep(0.02 if 'SLOW' in tickers else 0)
+        return {t: {'price': float(len(t)), 'currency': 'USD', 'change': 0.0, 'change_percent': 0.0} for t in tickers if t != 'GONE'}
+    monkeypatch.setattr(stock, 'get_stock_prices', get_stock_prices)
+    path = str(tmp_path / 'quotes.sock')
+
+    async def scenario():
+        server = await stock.serve_quotes(path)
+        client = stock.QuoteClient(path)
+        try:
+            # Replies come back out of order and are matched to their requests by id
+            return await asyncio.gather(client.fetch(['SLOW', 'GONE']), client.fetch(['AAPL']))
+        finally:
+            client._writer.close()
+            server.close()
+            await server.wait_closed()
+    slow, fast = run(scenario())
+
+    assert slow == {'SLOW': {'price': 4.0, 'currency': 'USD', 'change': 0.0, 'change_percent': 0.0}}
+    assert fast == {'AAPL': {'price': 4.0, 'currency': 'USD', 'change': 0.0, 'change_percent': 0.0}}
+    assert sorted(asked) == [['AAPL'], ['SLOW', 'GONE']]
+    assert stock.price_coalescer.window == 0